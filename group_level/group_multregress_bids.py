@@ -6,16 +6,31 @@ contact: annepark@mit.edu
 """
 
 import os
-from nipype import config
-config.enable_provenance()
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from pipeline_utils.lazy import lazy_from, lazy_import
 
-from nipype import Workflow, Node, MapNode, Function
-from nipype import DataGrabber, DataSink
-from nipype.interfaces.fsl import (Merge, FLAMEO, ContrastMgr,
-                                   SmoothEstimate, Cluster, ImageMaths, MultipleRegressDesign)
-import nipype.interfaces.fsl as fsl
-import nipype.interfaces.utility as util
-from nipype.interfaces.fsl.maths import BinaryMaths
+# nipype is imported when the workflow is built, not to parse arguments
+Workflow, Node, MapNode, Function, DataSink = lazy_from(
+    'nipype', 'Workflow', 'Node', 'MapNode', 'Function', 'DataSink')
+(FLAMEO, ContrastMgr, SmoothEstimate, Cluster, ImageMaths,
+ MultipleRegressDesign) = lazy_from(
+    'nipype.interfaces.fsl', 'FLAMEO', 'ContrastMgr', 'SmoothEstimate',
+    'Cluster', 'ImageMaths', 'MultipleRegressDesign')
+fsl = lazy_import('nipype.interfaces.fsl')
+util = lazy_import('nipype.interfaces.utility')
+BinaryMaths = lazy_from('nipype.interfaces.fsl.maths', 'BinaryMaths')
+from pipeline_utils.clusters import CLUSTER_OUTPUTS, cluster_node
+from pipeline_utils.groupinputs import group_inputs_node, merged_node
+from pipeline_utils.graphcache import expand_workflow, run_expanded
+from pipeline_utils.hashing import HashPolicy, add_hash_argument
+from pipeline_utils.l1index import load_l1index
+from pipeline_utils.profiling import RunProfiler
+from pipeline_utils.progress import GroupProgress, expected_nodes
+from pipeline_utils.resources import (apply_resources, default_resource_file,
+                                      load_resource_config, parse_plugin_args)
+from pipeline_utils.toolcache import TOOL_CACHE, ToolEnvironment
 
 get_len = lambda x: len(x)
 
@@ -58,7 +73,7 @@ def get_sub_vars(dataset_dir, task_name, model_id, sub_list_file, behav_file, gr
 
     subs_list = pd.read_table(sub_list_file, index_col=0)['task-%s' % task_name]
     subs_needed = subs_list.index[np.nonzero(subs_list)[0]]
-    behav_info = pd.read_table(behav_file,  delim_whitespace=True, index_col=0)
+    behav_info = pd.read_table(behav_file, sep=r'\s+', index_col=0)
 
     missing_subjects = np.setdiff1d(subs_needed, behav_info.index.tolist())
     if len(missing_subjects) > 0:
@@ -70,7 +85,7 @@ def get_sub_vars(dataset_dir, task_name, model_id, sub_list_file, behav_file, gr
 
     contrasts = []
     for row in contrast_defs:
-        print row
+        print(row)
         if 'task-%s' % task_name not in row:
             continue
         regressor_names =  re.search("\[([\w\s',]+)\]", row).group(1)
@@ -88,7 +103,7 @@ def get_sub_vars(dataset_dir, task_name, model_id, sub_list_file, behav_file, gr
     for idx, con in enumerate(contrasts):
         model_regressor = {}
         for cond in con[0][2]:
-            values = behav_info.ix[subs_needed, cond].values
+            values = behav_info.loc[subs_needed, cond].values
             if tuple(np.unique(values).tolist()) not in [(1,), (0, 1)]:
                 values = values - values.mean()
             model_regressor[cond] = values.tolist()
@@ -111,63 +126,262 @@ def run_palm(cope_file, design_file, contrast_file, group_file, mask_file,
     return [os.path.join(os.getcwd(), val) for val in sorted(glob('palm*'))]
 
 
+def run_permutation(cope_file, design_file, contrast_file, group_file,
+                    mask_file, cluster_threshold=3.09, n_perm=5000, seed=0,
+                    n_procs=1):
+    """Native replacement of run_palm (TFCE, cluster extent, FWE/FDR)"""
+    import os
+    from pipeline_utils.permutation import permutation_test
+    return permutation_test(cope_file, design_file, contrast_file, mask_file,
+                            group_file=group_file, n_perm=n_perm,
+                            cluster_threshold=cluster_threshold, seed=seed,
+                            n_procs=n_procs, out_dir=os.getcwd())
+
+
+def regression_engine(inputs_file, regressors, contrasts, contrast_names,
+                      cope_ids, mask_file, method):
+    """Fit every group contrast of a task to every l1 contrast in one node"""
+    from pipeline_utils.groupinputs import GroupInputs
+    from pipeline_utils.groupstats import regression_design, run_regression
+    inputs = GroupInputs(inputs_file)
+    cope_files = [inputs.data('copes', cope_id) for cope_id in cope_ids]
+    varcope_files = [inputs.data('varcopes', cope_id)
+                     if 'varcopes' in inputs.kinds else None
+                     for cope_id in cope_ids]
+    designs = [regression_design(regs, con)
+               for regs, con in zip(regressors, contrasts)]
+    # name the l1 contrast directories like the cope_id iterables so that
+    # the DataSink layout matches the FLAMEO path
+    out = run_regression(cope_files, varcope_files, designs, mask_file,
+                         method=method, design_dirs=contrast_names,
+                         cope_dirs=['_cope_id_%d' % cope_id
+                                    for cope_id in cope_ids])
+    return (out['copes'], out['varcopes'], out['tstats'], out['zstats'],
+            out['pvals'])
+
+
+def select_contrast(zstats, tstats, pvals, design_index, cope_ids, cope_id):
+    idx = list(cope_ids).index(cope_id)
+    return (zstats[design_index][idx], tstats[design_index][idx],
+            pvals[design_index][idx])
+
+
+def add_inference(wk, zstats_node, zstats_field, mask_file, sink_dir,
+                  no_reversal, cluster_engine='fsl'):
+    """Connect cluster inference and a DataSink to a zstat output
+
+    Returns the DataSink so that further outputs can be connected.
+    """
+    smoothest = Node(SmoothEstimate(), name='smooth_estimate')
+    wk.connect(zstats_node, zstats_field, smoothest, 'zstat_file')
+    smoothest.inputs.mask_file = mask_file
+
+    if cluster_engine == 'fsl':
+        cluster = Node(Cluster(), name='cluster')
+        wk.connect(smoothest, 'dlh', cluster, 'dlh')
+        wk.connect(smoothest, 'volume', cluster, 'volume')
+        cluster.inputs.connectivity = 26
+        cluster.inputs.threshold = 2.3
+        cluster.inputs.pthreshold = 0.05
+        cluster.inputs.out_threshold_file = True
+        cluster.inputs.out_index_file = True
+        cluster.inputs.out_localmax_txt_file = True
+        wk.connect(zstats_node, zstats_field, cluster, 'in_file')
+        sink_outputs = [(cluster, 'threshold_file', 'stats.@thr'),
+                        (cluster, 'index_file', 'stats.@index'),
+                        (cluster, 'localmax_txt_file', 'stats.@localmax')]
+        if not no_reversal:
+            zstats_reverse = Node(BinaryMaths(), name='zstats_reverse')
+            zstats_reverse.inputs.operation = 'mul'
+            zstats_reverse.inputs.operand_value = -1
+            wk.connect(zstats_node, zstats_field, zstats_reverse, 'in_file')
+            cluster2 = cluster.clone(name='cluster2')
+            wk.connect(smoothest, 'dlh', cluster2, 'dlh')
+            wk.connect(smoothest, 'volume', cluster2, 'volume')
+            wk.connect(zstats_reverse, 'out_file', cluster2, 'in_file')
+            sink_outputs.extend([
+                (zstats_reverse, 'out_file', 'stats.@neg'),
+                (cluster2, 'threshold_file', 'stats.@neg_thr'),
+                (cluster2, 'index_file', 'stats.@neg_index'),
+                (cluster2, 'localmax_txt_file', 'stats.@neg_localmax')])
+    else:
+        cluster = Node(Function(input_names=['zstat_file', 'dlh', 'volume',
+                                             'threshold', 'pthreshold',
+                                             'connectivity', 'two_tailed'],
+                                output_names=CLUSTER_OUTPUTS,
+                                function=cluster_node),
+                       name='cluster')
+        wk.connect(smoothest, 'dlh', cluster, 'dlh')
+        wk.connect(smoothest, 'volume', cluster, 'volume')
+        cluster.inputs.connectivity = 26
+        cluster.inputs.threshold = 2.3
+        cluster.inputs.pthreshold = 0.05
+        # positive and reversed contrast clusters from one read of the zstat
+        cluster.inputs.two_tailed = not no_reversal
+        wk.connect(zstats_node, zstats_field, cluster, 'zstat_file')
+        sink_outputs = [(cluster, 'threshold_file', 'stats.@thr'),
+                        (cluster, 'index_file', 'stats.@index'),
+                        (cluster, 'localmax_txt_file', 'stats.@localmax'),
+                        (cluster, 'table_file', 'stats.@clusters')]
+        if not no_reversal:
+            sink_outputs.extend([
+                (cluster, 'neg_threshold_file', 'stats.@neg_thr'),
+                (cluster, 'neg_index_file', 'stats.@neg_index'),
+                (cluster, 'neg_localmax_txt_file', 'stats.@neg_localmax'),
+                (cluster, 'neg_table_file', 'stats.@neg_clusters')])
+
+    ztopval = Node(ImageMaths(op_string='-ztop', suffix='_pval'),
+                   name='z2pval')
+    wk.connect(zstats_node, zstats_field, ztopval,'in_file')
+    
+    sinker = Node(DataSink(), name='sinker')
+    sinker.inputs.base_directory = sink_dir
+    sinker.inputs.substitutions = [('_cope_id', 'contrast'),
+                                   ('_maths_', '_reversed_')]
+    
+    wk.connect(zstats_node, zstats_field, sinker, 'stats')
+    for node, field, dest in sink_outputs:
+        wk.connect(node, field, sinker, dest)
+    return sinker
+
+
+def group_inputs(task, index, cope_ids, subj_list, mask_file, kinds):
+    """Node stacking the masked subject maps of a task in design row order"""
+    inputs = Node(Function(input_names=['index_file', 'cope_ids', 'mask_file',
+                                        'subjects', 'kinds'],
+                           output_names=['inputs_file'],
+                           function=group_inputs_node),
+                  name='group_inputs_task%03d' % task)
+    inputs.inputs.index_file = index.index_file
+    inputs.inputs.cope_ids = list(cope_ids)
+    inputs.inputs.mask_file = mask_file
+    inputs.inputs.subjects = list(subj_list)
+    inputs.inputs.kinds = list(kinds)
+    # the arrays next to the sidecar are read in place by the engines
+    inputs.config = {'execution': {'remove_unnecessary_outputs': False}}
+    return inputs
+
+
+def add_regression_engine(meta_workflow, method, model_id, task, cope_ids,
+                          subj_list, regressors_needed, contrasts, index,
+                          out_dir, no_reversal, cluster_engine='fsl'):
+    """Add the in-process regression of one task to meta_workflow
+
+    A single node fits all group contrasts to the subject copes of each l1
+    contrast, stacked once per task; per group contrast, a small workflow
+    selects the zstat of each l1 contrast and runs the usual cluster
+    inference.
+    """
+    mask_file = fsl.Info.standard_image('MNI152_T1_2mm_brain_mask.nii.gz')
+    inputs = group_inputs(task, index, cope_ids, subj_list, mask_file,
+                          ['copes'] if method == 'ols' else
+                          ['copes', 'varcopes'])
+
+    engine = Node(Function(input_names=['inputs_file', 'regressors',
+                                        'contrasts', 'contrast_names',
+                                        'cope_ids', 'mask_file', 'method'],
+                           output_names=['copes', 'varcopes', 'tstats',
+                                         'zstats', 'pvals'],
+                           function=regression_engine),
+                  name='regress_engine_task%03d' % task)
+    meta_workflow.connect(inputs, 'inputs_file', engine, 'inputs_file')
+    engine.inputs.regressors = regressors_needed
+    engine.inputs.contrasts = contrasts
+    engine.inputs.contrast_names = [contrast[0][0] for contrast in contrasts]
+    engine.inputs.cope_ids = list(cope_ids)
+    engine.inputs.mask_file = mask_file
+    engine.inputs.method = method
+
+    for idx, contrast in enumerate(contrasts):
+        wk = Workflow(name='model_%03d_task_%03d_contrast_%s' % (model_id, task, contrast[0][0]))
+        select = Node(Function(input_names=['zstats', 'tstats', 'pvals',
+                                            'design_index', 'cope_ids',
+                                            'cope_id'],
+                               output_names=['zstat', 'tstat', 'pval'],
+                               function=select_contrast),
+                      name='select_contrast')
+        select.inputs.design_index = idx
+        select.inputs.cope_ids = list(cope_ids)
+        select.iterables = ('cope_id', cope_ids)
+        sinker = add_inference(wk, select, 'zstat', mask_file,
+                               os.path.join(out_dir, 'task%03d' % task,
+                                            contrast[0][0]),
+                               no_reversal, cluster_engine)
+        wk.connect(select, 'tstat', sinker, 'stats.@tstat')
+        wk.connect(select, 'pval', sinker, 'stats.@pval')
+        for field in ['zstats', 'tstats', 'pvals']:
+            meta_workflow.connect(engine, field,
+                                  wk, 'select_contrast.%s' % field)
+
+
 def group_multregress_openfmri(dataset_dir, model_id=None, task_id=None, l1output_dir=None, out_dir=None, 
                                no_reversal=False, plugin=None, plugin_args=None, flamemodel='flame1',
                                nonparametric=False, use_spm=False,
-                               sub_list_file=None, behav_file=None, group_contrast_file=None):
+                               sub_list_file=None, behav_file=None, group_contrast_file=None,
+                               engine='flameo', use_palm=False, n_perm=5000, perm_seed=0,
+                               perm_workers=1, cluster_engine='fsl',
+                               work_dir=None):
+    """Build the group multiple regression workflow
+
+    engine 'flameo' runs MultipleRegressDesign, fslmerge and FLAMEO
+    (flamemodel) for every group contrast and l1 contrast; 'ols' and 'wls'
+    fit all of them per task in one node with pipeline_utils.groupstats.
+
+    nonparametric adds permutation inference with the native engine of
+    pipeline_utils.permutation (n_perm shuffles drawn from perm_seed, run
+    by perm_workers processes), or with MATLAB/Octave PALM if use_palm.
+
+    cluster_engine selects FSL's cluster (default) or the in-process GRF
+    cluster inference of pipeline_utils.clusters.
+
+    Every task/contrast sub-workflow is independent, so with MultiProc
+    their FLAMEO/permutation jobs run concurrently.
+    """
+    if engine != 'flameo' and nonparametric:
+        raise ValueError('--nonparametric requires the flameo engine')
 
     meta_workflow = Workflow(name='mult_regress')
-    meta_workflow.base_dir = work_dir
+    meta_workflow.base_dir = os.path.abspath(work_dir or os.getcwd())
     for task in task_id:
         task_name = get_taskname(dataset_dir, task)
-        cope_ids = l1_contrasts_num(model_id, task_name, dataset_dir)
         regressors_needed, contrasts, groups, subj_list = get_sub_vars(dataset_dir, task_name, model_id,
                                                                       sub_list_file, behav_file, group_contrast_file)
+        # scan the first level outputs once and fail early on missing files
+        index = load_l1index(l1output_dir, model_id, task,
+                             os.path.join(meta_workflow.base_dir,
+                                          'l1index_model%03d_task%03d.json' %
+                                          (model_id, task)),
+                             use_spm=use_spm)
+        cope_ids = list(l1_contrasts_num(model_id, task_name, dataset_dir)) or \
+            index.cope_ids()
+        index.check(cope_ids, list(subj_list))
+        if engine != 'flameo':
+            add_regression_engine(meta_workflow, engine, model_id, task,
+                                  cope_ids, subj_list, regressors_needed,
+                                  contrasts, index, out_dir,
+                                  no_reversal, cluster_engine)
+            continue
+        mask_file = fsl.Info.standard_image('MNI152_T1_2mm_brain_mask.nii.gz')
+        # the subject maps are stacked once per task and shared by the
+        # group contrasts, in the order of the design rows
+        inputs = group_inputs(task, index, cope_ids, subj_list, mask_file,
+                              ['copes'] if flamemodel == 'ols' else
+                              ['copes', 'varcopes'])
         for idx, contrast in enumerate(contrasts):
             wk = Workflow(name='model_%03d_task_%03d_contrast_%s' % (model_id, task, contrast[0][0]))
 
-            info = Node(util.IdentityInterface(fields=['model_id', 'task_id', 'dataset_dir', 'subj_list']),
-                        name='infosource')
-            info.inputs.model_id = model_id
-            info.inputs.task_id = task
-            info.inputs.dataset_dir = dataset_dir
-            
-            dg = Node(DataGrabber(infields=['model_id', 'task_id', 'cope_id'],
-                                  outfields=['copes', 'varcopes']), name='grabber')
-            dg.inputs.template = os.path.join(l1output_dir,
-                                              'model%03d/task%03d/%s/%scopes/%smni/%scope%02d.nii%s')
-            if use_spm:
-                dg.inputs.template_args['copes'] = [['model_id', 'task_id', subj_list, '', 'spm/',
-                                                     '', 'cope_id', '']]
-                dg.inputs.template_args['varcopes'] = [['model_id', 'task_id', subj_list, 'var', 'spm/',
-                                                        'var', 'cope_id', '.gz']]
-            else:
-                dg.inputs.template_args['copes'] = [['model_id', 'task_id', subj_list, '', '', '', 
-                                                     'cope_id', '.gz']]
-                dg.inputs.template_args['varcopes'] = [['model_id', 'task_id', subj_list, 'var', '',
-                                                        'var', 'cope_id', '.gz']]
-            dg.iterables=('cope_id', cope_ids)
-            dg.inputs.sort_filelist = False
-
-            wk.connect(info, 'model_id', dg, 'model_id')
-            wk.connect(info, 'task_id', dg, 'task_id')
-
-            print '------------'
-            print dg
+            merged = Node(Function(input_names=['inputs_file', 'cope_id'],
+                                   output_names=['cope_file', 'varcope_file',
+                                                 'num_copes'],
+                                   function=merged_node),
+                          name='merged_inputs')
+            merged.iterables=('cope_id', cope_ids)
             
             model = Node(MultipleRegressDesign(), name='l2model')
             model.inputs.groups = groups
             model.inputs.contrasts = contrasts[idx]
             model.inputs.regressors = regressors_needed[idx]
             
-            mergecopes = Node(Merge(dimension='t'), name='merge_copes')
-            wk.connect(dg, 'copes', mergecopes, 'in_files')
-            
-            if flamemodel != 'ols':
-                mergevarcopes = Node(Merge(dimension='t'), name='merge_varcopes')
-                wk.connect(dg, 'varcopes', mergevarcopes, 'in_files')
-            
-            mask_file = fsl.Info.standard_image('MNI152_T1_2mm_brain_mask.nii.gz')
             flame = Node(FLAMEO(), name='flameo')
             flame.inputs.mask_file =  mask_file
             flame.inputs.run_mode = flamemodel
@@ -175,12 +389,12 @@ def group_multregress_openfmri(dataset_dir, model_id=None, task_id=None, l1outpu
 
             wk.connect(model, 'design_mat', flame, 'design_file')
             wk.connect(model, 'design_con', flame, 't_con_file')
-            wk.connect(mergecopes, 'merged_file', flame, 'cope_file')
+            wk.connect(merged, 'cope_file', flame, 'cope_file')
             if flamemodel != 'ols':
-                wk.connect(mergevarcopes, 'merged_file', flame, 'var_cope_file')
+                wk.connect(merged, 'varcope_file', flame, 'var_cope_file')
             wk.connect(model, 'design_grp', flame, 'cov_split_file')
             
-            if nonparametric:
+            if nonparametric and use_palm:
                 palm = Node(Function(input_names=['cope_file', 'design_file', 'contrast_file', 
                                                   'group_file', 'mask_file', 'cluster_threshold'],
                                      output_names=['palm_outputs'],
@@ -188,63 +402,34 @@ def group_multregress_openfmri(dataset_dir, model_id=None, task_id=None, l1outpu
                             name='palm')
                 palm.inputs.cluster_threshold = 3.09
                 palm.inputs.mask_file = mask_file
-                palm.plugin_args = {'sbatch_args': '-p om_all_nodes -N1 -c2 --mem=10G', 'overwrite': True}
+            elif nonparametric:
+                palm = Node(Function(input_names=['cope_file', 'design_file', 'contrast_file',
+                                                  'group_file', 'mask_file', 'cluster_threshold',
+                                                  'n_perm', 'seed', 'n_procs'],
+                                     output_names=['palm_outputs'],
+                                     function=run_permutation),
+                            name='permutation')
+                palm.inputs.cluster_threshold = 3.09
+                palm.inputs.mask_file = mask_file
+                palm.inputs.n_perm = n_perm
+                palm.inputs.seed = perm_seed
+                palm.inputs.n_procs = perm_workers
+                palm.n_procs = perm_workers
+            if nonparametric:
                 wk.connect(model, 'design_mat', palm, 'design_file')
                 wk.connect(model, 'design_con', palm, 'contrast_file')
-                wk.connect(mergecopes, 'merged_file', palm, 'cope_file')
+                wk.connect(merged, 'cope_file', palm, 'cope_file')
                 wk.connect(model, 'design_grp', palm, 'group_file')
                 
-            smoothest = Node(SmoothEstimate(), name='smooth_estimate')
-            wk.connect(flame, 'zstats', smoothest, 'zstat_file')
-            smoothest.inputs.mask_file = mask_file
-        
-            cluster = Node(Cluster(), name='cluster')
-            wk.connect(smoothest,'dlh', cluster, 'dlh')
-            wk.connect(smoothest, 'volume', cluster, 'volume')
-            cluster.inputs.connectivity = 26
-            cluster.inputs.threshold = 2.3
-            cluster.inputs.pthreshold = 0.05
-            cluster.inputs.out_threshold_file = True
-            cluster.inputs.out_index_file = True
-            cluster.inputs.out_localmax_txt_file = True
-            
-            wk.connect(flame, 'zstats', cluster, 'in_file')
-    
-            ztopval = Node(ImageMaths(op_string='-ztop', suffix='_pval'),
-                           name='z2pval')
-            wk.connect(flame, 'zstats', ztopval,'in_file')
-            
-            sinker = Node(DataSink(), name='sinker')
-            sinker.inputs.base_directory = os.path.join(out_dir, 'task%03d' % task, contrast[0][0])
-            sinker.inputs.substitutions = [('_cope_id', 'contrast'),
-                                           ('_maths_', '_reversed_')]
-            
-            wk.connect(flame, 'zstats', sinker, 'stats')
-            wk.connect(cluster, 'threshold_file', sinker, 'stats.@thr')
-            wk.connect(cluster, 'index_file', sinker, 'stats.@index')
-            wk.connect(cluster, 'localmax_txt_file', sinker, 'stats.@localmax')
+            sinker = add_inference(wk, flame, 'zstats', mask_file,
+                                   os.path.join(out_dir, 'task%03d' % task,
+                                                contrast[0][0]),
+                                   no_reversal, cluster_engine)
             if nonparametric:
                 wk.connect(palm, 'palm_outputs', sinker, 'stats.palm')
-
-            if not no_reversal:
-                zstats_reverse = Node( BinaryMaths()  , name='zstats_reverse')
-                zstats_reverse.inputs.operation = 'mul'
-                zstats_reverse.inputs.operand_value = -1
-                wk.connect(flame, 'zstats', zstats_reverse, 'in_file')
-                
-                cluster2=cluster.clone(name='cluster2')
-                wk.connect(smoothest, 'dlh', cluster2, 'dlh')
-                wk.connect(smoothest, 'volume', cluster2, 'volume')
-                wk.connect(zstats_reverse, 'out_file', cluster2, 'in_file')
-                
-                ztopval2 = ztopval.clone(name='ztopval2')
-                wk.connect(zstats_reverse, 'out_file', ztopval2, 'in_file')
-                
-                wk.connect(zstats_reverse, 'out_file', sinker, 'stats.@neg')
-                wk.connect(cluster2, 'threshold_file', sinker, 'stats.@neg_thr')
-                wk.connect(cluster2, 'index_file',sinker, 'stats.@neg_index')
-                wk.connect(cluster2, 'localmax_txt_file', sinker, 'stats.@neg_localmax')
-            meta_workflow.add_nodes([wk])
+            # connected once the sub-workflow has its merged_inputs node
+            meta_workflow.connect(inputs, 'inputs_file',
+                                  wk, 'merged_inputs.inputs_file')
     return meta_workflow
 
 if __name__ == '__main__':
@@ -264,19 +449,50 @@ if __name__ == '__main__':
     parser.add_argument("-w", "--work_dir", dest="work_dir",
                         help="Output directory base")
     parser.add_argument("-p", "--plugin", dest="plugin",
-                        default='Linear',
+                        default='MultiProc',
                         help="Plugin to use" + defstr)
+    parser.add_argument("--n_procs", dest="n_procs", default=None, type=int,
+                        help=("Concurrent jobs of the MultiProc plugin "
+                              "(default: all CPUs)"))
     parser.add_argument("--plugin_args", dest="plugin_args",
                         help="Plugin arguments")
+    parser.add_argument("--resources", dest="resources",
+                        default=default_resource_file(__file__),
+                        help=("JSON or YAML file with default and per-node "
+                              "CPU/memory/partition requests" + defstr))
+    parser.add_argument("--profile", dest="profile", action='store_true',
+                        help=("Record wall/CPU time, memory and I/O of every "
+                              "node and write reports to <work_dir>/profile"))
     parser.add_argument("--norev",action='store_true',
                         help="do not generate reverse contrasts")
     parser.add_argument("--use_spm",action='store_true', default=False,
                         help="use spm estimation results from 1st level")
     parser.add_argument("--nonparametric", action='store_true', default=False,
-                        help="Run non-parametric estimation using palm" + defstr)
+                        help="Run non-parametric estimation using permutations" + defstr)
+    parser.add_argument("--use_palm", action='store_true', default=False,
+                        help=("Run the permutations with MATLAB/Octave PALM "
+                              "instead of the native engine" + defstr))
+    parser.add_argument("--n_perm", dest="n_perm", default=5000, type=int,
+                        help="Number of permutations of the native engine" + defstr)
+    parser.add_argument("--perm_seed", dest="perm_seed", default=0, type=int,
+                        help="Seed of the native permutations" + defstr)
+    parser.add_argument("--perm_workers", dest="perm_workers", default=4,
+                        type=int,
+                        help="Processes of the native permutation engine" + defstr)
     parser.add_argument('-f','--flame', dest='flamemodel', default='flame1',
                         choices=('ols', 'flame1', 'flame12'),
                         help='tool to use for dicom conversion' + defstr)
+    parser.add_argument("--engine", dest="engine", default='flameo',
+                        choices=('flameo', 'ols', 'wls'),
+                        help=("Group estimator: FLAMEO per group and l1 "
+                              "contrast, or in-process OLS / mixed effects "
+                              "WLS of all contrasts of a task in one node" +
+                              defstr))
+    parser.add_argument("--cluster_engine", dest="cluster_engine",
+                        default='fsl', choices=('python', 'fsl'),
+                        help=("GRF cluster inference with FSL's cluster, or "
+                              "in-process (both tails from one read of the "
+                              "zstat, plus a cluster table)" + defstr))
     parser.add_argument("--sleep", dest="sleep", default=60., type=float,
                         help="Time to sleep between polls" + defstr)
     parser.add_argument("-s", "--sub_list_file", dest="sub_list_file",
@@ -291,7 +507,10 @@ if __name__ == '__main__':
     parser.add_argument("--crashdump_dir", dest="crashdump_dir",
                         help="Crashdump dir", default=None)    
                         
+    add_hash_argument(parser)
     args = parser.parse_args()
+    from nipype import config
+    config.enable_provenance()
     outdir = args.outdir
     work_dir = os.getcwd()
 
@@ -317,13 +536,39 @@ if __name__ == '__main__':
                                     use_spm=args.use_spm,
                                     sub_list_file=args.sub_list_file, 
                                     behav_file=args.behav_file, 
-                                    group_contrast_file=args.group_contrast_file)
+                                    group_contrast_file=args.group_contrast_file,
+                                    engine=args.engine,
+                                    use_palm=args.use_palm,
+                                    n_perm=args.n_perm,
+                                    perm_seed=args.perm_seed,
+                                    perm_workers=args.perm_workers,
+                                    cluster_engine=args.cluster_engine,
+                                    work_dir=work_dir)
     wf.config['execution']['poll_sleep_duration'] = args.sleep
     
     if not (args.crashdump_dir is None):
         wf.config['execution']['crashdump_dir'] = args.crashdump_dir    
 
-    if args.plugin_args:
-        wf.run(args.plugin, plugin_args=eval(args.plugin_args))
-    else:
-        wf.run(args.plugin)
+    apply_resources(wf, load_resource_config(args.resources))
+    # probe FSL, ANTs and FreeSurfer once for the driver and all nodes
+    tools = ToolEnvironment(os.path.join(work_dir, TOOL_CACHE))
+    tools.probe()
+    tools.attach(wf)
+    hashing = HashPolicy(args.hash_method)
+    hashing.configure(wf)
+    hashing.attach(wf)
+    plugin_args = parse_plugin_args(args.plugin_args)
+    if args.plugin == 'MultiProc' and args.n_procs:
+        plugin_args.setdefault('n_procs', args.n_procs)
+    # expanded once, for the progress totals and the run
+    execgraph = expand_workflow(wf)
+    GroupProgress(wf.name, expected_nodes(execgraph, wf.name)).install(
+        plugin_args)
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler(os.path.join(work_dir, 'profile'), wf.name)
+        profiler.install(plugin_args)
+    execgraph = run_expanded(wf, execgraph, args.plugin,
+                             plugin_args=plugin_args)
+    if profiler is not None:
+        profiler.write(execgraph)
@@ -1,14 +1,26 @@
 import os
-from nipype import config
-config.enable_provenance()
-from nipype import Workflow, Node, MapNode
-from nipype import DataGrabber, DataSink
-from nipype.interfaces.fsl import (L2Model, Merge, FLAMEO, ContrastMgr, 
-                                   SmoothEstimate, Cluster, ImageMaths)
-import nipype.interfaces.fsl as fsl
-import nipype.interfaces.utility as util
-from nipype.interfaces.fsl.maths import BinaryMaths
-get_len = lambda x: len(x)
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from pipeline_utils.lazy import lazy_from, lazy_import
+
+# nipype is imported when the workflow is built, not to parse arguments
+Workflow, Node, MapNode, Function, DataSink = lazy_from(
+    'nipype', 'Workflow', 'Node', 'MapNode', 'Function', 'DataSink')
+L2Model, FLAMEO, ContrastMgr, SmoothEstimate, Cluster, ImageMaths = lazy_from(
+    'nipype.interfaces.fsl', 'L2Model', 'FLAMEO', 'ContrastMgr',
+    'SmoothEstimate', 'Cluster', 'ImageMaths')
+fsl = lazy_import('nipype.interfaces.fsl')
+util = lazy_import('nipype.interfaces.utility')
+BinaryMaths = lazy_from('nipype.interfaces.fsl.maths', 'BinaryMaths')
+from pipeline_utils.clusters import CLUSTER_OUTPUTS, cluster_node
+from pipeline_utils.groupinputs import group_inputs_node, merged_node
+from pipeline_utils.hashing import HashPolicy, add_hash_argument
+from pipeline_utils.l1index import load_l1index
+from pipeline_utils.profiling import RunProfiler
+from pipeline_utils.resources import (apply_resources, default_resource_file,
+                                      load_resource_config, parse_plugin_args)
+from pipeline_utils.toolcache import TOOL_CACHE, ToolEnvironment
 def contrasts_num(model_id,
                   task_id,
                   dataset_dir):
@@ -33,72 +45,225 @@ def contrasts_num(model_id,
     cope_id = range(1, contrasts + 1)
     return cope_id
 
-def group_onesample_openfmri(dataset_dir,model_id=None,task_id=None,l1output_dir=None,out_dir=None, no_reversal=False):
+def onesample_engine(index_file, inputs_file, cope_ids, mask_file, method,
+                     n_workers, store_dir):
+    """Run the one-sample test of all contrasts in one node"""
+    from pipeline_utils.groupinputs import GroupInputs
+    from pipeline_utils.groupstats import run_flameo_batch, run_onesample
+    from pipeline_utils.incremental import run_incremental
+    if inputs_file:
+        inputs = GroupInputs(inputs_file)
+        # FLAMEO reads 4D images, the in-process engines the stacked arrays
+        if method == 'flameo-batch':
+            get = inputs.merged_file
+        else:
+            get = inputs.data
+        cope_files = [get('copes', cope_id) for cope_id in cope_ids]
+        varcope_files = [get('varcopes', cope_id)
+                         if 'varcopes' in inputs.kinds else None
+                         for cope_id in cope_ids]
+    # name the contrast directories like the cope_id iterables so that the
+    # DataSink layout matches the FLAMEO path
+    subdirs = ['_cope_id_%d' % cope_id for cope_id in cope_ids]
+    if method == 'flameo-batch':
+        out = run_flameo_batch(cope_files, varcope_files, mask_file,
+                               run_mode='flame1', n_workers=n_workers,
+                               subdirs=subdirs)
+    elif method.endswith('-incremental'):
+        out = run_incremental(index_file, cope_ids, mask_file,
+                              method=method.split('-')[0],
+                              store_dir=store_dir, subdirs=subdirs)
+    else:
+        out = run_onesample(cope_files, varcope_files, mask_file,
+                            method=method, subdirs=subdirs)
+    return out['copes'], out['varcopes'], out['tstats'], out['zstats']
 
-    wk = Workflow(name='one_sample')
-    wk.base_dir = os.path.abspath(work_dir)
+def select_contrast(in_files, cope_ids, cope_id):
+    return in_files[list(cope_ids).index(cope_id)]
 
-    info = Node(util.IdentityInterface(fields=['model_id','task_id','dataset_dir']),
-                                        name='infosource')
-    info.inputs.model_id=model_id
-    info.inputs.task_id=task_id
-    info.inputs.dataset_dir=dataset_dir
-    
-    num_copes=contrasts_num(model_id,task_id,dataset_dir)
+def group_onesample_openfmri(dataset_dir,model_id=None,task_id=None,l1output_dir=None,out_dir=None, no_reversal=False,
+                             engine='flameo', n_workers=None,
+                             cluster_engine='fsl', store_dir=None):
+    """Build the one-sample group workflow
 
-    dg = Node(DataGrabber(infields=['model_id','task_id','cope_id'], 
-                          outfields=['copes', 'varcopes']),name='grabber')
-    dg.inputs.template = os.path.join(l1output_dir,'model%03d/task%03d/*/%scopes/mni/%scope%02d.nii.gz')
-    dg.inputs.template_args['copes'] = [['model_id','task_id','', '', 'cope_id']]
-    dg.inputs.template_args['varcopes'] = [['model_id','task_id','var', 'var', 'cope_id']]
-    dg.iterables=('cope_id',num_copes)
+    engine selects FLAMEO (flame1 on merged 4D copes/varcopes, one run per
+    contrast), 'flameo-batch' (flame1 for all contrasts in one node, sharing
+    the design and running n_workers FLAMEO processes at a time) or the
+    in-process 'ols'/'wls' estimator of pipeline_utils.groupstats.
+    'ols-incremental'/'fe-incremental' keep OLS/fixed effects sufficient
+    statistics per contrast in store_dir (default: in the working
+    directory) and only read the subjects added since the last run.
+    cluster_engine selects FSL's cluster (default) or the in-process
+    cluster inference of pipeline_utils.clusters.
+    """
 
-    dg.inputs.sort_filelist = True
+    wk = Workflow(name='one_sample')
+    wk.base_dir = os.path.abspath(work_dir)
 
-    wk.connect(info,'model_id',dg,'model_id')
-    wk.connect(info,'task_id',dg,'task_id')
+    # scan the first level outputs once and fail early on missing files
+    index = load_l1index(l1output_dir, model_id, task_id,
+                         os.path.join(wk.base_dir, 'l1index_model%03d_task%03d.json'
+                                      % (model_id, task_id)))
+    num_copes = list(contrasts_num(model_id, task_id, dataset_dir)) or \
+        index.cope_ids()
+    index.check(num_copes)
 
-    model = Node(L2Model(), name='l2model')
+    mask_file = fsl.Info.standard_image('MNI152_T1_2mm_brain_mask.nii.gz')
+    if engine != 'flameo':
+        if store_dir is None:
+            store_dir = os.path.join(wk.base_dir,
+                                     'groupstats_model%03d_task%03d'
+                                     % (model_id, task_id))
+        return _group_onesample_engine(wk, index.index_file, mask_file,
+                                       num_copes, out_dir, no_reversal,
+                                       engine, n_workers, cluster_engine,
+                                       os.path.abspath(store_dir))
 
-    wk.connect(dg, ('copes', get_len), model, 'num_copes')
+    inputs = group_inputs(index.index_file, num_copes, mask_file)
+    merged = Node(Function(input_names=['inputs_file', 'cope_id'],
+                           output_names=['cope_file', 'varcope_file',
+                                         'num_copes'],
+                           function=merged_node), name='merged_inputs')
+    merged.iterables=('cope_id',num_copes)
+    wk.connect(inputs, 'inputs_file', merged, 'inputs_file')
 
-    mergecopes = Node(Merge(dimension='t'), name='merge_copes')
-    wk.connect(dg, 'copes', mergecopes, 'in_files')
+    model = Node(L2Model(), name='l2model')
 
-    mergevarcopes = Node(Merge(dimension='t'), name='merge_varcopes')
-    wk.connect(dg, 'varcopes', mergevarcopes, 'in_files')
+    wk.connect(merged, 'num_copes', model, 'num_copes')
 
-    mask_file = fsl.Info.standard_image('MNI152_T1_2mm_brain_mask.nii.gz')
     flame = Node(FLAMEO(), name='flameo')
     flame.inputs.mask_file =  mask_file
     flame.inputs.run_mode = 'flame1'
 
     wk.connect(model, 'design_mat', flame, 'design_file')
     wk.connect(model, 'design_con', flame, 't_con_file')
-    wk.connect(mergecopes, 'merged_file', flame, 'cope_file')
-    wk.connect(mergevarcopes, 'merged_file', flame, 'var_cope_file')
+    wk.connect(merged, 'cope_file', flame, 'cope_file')
+    wk.connect(merged, 'varcope_file', flame, 'var_cope_file')
     wk.connect(model, 'design_grp', flame, 'cov_split_file')
 
+    add_inference(wk, flame, 'zstats', mask_file, out_dir, no_reversal,
+                  cluster_engine)
+    return wk
+
+def group_inputs(index_file, cope_ids, mask_file, kinds=('copes', 'varcopes')):
+    """Node stacking the masked subject maps of all contrasts once"""
+    inputs = Node(Function(input_names=['index_file', 'cope_ids', 'mask_file',
+                                        'subjects', 'kinds'],
+                           output_names=['inputs_file'],
+                           function=group_inputs_node), name='group_inputs')
+    inputs.inputs.index_file = index_file
+    inputs.inputs.cope_ids = list(cope_ids)
+    inputs.inputs.mask_file = mask_file
+    inputs.inputs.subjects = []
+    inputs.inputs.kinds = list(kinds)
+    # the arrays next to the sidecar are read in place by the engines
+    inputs.config = {'execution': {'remove_unnecessary_outputs': False}}
+    return inputs
+
+def _group_onesample_engine(wk, index_file, mask_file, num_copes, out_dir,
+                            no_reversal, method, n_workers, cluster_engine,
+                            store_dir=None):
+    engine = Node(Function(input_names=['index_file', 'inputs_file',
+                                        'cope_ids', 'mask_file', 'method',
+                                        'n_workers', 'store_dir'],
+                           output_names=['copes', 'varcopes', 'tstats',
+                                         'zstats'],
+                           function=onesample_engine),
+                  name='onesample_engine')
+    engine.inputs.index_file = index_file
+    engine.inputs.cope_ids = list(num_copes)
+    engine.inputs.mask_file = mask_file
+    engine.inputs.method = method
+    engine.inputs.n_workers = n_workers
+    engine.inputs.store_dir = store_dir
+    if method.endswith('-incremental'):
+        # the index file keeps its name when subjects are added, and the
+        # stored statistics make a rerun cheap
+        engine.overwrite = True
+        engine.inputs.inputs_file = None
+    else:
+        inputs = group_inputs(index_file, num_copes, mask_file,
+                              ['copes'] if method == 'ols' else
+                              ['copes', 'varcopes'])
+        wk.connect(inputs, 'inputs_file', engine, 'inputs_file')
+
+    select = Node(Function(input_names=['in_files', 'cope_ids', 'cope_id'],
+                           output_names=['out_file'],
+                           function=select_contrast),
+                  name='select_contrast')
+    select.inputs.cope_ids = list(num_copes)
+    select.iterables = ('cope_id', num_copes)
+    wk.connect(engine, 'zstats', select, 'in_files')
+
+    add_inference(wk, select, 'out_file', mask_file, out_dir, no_reversal,
+                  cluster_engine)
+    return wk
+
+def add_inference(wk, zstats_node, zstats_field, mask_file, out_dir,
+                  no_reversal, cluster_engine='fsl'):
+    """Connect cluster inference and the DataSink to a zstat output"""
     smoothest = Node(SmoothEstimate(), name='smooth_estimate') 
-    wk.connect(flame, 'zstats', smoothest, 'zstat_file')
+    wk.connect(zstats_node, zstats_field, smoothest, 'zstat_file')
     smoothest.inputs.mask_file = mask_file
 
   
-    cluster = Node(Cluster(), name='cluster')
-    wk.connect(smoothest,'dlh', cluster, 'dlh')
-    wk.connect(smoothest, 'volume', cluster, 'volume')
-    cluster.inputs.connectivity = 26
-    cluster.inputs.threshold=2.3
-    cluster.inputs.pthreshold = 0.05
-    cluster.inputs.out_threshold_file = True
-    cluster.inputs.out_index_file = True
-    cluster.inputs.out_localmax_txt_file = True
-
-    wk.connect(flame, 'zstats', cluster, 'in_file')
-	 
+    if cluster_engine == 'fsl':
+        cluster = Node(Cluster(), name='cluster')
+        wk.connect(smoothest, 'dlh', cluster, 'dlh')
+        wk.connect(smoothest, 'volume', cluster, 'volume')
+        cluster.inputs.connectivity = 26
+        cluster.inputs.threshold = 2.3
+        cluster.inputs.pthreshold = 0.05
+        cluster.inputs.out_threshold_file = True
+        cluster.inputs.out_index_file = True
+        cluster.inputs.out_localmax_txt_file = True
+        wk.connect(zstats_node, zstats_field, cluster, 'in_file')
+        sink_outputs = [(cluster, 'threshold_file', 'stats.@thr'),
+                        (cluster, 'index_file', 'stats.@index'),
+                        (cluster, 'localmax_txt_file', 'stats.@localmax')]
+        if not no_reversal:
+            zstats_reverse = Node(BinaryMaths(), name='zstats_reverse')
+            zstats_reverse.inputs.operation = 'mul'
+            zstats_reverse.inputs.operand_value = -1
+            wk.connect(zstats_node, zstats_field, zstats_reverse, 'in_file')
+            cluster2 = cluster.clone(name='cluster2')
+            wk.connect(smoothest, 'dlh', cluster2, 'dlh')
+            wk.connect(smoothest, 'volume', cluster2, 'volume')
+            wk.connect(zstats_reverse, 'out_file', cluster2, 'in_file')
+            sink_outputs.extend([
+                (zstats_reverse, 'out_file', 'stats.@neg'),
+                (cluster2, 'threshold_file', 'stats.@neg_thr'),
+                (cluster2, 'index_file', 'stats.@neg_index'),
+                (cluster2, 'localmax_txt_file', 'stats.@neg_localmax')])
+    else:
+        cluster = Node(Function(input_names=['zstat_file', 'dlh', 'volume',
+                                             'threshold', 'pthreshold',
+                                             'connectivity', 'two_tailed'],
+                                output_names=CLUSTER_OUTPUTS,
+                                function=cluster_node),
+                       name='cluster')
+        wk.connect(smoothest, 'dlh', cluster, 'dlh')
+        wk.connect(smoothest, 'volume', cluster, 'volume')
+        cluster.inputs.connectivity = 26
+        cluster.inputs.threshold = 2.3
+        cluster.inputs.pthreshold = 0.05
+        # positive and reversed contrast clusters from one read of the zstat
+        cluster.inputs.two_tailed = not no_reversal
+        wk.connect(zstats_node, zstats_field, cluster, 'zstat_file')
+        sink_outputs = [(cluster, 'threshold_file', 'stats.@thr'),
+                        (cluster, 'index_file', 'stats.@index'),
+                        (cluster, 'localmax_txt_file', 'stats.@localmax'),
+                        (cluster, 'table_file', 'stats.@clusters')]
+        if not no_reversal:
+            sink_outputs.extend([
+                (cluster, 'neg_threshold_file', 'stats.@neg_thr'),
+                (cluster, 'neg_index_file', 'stats.@neg_index'),
+                (cluster, 'neg_localmax_txt_file', 'stats.@neg_localmax'),
+                (cluster, 'neg_table_file', 'stats.@neg_clusters')])
+
     ztopval = Node(ImageMaths(op_string='-ztop', suffix='_pval'),
                    name='z2pval')
-    wk.connect(flame, 'zstats', ztopval,'in_file')
+    wk.connect(zstats_node, zstats_field, ztopval,'in_file')
     
     
 
@@ -107,31 +272,10 @@ def group_onesample_openfmri(dataset_dir,model_id=None,task_id=None,l1output_dir
     sinker.inputs.substitutions = [('_cope_id', 'contrast'),
 			            ('_maths__', '_reversed_')]
     
-    wk.connect(flame, 'zstats', sinker, 'stats')
-    wk.connect(cluster, 'threshold_file', sinker, 'stats.@thr')
-    wk.connect(cluster, 'index_file', sinker, 'stats.@index')
-    wk.connect(cluster, 'localmax_txt_file', sinker, 'stats.@localmax')
-    
-    if no_reversal == False:
-        zstats_reverse = Node( BinaryMaths()  , name='zstats_reverse')
-        zstats_reverse.inputs.operation = 'mul'
-        zstats_reverse.inputs.operand_value= -1
-        wk.connect(flame, 'zstats', zstats_reverse, 'in_file')
-
-        cluster2=cluster.clone(name='cluster2')
-        wk.connect(smoothest,'dlh',cluster2,'dlh')
-        wk.connect(smoothest,'volume',cluster2,'volume')
-        wk.connect(zstats_reverse,'out_file',cluster2,'in_file')
-   
-        ztopval2 = ztopval.clone(name='ztopval2')
-        wk.connect(zstats_reverse,'out_file',ztopval2,'in_file')
-
-        wk.connect(zstats_reverse,'out_file',sinker,'stats.@neg')
-        wk.connect(cluster2,'threshold_file',sinker,'stats.@neg_thr')
-        wk.connect(cluster2,'index_file',sinker,'stats.@neg_index')
-        wk.connect(cluster2,'localmax_txt_file',sinker,'stats.@neg_localmax')
+    wk.connect(zstats_node, zstats_field, sinker, 'stats')
+    for node, field, dest in sink_outputs:
+        wk.connect(node, field, sinker, dest)
 
-    return wk
 
 if __name__ == '__main__':
     import argparse
@@ -154,9 +298,41 @@ if __name__ == '__main__':
                         help="Plugin to use")
     parser.add_argument("--plugin_args", dest="plugin_args",
                         help="Plugin arguments")
+    parser.add_argument("--resources", dest="resources",
+                        default=default_resource_file(__file__),
+                        help=("JSON or YAML file with default and per-node "
+                              "CPU/memory/partition requests" + defstr))
+    parser.add_argument("--profile", dest="profile", action='store_true',
+                        help=("Record wall/CPU time, memory and I/O of every "
+                              "node and write reports to <work_dir>/profile"))
     parser.add_argument("--norev",action='store_true',
                         help="if reversal of contrasts already in task_contrasts.txt") 
+    parser.add_argument("--engine", dest="engine", default='flameo',
+                        choices=('flameo', 'flameo-batch', 'ols', 'wls',
+                                 'ols-incremental', 'fe-incremental'),
+                        help=("Group estimator: FLAMEO flame1 per contrast, "
+                              "FLAMEO flame1 for all contrasts in one node, "
+                              "in-process OLS / mixed effects WLS over all "
+                              "contrasts at once, or OLS / fixed effects "
+                              "updated with the subjects added since the "
+                              "last run" + defstr))
+    parser.add_argument("--store_dir", dest="store_dir",
+                        help=("Directory of the sufficient statistics of the "
+                              "incremental engines (default: "
+                              "<work_dir>/groupstats_model<m>_task<t>)"))
+    parser.add_argument("--n_workers", dest="n_workers", default=4, type=int,
+                        help=("Parallel FLAMEO processes of the flameo-batch "
+                              "engine; keep it at the cpus requested for "
+                              "onesample_engine in --resources" + defstr))
+    parser.add_argument("--cluster_engine", dest="cluster_engine",
+                        default='fsl', choices=('python', 'fsl'),
+                        help=("GRF cluster inference with FSL's cluster, or "
+                              "in-process (both tails from one read of the "
+                              "zstat, plus a cluster table)" + defstr))
+    add_hash_argument(parser)
     args = parser.parse_args()
+    from nipype import config
+    config.enable_provenance()
     outdir = args.outdir
     work_dir = os.getcwd()
 
@@ -177,9 +353,25 @@ if __name__ == '__main__':
                                   l1output_dir=l1_outdir,
                                   out_dir=outdir,
                                   dataset_dir=os.path.abspath(args.datasetdir),
-                                  no_reversal=args.norev)
+                                  no_reversal=args.norev,
+                                  engine=args.engine,
+                                  n_workers=args.n_workers,
+                                  cluster_engine=args.cluster_engine,
+                                  store_dir=args.store_dir)
     wf.base_dir = work_dir
-    if args.plugin_args:
-        wf.run(args.plugin, plugin_args=eval(args.plugin_args))
-    else:
-        wf.run(args.plugin)
+    apply_resources(wf, load_resource_config(args.resources))
+    # probe FSL, ANTs and FreeSurfer once for the driver and all nodes
+    tools = ToolEnvironment(os.path.join(work_dir, TOOL_CACHE))
+    tools.probe()
+    tools.attach(wf)
+    hashing = HashPolicy(args.hash_method)
+    hashing.configure(wf)
+    hashing.attach(wf)
+    plugin_args = parse_plugin_args(args.plugin_args)
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler(os.path.join(work_dir, 'profile'), wf.name)
+        profiler.install(plugin_args)
+    execgraph = wf.run(args.plugin, plugin_args=plugin_args)
+    if profiler is not None:
+        profiler.write(execgraph)
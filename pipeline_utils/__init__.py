@@ -0,0 +1,18 @@
+"""
+Helpers shared by the subject level, group level and resting state scripts.
+
+The scripts in this repository are run directly (``python script.py``), so
+each of them puts the repository root on ``sys.path`` before importing from
+this package.  Importing the package also exports the repository root on
+``PYTHONPATH`` so that nipype workers (MultiProc children, SLURM/SGE jobs)
+can import the same helpers when they unpickle a node.
+"""
+
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_pythonpath = [val for val in os.environ.get('PYTHONPATH', '').split(os.pathsep)
+               if val]
+if ROOT_DIR not in _pythonpath:
+    os.environ['PYTHONPATH'] = os.pathsep.join([ROOT_DIR] + _pythonpath)
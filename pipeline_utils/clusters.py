@@ -0,0 +1,252 @@
+"""
+Two-tailed GRF cluster inference of z maps.
+
+Like FSL's ``cluster``, the z map is thresholded, the suprathreshold voxels
+are labelled and clusters are kept when their size is significant under
+Gaussian random field theory, given the smoothness estimated by
+``smoothest`` (``dlh``, the square root of the determinant of the Lambda
+matrix in voxels, and the search ``volume`` in voxels).
+
+Reversed contrasts used to be obtained by negating the z map with fslmaths
+and running ``cluster`` a second time on the new image.
+:func:`two_tailed_clusters` reads the z map once and labels each sign,
+writing the outputs of the negative tail under the names the negated map
+produced::
+
+    zstat1_threshold.nii.gz         zstat1_maths_threshold.nii.gz
+    zstat1_index.nii.gz             zstat1_maths_index.nii.gz
+    zstat1_localmax.txt             zstat1_maths_localmax.txt
+    zstat1_clusters.txt             zstat1_maths_clusters.txt
+
+The outputs follow ``cluster``'s conventions: voxels at or above the
+threshold, cluster indices by increasing size, at most 6 local maxima per
+cluster, FSL voxel coordinates and, in ``*_clusters.txt``, the table
+``cluster`` prints (size, p, -log10(p), z max and its position, z weighted
+centre of gravity).
+"""
+
+import os
+
+import numpy as np
+
+from .tfce import STRUCTURES
+
+N_DIM = 3
+CLUSTER_OUTPUTS = ['threshold_file', 'index_file', 'localmax_txt_file',
+                   'table_file', 'neg_threshold_file', 'neg_index_file',
+                   'neg_localmax_txt_file', 'neg_table_file']
+
+
+def _structure(connectivity):
+    from scipy import ndimage
+    return ndimage.generate_binary_structure(N_DIM, STRUCTURES[connectivity])
+
+
+def grf_pvalues(sizes, dlh, volume, threshold, n_dim=N_DIM):
+    """Return the GRF p value of clusters of sizes voxels above threshold
+
+    With ``Em`` the expected number of clusters and ``P(Z > t)`` the
+    Gaussian tail probability::
+
+        Em = V (2 pi)^-(D+1)/2 dLh (t^2 - 1)^(D-1)/2 exp(-t^2/2)
+        beta = (Gamma(D/2 + 1) Em / (V P(Z > t)))^(2/D)
+        p = 1 - exp(-Em exp(-beta k^(2/D)))
+    """
+    from scipy.special import gamma, ndtr
+    t = float(threshold)
+    em = (volume * (2 * np.pi) ** (-(n_dim + 1) / 2.) * dlh *
+          (t * t - 1) ** ((n_dim - 1) / 2.) * np.exp(-t * t / 2.))
+    beta = (gamma(n_dim / 2. + 1) * em / (volume * ndtr(-t))) ** (2. / n_dim)
+    sizes = np.asarray(sizes, dtype=np.float64)
+    return -np.expm1(-em * np.exp(-beta * sizes ** (2. / n_dim)))
+
+
+def fsl_voxels(coords, affine, shape):
+    """Convert array indices to FSL voxel coordinates
+
+    FSL flips the x axis of images stored in neurological order (positive
+    determinant of the affine).
+    """
+    coords = np.array(coords, dtype=np.float64, ndmin=2)
+    if affine is not None and np.linalg.det(affine[:3, :3]) > 0:
+        coords[:, 0] = shape[0] - 1 - coords[:, 0]
+    return coords
+
+
+def _raster(coords, shape):
+    """Position of voxels in FSL's scanning order (x fastest)"""
+    return np.ravel_multi_index(tuple(np.asarray(coords).T), shape, order='F')
+
+
+def local_maxima(stat, index, n_maxima=6, connectivity=26, affine=None):
+    """Return (cluster index, value, x, y, z) of the local maxima of stat
+
+    A voxel is a local maximum if no neighbour is larger; on plateaus the
+    first voxel in FSL's scanning order wins.  At most n_maxima per
+    cluster, ordered by decreasing cluster index and value, in FSL voxel
+    coordinates.
+    """
+    padded = np.pad(stat, 1, mode='constant', constant_values=-np.inf)
+    peaks = index > 0
+    for offset in np.argwhere(_structure(connectivity)) - 1:
+        if not offset.any():
+            continue
+        shifted = padded[tuple([slice(1 + off, 1 + off + dim)
+                                for off, dim in zip(offset, stat.shape)])]
+        if tuple(offset[::-1]) < (0, 0, 0):
+            # the neighbour comes first in scanning order
+            peaks &= stat > shifted
+        else:
+            peaks &= stat >= shifted
+    coords = np.argwhere(peaks)
+    values = stat[peaks]
+    clusters = index[peaks]
+    order = np.lexsort((_raster(coords, stat.shape), -values, -clusters))
+    xyz = fsl_voxels(coords, affine, stat.shape).astype(int)
+    out = []
+    counts = {}
+    for idx in order:
+        cluster = int(clusters[idx])
+        counts[cluster] = counts.get(cluster, 0) + 1
+        if counts[cluster] > n_maxima:
+            continue
+        out.append((cluster, float(values[idx])) +
+                   tuple([int(val) for val in xyz[idx]]))
+    return out
+
+
+def label_clusters(stat, threshold, connectivity=26):
+    """Label voxels of stat >= threshold numbered in FSL's scanning order"""
+    from scipy import ndimage
+    # labelling the transposed volume scans x fastest
+    labels, n_labels = ndimage.label((stat >= threshold).T,
+                                     _structure(connectivity))
+    return np.ascontiguousarray(labels.T), n_labels
+
+
+def cluster_inference(stat, dlh, volume, threshold=2.3, pthreshold=0.05,
+                      connectivity=26, affine=None):
+    """Return the cluster index map and table of the significant clusters
+
+    As in FSL, clusters are numbered by increasing size (ties in scanning
+    order) so that the largest cluster has the highest index.  Table rows
+    are dicts with the columns of cluster's table, largest cluster first.
+    """
+    from scipy import ndimage
+    labels, n_labels = label_clusters(stat, threshold, connectivity)
+    sizes = np.bincount(labels.ravel(), minlength=n_labels + 1)[1:]
+    pvals = grf_pvalues(sizes, dlh, volume, threshold)
+    keep = np.flatnonzero(pvals < pthreshold)
+    keep = keep[np.argsort(sizes[keep], kind='stable')]
+    relabel = np.zeros(n_labels + 1, dtype=np.int32)
+    relabel[keep + 1] = np.arange(1, len(keep) + 1)
+    index = relabel[labels]
+    table = []
+    if not len(keep):
+        return index, table
+    cluster_ids = np.arange(1, len(keep) + 1)
+    cogs = fsl_voxels(ndimage.center_of_mass(stat, index, cluster_ids),
+                      affine, stat.shape)
+    coords = np.argwhere(index > 0)
+    values = stat[index > 0]
+    clusters = index[index > 0]
+    order = np.lexsort((_raster(coords, stat.shape), -values, clusters))
+    first = order[np.searchsorted(clusters[order], cluster_ids)]
+    peaks = fsl_voxels(coords[first], affine, stat.shape).astype(int)
+    for idx in range(len(keep))[::-1]:
+        label = keep[idx]
+        table.append(dict(index=idx + 1, size=int(sizes[label]),
+                          p=float(pvals[label]), zmax=float(values[first[idx]]),
+                          zmax_xyz=tuple(peaks[idx]), cog_xyz=tuple(cogs[idx])))
+    return index, table
+
+
+def write_localmax(filename, maxima):
+    """Write local maxima in the format of cluster --olmax"""
+    with open(filename, 'wt') as fp:
+        fp.write('Cluster Index\tValue\tx\ty\tz\t\n')
+        for row in maxima:
+            fp.write('%d\t%g\t%d\t%d\t%d\t\n' % row)
+    return filename
+
+
+def write_table(filename, table):
+    """Write the cluster table printed by cluster"""
+    columns = ['Cluster Index', 'Voxels', 'P', '-log10(P)', 'Z-MAX',
+               'Z-MAX X (vox)', 'Z-MAX Y (vox)', 'Z-MAX Z (vox)',
+               'Z-COG X (vox)', 'Z-COG Y (vox)', 'Z-COG Z (vox)']
+    with open(filename, 'wt') as fp:
+        fp.write('\t'.join(columns) + '\n')
+        for row in table:
+            values = ([row['index'], row['size'], '%g' % row['p'],
+                       '%g' % -np.log10(max(row['p'], 1e-300)),
+                       '%g' % row['zmax']] + list(row['zmax_xyz']) +
+                      ['%g' % val for val in row['cog_xyz']])
+            fp.write('\t'.join([str(val) for val in values]) + '\n')
+    return filename
+
+
+def two_tailed_clusters(zstat_file, dlh, volume, threshold=2.3,
+                        pthreshold=0.05, connectivity=26, two_tailed=True,
+                        out_dir=None):
+    """Run cluster inference on both tails of a z map
+
+    Returns a dict with ``threshold_file``, ``index_file``,
+    ``localmax_txt_file`` and ``table_file`` and, when two_tailed, the same
+    keys prefixed with ``neg_``.
+    """
+    import nibabel as nb
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    img = nb.load(zstat_file)
+    zstat = np.asanyarray(img.dataobj).astype(np.float64)
+    name = os.path.basename(zstat_file)
+    for ext in ['.nii.gz', '.nii']:
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+            break
+    base = os.path.join(out_dir, name)
+    tails = [('', '', zstat)]
+    if two_tailed:
+        tails.append(('neg_', '_maths', -zstat))
+    out = {}
+    for key, suffix, stat in tails:
+        index, table = cluster_inference(stat, dlh, volume, threshold,
+                                         pthreshold, connectivity,
+                                         affine=img.affine)
+        prefix = base + suffix
+        thresholded = nb.Nifti1Image(np.where(index > 0, stat, 0).astype(
+            np.float32), img.affine, img.header)
+        thresholded.set_data_dtype(np.float32)
+        thresholded.to_filename(prefix + '_threshold.nii.gz')
+        index_img = nb.Nifti1Image(index, img.affine, img.header)
+        index_img.set_data_dtype(np.int32)
+        index_img.to_filename(prefix + '_index.nii.gz')
+        write_localmax(prefix + '_localmax.txt',
+                       local_maxima(stat, index, connectivity=connectivity,
+                                    affine=img.affine))
+        write_table(prefix + '_clusters.txt', table)
+        out[key + 'threshold_file'] = prefix + '_threshold.nii.gz'
+        out[key + 'index_file'] = prefix + '_index.nii.gz'
+        out[key + 'localmax_txt_file'] = prefix + '_localmax.txt'
+        out[key + 'table_file'] = prefix + '_clusters.txt'
+    return out
+
+
+def cluster_node(zstat_file, dlh, volume, threshold, pthreshold,
+                 connectivity, two_tailed):
+    """nipype Function wrapper of two_tailed_clusters"""
+    from pipeline_utils.clusters import two_tailed_clusters
+    if isinstance(zstat_file, list):
+        # one group t-contrast per flameo; never drop the inference of others
+        if len(zstat_file) != 1:
+            raise ValueError('Expected one zstat, got %d: %s' %
+                             (len(zstat_file), ', '.join(zstat_file)))
+        zstat_file = zstat_file[0]
+    out = two_tailed_clusters(zstat_file, dlh, volume, threshold=threshold,
+                              pthreshold=pthreshold,
+                              connectivity=connectivity,
+                              two_tailed=two_tailed)
+    return (out['threshold_file'], out['index_file'],
+            out['localmax_txt_file'], out['table_file'],
+            out.get('neg_threshold_file'), out.get('neg_index_file'),
+            out.get('neg_localmax_txt_file'), out.get('neg_table_file'))
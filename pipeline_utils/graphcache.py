@@ -0,0 +1,187 @@
+"""
+Cache of expanded execution graphs.
+
+Before the first job is submitted, ``Workflow.run`` flattens the workflow
+and expands the subject, run and plot iterables into one node per
+execution, which for large subject lists takes longer than building the
+workflow itself.  The expanded graph only depends on the code that built
+it, the parameters of the script and the parts of the dataset read while
+building (subject directories, model files), so it is pickled once::
+
+    <cache_dir>/<workflow>_<key>.pklz
+
+where ``key`` is :func:`graph_key` of the script, pipeline_utils and nipype
+sources, the parameters and :func:`dataset_index`.  Any change to one of
+them gives another key, so a stale graph is never loaded.  The directory
+can be removed at any time.
+
+:func:`run_expanded` runs a cached graph the way ``Workflow.run`` runs the
+graph it expands (node configuration, base directory, input sources and
+report), so reruns and resumptions neither build the workflow nor expand
+it.  Nodes still check their own hashes when they run.
+"""
+
+from glob import glob
+import gzip
+import hashlib
+import json
+import os
+import pickle
+import sys
+
+CACHE_DIR = 'graph_cache'
+
+
+def source_files(script):
+    """Return the files whose code defines the graph of script"""
+    utils_dir = os.path.dirname(os.path.abspath(__file__))
+    return [os.path.abspath(script)] + sorted(
+        glob(os.path.join(utils_dir, '*.py')))
+
+
+def dataset_index(data_dir, patterns):
+    """Return the (path, size, mtime) of the dataset entries of patterns
+
+    Directories (e.g. subjects) are only listed by name, since the graph
+    does not depend on their content.
+    """
+    index = []
+    for pattern in patterns:
+        for path in sorted(glob(os.path.join(data_dir, pattern))):
+            relpath = os.path.relpath(path, data_dir)
+            if os.path.isdir(path):
+                index.append([relpath, None, None])
+            else:
+                stat = os.stat(path)
+                index.append([relpath, stat.st_size, stat.st_mtime])
+    return index
+
+
+def graph_key(script, params, dataset=None):
+    """Return the SHA1 of the sources, parameters and dataset index"""
+    import nipype
+    sha1 = hashlib.sha1()
+    for filename in source_files(script):
+        with open(filename, 'rb') as fp:
+            sha1.update(fp.read())
+    sha1.update(json.dumps(dict(params=params, dataset=dataset,
+                                nipype=nipype.__version__,
+                                python=list(sys.version_info[:2])),
+                           sort_keys=True, default=str).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+class GraphCache(object):
+    """Expanded graphs of the workflow name stored in cache_dir"""
+
+    def __init__(self, cache_dir, name, key):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.name = name
+        self.key = key
+        self.filename = os.path.join(self.cache_dir,
+                                     '%s_%s.pklz' % (name, key))
+
+    def load(self):
+        """Return the cached graph, or None if there is none for the key"""
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with gzip.open(self.filename, 'rb') as fp:
+                return pickle.load(fp)
+        except Exception:
+            # unreadable (e.g. truncated or written by another nipype)
+            return None
+
+    def save(self, execgraph):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_file = '%s.%d.tmp' % (self.filename, os.getpid())
+        with gzip.open(tmp_file, 'wb', compresslevel=1) as fp:
+            pickle.dump(execgraph, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.filename)
+        return self.filename
+
+
+def expand_workflow(workflow):
+    """Return the expanded execution graph of workflow
+
+    These are the steps of ``Workflow.run`` that precede the run specific
+    configuration of the nodes.
+    """
+    from copy import deepcopy
+    from nipype import config
+    from nipype.pipeline.engine.utils import (generate_expanded_graph,
+                                              merge_dict)
+    flatgraph = workflow._create_flat_graph()
+    workflow.config = merge_dict(deepcopy(config._sections), workflow.config)
+    workflow._set_needed_outputs(flatgraph)
+    return generate_expanded_graph(deepcopy(flatgraph))
+
+
+def run_expanded(workflow, execgraph, plugin=None, plugin_args=None,
+                 updatehash=False):
+    """Run the expanded graph of workflow like ``Workflow.run``
+
+    Returns the execution graph.
+    """
+    from copy import deepcopy
+    from datetime import datetime
+    from nipype import config
+    from nipype.pipeline import plugins
+    from nipype.pipeline.engine import MapNode
+    from nipype.pipeline.engine.utils import merge_dict, write_workflow_prov
+    from nipype.utils.misc import str2bool
+    if plugin is None:
+        plugin = config.get('execution', 'plugin')
+    if isinstance(plugin, (str, bytes)):
+        runner = getattr(plugins, '%sPlugin' % plugin)(
+            plugin_args=plugin_args)
+    else:
+        runner = plugin
+    workflow.config = merge_dict(deepcopy(config._sections), workflow.config)
+    for index, node in enumerate(execgraph.nodes()):
+        node.config = merge_dict(deepcopy(workflow.config), node.config)
+        node.base_dir = workflow.base_dir
+        node.index = index
+        if isinstance(node, MapNode):
+            node.use_plugin = (plugin, plugin_args)
+    workflow._configure_exec_nodes(execgraph)
+    if str2bool(workflow.config['execution']['create_report']):
+        workflow._write_report_info(workflow.base_dir, workflow.name,
+                                    execgraph)
+    runner.run(execgraph, updatehash=updatehash, config=workflow.config)
+    if str2bool(workflow.config['execution']['write_provenance']):
+        datestr = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        write_workflow_prov(execgraph, os.path.join(
+            workflow.base_dir, 'workflow_provenance_%s' % datestr),
+            format='all')
+    if getattr(config, 'resource_monitor', False):
+        # as Workflow.run of nipype >= 1.0, which has a resource monitor
+        from nipype.pipeline.engine.utils import write_workflow_resources
+        write_workflow_resources(execgraph, filename=os.path.join(
+            workflow.base_dir or os.getcwd(), workflow.name,
+            'resource_monitor.json'))
+    return execgraph
+
+
+def cached_graph(build, configure, script, params, dataset, cache_dir,
+                 name):
+    """Return (workflow, execution graph, whether it was cached)
+
+    build() returns the workflow and is only called when the cache has no
+    graph for the key.  configure(workflow) sets the config and base_dir of
+    the built workflow or, for a cached graph, of an empty workflow of the
+    same name; params must cover everything build and configure depend on.
+    """
+    from nipype import Workflow
+    cache = GraphCache(cache_dir, name, graph_key(script, params, dataset))
+    execgraph = cache.load()
+    if execgraph is not None:
+        workflow = Workflow(name=name)
+        configure(workflow)
+        return workflow, execgraph, True
+    workflow = build()
+    configure(workflow)
+    execgraph = expand_workflow(workflow)
+    cache.save(execgraph)
+    return workflow, execgraph, False
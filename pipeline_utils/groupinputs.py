@@ -0,0 +1,160 @@
+"""
+Subject maps of a group analysis stacked once per task.
+
+The group workflows merged the subject copes and varcopes with
+``fslmerge -t`` for every first level contrast (and, in the regression
+script, again for every group contrast), writing compressed 4D images on
+the full MNI grid that were read once by FLAMEO.
+:func:`build_group_inputs` reads every subject image once and writes, per
+kind, one uncompressed float32 array of the voxels in the brain mask::
+
+    <out_dir>/copes.npy           [contrast x subject x voxel in mask]
+    <out_dir>/varcopes.npy
+    <out_dir>/group_inputs.json   cope ids, subjects, mask, source SHA1s
+
+The arrays are memory mapped by the in-process engines of
+:mod:`pipeline_utils.groupstats`, and the 4D images FLAMEO needs are
+written from them, uncompressed, the first time a contrast asks for one
+(:meth:`GroupInputs.merged_file`).  A build whose sources (the SHA1s of the
+first level index), subjects, contrasts and mask did not change reuses the
+existing arrays.
+"""
+
+import json
+import os
+from glob import glob
+
+import numpy as np
+
+from .groupstats import load_mask, masked_data
+from .l1index import file_hash
+
+SIDECAR = 'group_inputs.json'
+KINDS = ['copes', 'varcopes']
+
+
+class GroupInputs(object):
+    """Stacked group inputs described by the sidecar filename"""
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.out_dir = os.path.dirname(self.filename)
+        with open(self.filename, 'rt') as fp:
+            self.meta = json.load(fp)
+        self.cope_ids = self.meta['cope_ids']
+        self.subjects = self.meta['subjects']
+        self.kinds = self.meta['kinds']
+        self.mask_file = self.meta['mask_file']
+        self._arrays = {}
+
+    def array(self, kind):
+        """Memory mapped [contrast x subject x voxel] array of kind"""
+        if kind not in self.kinds:
+            raise ValueError('%s were not stacked in %s' % (kind,
+                                                            self.out_dir))
+        if kind not in self._arrays:
+            self._arrays[kind] = np.load(
+                os.path.join(self.out_dir, '%s.npy' % kind), mmap_mode='r')
+        return self._arrays[kind]
+
+    def data(self, kind, cope_id):
+        """[subject x voxel] array of cope_id"""
+        return self.array(kind)[self.cope_ids.index(int(cope_id))]
+
+    def merged_file(self, kind, cope_id):
+        """4D image of cope_id on the mask grid, written on first use"""
+        import nibabel as nb
+        filename = os.path.join(self.out_dir, '%s%02d_merged.nii' %
+                                (kind[:-1], int(cope_id)))
+        if os.path.exists(filename):
+            return filename
+        mask_img, mask_idx = load_mask(self.mask_file)
+        shape = tuple(mask_img.shape[:3])
+        data = self.data(kind, cope_id)
+        out = np.zeros((int(np.prod(shape)), data.shape[0]),
+                       dtype=np.float32)
+        out[mask_idx] = data.T
+        img = nb.Nifti1Image(out.reshape(shape + (data.shape[0],)),
+                             mask_img.affine)
+        img.set_data_dtype(np.float32)
+        # concurrent contrasts may ask for the same image
+        tmp_file = '%s.%d.tmp.nii' % (filename[:-4], os.getpid())
+        img.to_filename(tmp_file)
+        os.rename(tmp_file, filename)
+        return filename
+
+
+def build_group_inputs(index, cope_ids, mask_file, out_dir, subjects=None,
+                       kinds=KINDS):
+    """Stack the masked subject maps of cope_ids from an L1Index
+
+    subjects gives the order of the subject axis (all indexed subjects if
+    None).  Returns a :class:`GroupInputs`.
+    """
+    out_dir = os.path.abspath(out_dir)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    subjects = index.subjects if subjects is None else list(subjects)
+    cope_ids = [int(cope_id) for cope_id in cope_ids]
+    mask_img, mask_idx = load_mask(mask_file)
+    sources = {}
+    for kind in kinds:
+        sources[kind] = [[index.record(subject, kind, cope_id)['sha1']
+                          for subject in subjects] for cope_id in cope_ids]
+    meta = dict(cope_ids=cope_ids, subjects=subjects, kinds=list(kinds),
+                mask_file=os.path.abspath(mask_file),
+                mask_sha1=file_hash(mask_file), n_voxels=len(mask_idx),
+                sources=sources)
+    sidecar = os.path.join(out_dir, SIDECAR)
+    if os.path.exists(sidecar):
+        with open(sidecar, 'rt') as fp:
+            if json.load(fp) == meta:
+                return GroupInputs(sidecar)
+        os.remove(sidecar)
+    for filename in glob(os.path.join(out_dir, '*_merged.nii')):
+        os.remove(filename)
+    for kind in kinds:
+        tmp_file = os.path.join(out_dir, '%s.%d.tmp.npy' % (kind, os.getpid()))
+        data = np.lib.format.open_memmap(
+            tmp_file, mode='w+', dtype=np.float32,
+            shape=(len(cope_ids), len(subjects), len(mask_idx)))
+        for idx, cope_id in enumerate(cope_ids):
+            data[idx] = masked_data(index.files(kind, cope_id, subjects),
+                                    mask_idx, shape=mask_img.shape,
+                                    dtype=np.float32)
+        data.flush()
+        del data
+        os.rename(tmp_file, os.path.join(out_dir, '%s.npy' % kind))
+    with open(sidecar, 'wt') as fp:
+        json.dump(meta, fp, indent=1, sort_keys=True)
+    return GroupInputs(sidecar)
+
+
+def group_inputs_node(index_file, cope_ids, mask_file, subjects, kinds):
+    """nipype Function stacking the group inputs in the node directory
+
+    subjects gives the order of the subject axis (all indexed subjects if
+    empty).
+    """
+    import os
+    from pipeline_utils.groupinputs import build_group_inputs
+    from pipeline_utils.l1index import L1Index
+    inputs = build_group_inputs(L1Index.load(index_file), cope_ids,
+                                mask_file, os.getcwd(),
+                                list(subjects) or None, kinds)
+    return inputs.filename
+
+
+def merged_node(inputs_file, cope_id):
+    """nipype Function returning the 4D cope/varcope images of cope_id
+
+    Returns (cope_file, varcope_file, number of subjects); varcope_file is
+    None when the varcopes were not stacked.
+    """
+    from pipeline_utils.groupinputs import GroupInputs
+    inputs = GroupInputs(inputs_file)
+    varcope_file = None
+    if 'varcopes' in inputs.kinds:
+        varcope_file = inputs.merged_file('varcopes', cope_id)
+    return (inputs.merged_file('copes', cope_id), varcope_file,
+            len(inputs.subjects))
@@ -0,0 +1,487 @@
+"""
+In-process group level statistics.
+
+The FLAMEO path of the group scripts merges every subject's cope and varcope
+into 4D files and runs FLAMEO once per contrast.  For ordinary least
+squares and simple mixed effects one-sample tests the same maps can be
+computed directly from the per-subject images: the masked voxels of every
+subject are read once (memory mapped where the files are uncompressed) and
+all contrasts are estimated in vectorized blocks of voxels.
+
+``ols``
+    t test of the subject copes (FLAMEO ``ols``)
+``wls``
+    mixed effects weighted least squares: the between subject variance is
+    estimated per voxel with the DerSimonian-Laird estimator and subjects
+    are weighted by ``1 / (varcope + tau^2)``.  This approximates FLAME1
+    without its iterative refinement.
+
+The same applies to the multiple regression designs of the group scripts:
+:func:`run_regression` loads the subject maps of a first level contrast
+once and fits all group designs to them in one batched pass.
+
+When FLAME1 itself is needed, :func:`run_flameo_batch` keeps FLAMEO but
+shares the design across contrasts, stacks the subject maps in-process and
+runs the contrasts in parallel.
+
+Output maps are named like FLAMEO's (``cope1``, ``varcope1``, ``tstat1``,
+``zstat1``) so that smoothness estimation, clustering and the DataSink
+layout stay the same.
+"""
+
+import os
+
+import numpy as np
+
+BLOCK_SIZE = 20000
+METHODS = ['ols', 'wls']
+
+
+def load_mask(mask_file):
+    """Return the mask image and the flat indices of its nonzero voxels"""
+    import nibabel as nb
+    img = nb.load(mask_file)
+    mask = np.asanyarray(img.dataobj) > 0
+    return img, np.flatnonzero(mask.ravel())
+
+
+def masked_data(files, mask_idx, shape=None, dtype=np.float64):
+    """Return a [file x voxel] array of the masked voxels of files
+
+    The files are read one at a time through nibabel's memory map (for
+    uncompressed images), so no merged 4D image is ever created.  Compact
+    ``.mvec.npz`` maps (:mod:`pipeline_utils.maskstore`) are read without
+    rebuilding their volume.  files may
+    also be a [file x voxel] array already stacked by
+    :mod:`pipeline_utils.groupinputs`.
+    """
+    import nibabel as nb
+    from .maskstore import is_compact, masked_values
+    if isinstance(files, np.ndarray):
+        if files.ndim != 2 or files.shape[1] != len(mask_idx):
+            raise ValueError('Stacked inputs of shape %s do not match a mask '
+                             'of %d voxels' % (files.shape, len(mask_idx)))
+        return np.asarray(files, dtype=dtype)
+    out = np.empty((len(files), len(mask_idx)), dtype=dtype)
+    for idx, filename in enumerate(files):
+        if is_compact(filename):
+            out[idx] = masked_values(filename, mask_idx, shape)
+            continue
+        img = nb.load(filename, mmap=True)
+        if shape is not None and tuple(img.shape[:3]) != tuple(shape[:3]):
+            raise ValueError('%s has shape %s, expected %s' %
+                             (filename, img.shape, shape))
+        data = np.asanyarray(img.dataobj)
+        out[idx] = data.reshape(-1)[mask_idx]
+    return out
+
+
+def t_to_z(tstat, dof):
+    """Convert t statistics to z statistics with the same tail probability"""
+    from scipy import stats
+    from scipy.special import ndtri_exp
+    tstat = np.asarray(tstat, dtype=np.float64)
+    logp = stats.t.logsf(np.abs(tstat), dof)
+    return np.sign(tstat) * -ndtri_exp(logp)
+
+
+def onesample_block(copes, varcopes=None, method='ols'):
+    """One-sample test of a [subject x voxel] block
+
+    Returns a dictionary with the group cope, varcope, tstat and zstat of
+    every voxel, and the degrees of freedom.
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown method %s, use one of %s' % (method, METHODS))
+    n_subj = copes.shape[0]
+    if n_subj < 2:
+        raise ValueError('A one-sample test needs at least two subjects')
+    dof = n_subj - 1
+    if method == 'ols' or varcopes is None:
+        beta = copes.mean(axis=0)
+        variance = copes.var(axis=0, ddof=1) / n_subj
+    else:
+        weights = 1. / np.maximum(varcopes, np.finfo(np.float32).tiny)
+        sum_w = weights.sum(axis=0)
+        fixed = (weights * copes).sum(axis=0) / sum_w
+        q_stat = (weights * (copes - fixed) ** 2).sum(axis=0)
+        scale = sum_w - (weights ** 2).sum(axis=0) / sum_w
+        tau2 = np.maximum(0., (q_stat - dof) / np.maximum(scale, 1e-12))
+        weights = 1. / (np.maximum(varcopes, 0) + tau2)
+        weights[~np.isfinite(weights)] = 0.
+        sum_w = weights.sum(axis=0)
+        beta = (weights * copes).sum(axis=0) / np.maximum(sum_w, 1e-12)
+        variance = 1. / np.maximum(sum_w, 1e-12)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tstat = np.where(variance > 0, beta / np.sqrt(variance), 0.)
+    zstat = t_to_z(tstat, dof)
+    return dict(cope=beta, varcope=variance, tstat=tstat, zstat=zstat,
+                dof=dof)
+
+
+def onesample(copes, varcopes=None, method='ols', block_size=BLOCK_SIZE):
+    """One-sample test of [subject x voxel] arrays in blocks of voxels"""
+    n_vox = copes.shape[1]
+    out = dict([(key, np.zeros(n_vox)) for key in
+                ['cope', 'varcope', 'tstat', 'zstat']])
+    dof = None
+    for start in range(0, n_vox, block_size):
+        block = slice(start, start + block_size)
+        res = onesample_block(copes[:, block],
+                              None if varcopes is None else varcopes[:, block],
+                              method=method)
+        for key in out:
+            out[key][block] = res[key]
+        dof = res['dof']
+    out['dof'] = dof
+    return out
+
+
+def save_masked(values, mask_img, mask_idx, filename):
+    """Write masked voxel values to an image in the space of mask_img"""
+    import nibabel as nb
+    data = np.zeros(int(np.prod(mask_img.shape[:3])), dtype=np.float32)
+    data[mask_idx] = values
+    img = nb.Nifti1Image(data.reshape(mask_img.shape[:3]), mask_img.affine,
+                         mask_img.header)
+    img.set_data_dtype(np.float32)
+    img.to_filename(filename)
+    return filename
+
+
+def run_onesample(cope_files, varcope_files, mask_file, method='ols',
+                  out_dir=None, subdirs=None):
+    """Estimate one-sample tests for several contrasts in one pass
+
+    Parameters
+    ----------
+    cope_files, varcope_files : list of lists of str
+        Per contrast, the subject cope/varcope images (varcopes are only
+        read for ``wls``) or their stacked [subject x voxel] arrays
+    mask_file : str
+        Analysis mask, which also defines the output space
+    out_dir : str
+        Output directory (defaults to cwd)
+    subdirs : list of str
+        Per contrast output subdirectory (defaults to ``contrast_<n>``)
+
+    Returns
+    -------
+    dictionary mapping ``copes``, ``varcopes``, ``tstats``, ``zstats`` and
+    ``dof`` to one output per contrast
+    """
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    mask_img, mask_idx = load_mask(mask_file)
+    if subdirs is None:
+        subdirs = ['contrast_%d' % (idx + 1) for idx in range(len(cope_files))]
+    outputs = dict(copes=[], varcopes=[], tstats=[], zstats=[], dof=[])
+    for idx, files in enumerate(cope_files):
+        copes = masked_data(files, mask_idx, shape=mask_img.shape)
+        varcopes = None
+        if method == 'wls':
+            if len(varcope_files[idx]) != len(files):
+                raise ValueError('Contrast %d has %d copes but %d varcopes' %
+                                 (idx + 1, len(files),
+                                  len(varcope_files[idx])))
+            varcopes = masked_data(varcope_files[idx], mask_idx,
+                                   shape=mask_img.shape)
+        res = onesample(copes, varcopes, method=method)
+        contrast_dir = os.path.join(out_dir, subdirs[idx])
+        if not os.path.exists(contrast_dir):
+            os.makedirs(contrast_dir)
+        for key, name in [('cope', 'copes'), ('varcope', 'varcopes'),
+                          ('tstat', 'tstats'), ('zstat', 'zstats')]:
+            outputs[name].append(save_masked(
+                res[key], mask_img, mask_idx,
+                os.path.join(contrast_dir, '%s1.nii.gz' % key)))
+        outputs['dof'].append(res['dof'])
+    return outputs
+
+
+def write_onesample_design(n_copes, out_dir):
+    """Write the design.mat/.con/.grp files of fsl.L2Model for n_copes"""
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    ones = ['1'] * n_copes
+    txt = {
+        'design.mat': ['/NumWaves   1', '/NumPoints  %d' % n_copes,
+                       '/PPheights  1', '', '/Matrix'] + ones,
+        'design.con': ['/ContrastName1   group mean', '/NumWaves   1',
+                       '/NumContrasts   1', '/PPheights   1',
+                       '/RequiredEffect     100', '', '/Matrix', '1'],
+        'design.grp': ['/NumWaves   1', '/NumPoints  %d' % n_copes, '',
+                       '/Matrix'] + ones}
+    out = {}
+    for name, lines in txt.items():
+        out[name] = os.path.join(out_dir, name)
+        with open(out[name], 'wt') as fp:
+            fp.write('\n'.join(lines) + '\n')
+    return out
+
+
+def merge_images(files, out_file):
+    """Stack 3D images into a 4D image (fslmerge -t) in one pass"""
+    import nibabel as nb
+    ref = nb.load(files[0])
+    data = np.empty(tuple(ref.shape[:3]) + (len(files),), dtype=np.float32)
+    for idx, filename in enumerate(files):
+        img = nb.load(filename, mmap=True)
+        if tuple(img.shape[:3]) != tuple(ref.shape[:3]):
+            raise ValueError('%s has shape %s, expected %s' %
+                             (filename, img.shape, ref.shape))
+        data[..., idx] = np.asanyarray(img.dataobj).reshape(ref.shape[:3])
+    img = nb.Nifti1Image(data, ref.affine, ref.header)
+    img.set_data_dtype(np.float32)
+    img.to_filename(out_file)
+    return out_file
+
+
+def _run_flameo(job):
+    import shutil
+    from subprocess import call
+    contrast_dir, cmdline = job
+    log_dir = os.path.join(contrast_dir, 'stats')
+    if os.path.exists(log_dir):
+        # flameo writes to stats+ if stats exists
+        shutil.rmtree(log_dir)
+    with open(os.path.join(contrast_dir, 'flameo.log'), 'wt') as log:
+        returncode = call(cmdline, shell=True, cwd=contrast_dir, stdout=log,
+                          stderr=log)
+    if returncode:
+        raise RuntimeError('flameo failed in %s, see flameo.log' %
+                           contrast_dir)
+    return log_dir
+
+
+def run_flameo_batch(cope_files, varcope_files, mask_file, run_mode='flame1',
+                     n_workers=None, out_dir=None, subdirs=None):
+    """Run FLAMEO one-sample tests of several contrasts in parallel
+
+    The one-sample design is written once per number of subjects, the
+    subject maps of each contrast are stacked in-process instead of through
+    fslmerge, and the FLAMEO processes are dispatched to a pool of
+    ``n_workers`` threads (None: number of CPUs of the machine;
+    group_onesample_bids.py passes ``--n_workers``, 4 by default, the cpus
+    its resources.json requests for the engine node).  A contrast given as a
+    4D image (e.g. :meth:`pipeline_utils.groupinputs.GroupInputs.merged_file`)
+    instead of a list of subject images is used as is.
+
+    Returns a dictionary like :func:`run_onesample`.
+    """
+    from glob import glob
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+    import nibabel as nb
+    from nipype.interfaces.fsl import FLAMEO
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    if subdirs is None:
+        subdirs = ['contrast_%d' % (idx + 1) for idx in range(len(cope_files))]
+    merged = []
+    merges = []
+    for idx, subdir in enumerate(subdirs):
+        contrast_dir = os.path.join(out_dir, subdir)
+        if not os.path.exists(contrast_dir):
+            os.makedirs(contrast_dir)
+        paths = []
+        for files, name in [(cope_files[idx], 'cope_merged.nii'),
+                            (varcope_files[idx], 'varcope_merged.nii')]:
+            if isinstance(files, (list, tuple)):
+                paths.append(os.path.join(contrast_dir, name))
+                merges.append((files, paths[-1]))
+            else:
+                paths.append(files)
+        if isinstance(cope_files[idx], (list, tuple)):
+            n_copes = len(cope_files[idx])
+        else:
+            n_copes = nb.load(cope_files[idx]).shape[3]
+        if isinstance(varcope_files[idx], (list, tuple)) and \
+                len(varcope_files[idx]) != n_copes:
+            raise ValueError('Contrast %d has %d copes but %d varcopes' %
+                             (idx + 1, n_copes, len(varcope_files[idx])))
+        merged.append(paths + [n_copes])
+    pool = ThreadPool(n_workers or cpu_count())
+    try:
+        pool.map(lambda args: merge_images(*args), merges)
+        designs = {}
+        jobs = []
+        for idx, subdir in enumerate(subdirs):
+            cope_file, varcope_file, n_copes = merged[idx]
+            if n_copes not in designs:
+                designs[n_copes] = write_onesample_design(
+                    n_copes, os.path.join(out_dir, 'design_%d' % n_copes))
+            design = designs[n_copes]
+            contrast_dir = os.path.join(out_dir, subdir)
+            flame = FLAMEO(cope_file=cope_file, var_cope_file=varcope_file,
+                           design_file=design['design.mat'],
+                           t_con_file=design['design.con'],
+                           cov_split_file=design['design.grp'],
+                           mask_file=mask_file, run_mode=run_mode)
+            jobs.append((contrast_dir, flame.cmdline))
+        log_dirs = pool.map(_run_flameo, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    outputs = dict(copes=[], varcopes=[], tstats=[], zstats=[], dof=[])
+    for log_dir in log_dirs:
+        for key, name in [('cope', 'copes'), ('varcope', 'varcopes'),
+                          ('tstat', 'tstats'), ('zstat', 'zstats')]:
+            outputs[name].append(sorted(glob(os.path.join(
+                log_dir, '%s[0-9]*.nii*' % key)))[0])
+        outputs['dof'].append(sorted(glob(os.path.join(log_dir,
+                                                       'tdof_t1.nii*')))[0])
+    return outputs
+
+
+def regression_design(regressors, contrasts):
+    """Return the design matrix and contrast matrix of MultipleRegressDesign
+
+    Columns follow the sorted regressor names like fsl.MultipleRegressDesign;
+    ``contrasts`` are its ``(name, 'T', regressor_names, weights)`` tuples.
+    """
+    names = sorted(regressors.keys())
+    design = np.column_stack([np.asarray(regressors[name], dtype=np.float64)
+                              for name in names])
+    con = np.zeros((len(contrasts), len(names)))
+    for row, contrast in enumerate(contrasts):
+        if contrast[1] != 'T':
+            raise ValueError('Only T contrasts are supported: %s' %
+                             contrast[0])
+        for col, name in enumerate(names):
+            if name in contrast[2]:
+                con[row, col] = contrast[3][contrast[2].index(name)]
+    return design, con
+
+
+def regression_block(data, designs, varcopes=None, method='ols'):
+    """Fit several designs to a [subject x voxel] block in one pass
+
+    Parameters
+    ----------
+    data : array [subject x voxel]
+    designs : list of (design, contrasts) arrays
+    varcopes : array [subject x voxel], required for ``wls``
+
+    Returns one dictionary per design with [contrast x voxel] ``cope``,
+    ``varcope``, ``tstat`` and ``zstat`` arrays and the degrees of freedom.
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown method %s, use one of %s' % (method, METHODS))
+    n_subj = data.shape[0]
+    # the pseudo-inverses of all designs are stacked, so that the OLS
+    # parameters of every design come out of a single matrix product
+    pinvs = [np.linalg.pinv(design) for design, _ in designs]
+    betas = np.dot(np.vstack(pinvs), data)
+    results = []
+    row = 0
+    for (design, con), pinv in zip(designs, pinvs):
+        n_reg = design.shape[1]
+        dof = n_subj - np.linalg.matrix_rank(design)
+        if dof < 1:
+            raise ValueError('Design with %d regressors needs more than %d '
+                             'subjects' % (n_reg, n_subj))
+        beta = betas[row:row + n_reg]
+        row += n_reg
+        resid = data - np.dot(design, beta)
+        sigma2 = (resid ** 2).sum(axis=0) / dof
+        if method == 'ols':
+            cope = np.dot(con, beta)
+            unscaled = np.einsum('kp,pq,kq->k', con, np.dot(pinv, pinv.T), con)
+            variance = unscaled[:, None] * sigma2[None, :]
+        else:
+            # method of moments between subject variance, then a weighted
+            # fit per voxel
+            tau2 = np.maximum(0., sigma2 - varcopes.mean(axis=0))
+            weights = 1. / np.maximum(varcopes + tau2,
+                                      np.finfo(np.float32).tiny)
+            xtwx = np.einsum('ip,iv,iq->vpq', design, weights, design)
+            xtwy = np.einsum('ip,iv,iv->vp', design, weights, data)
+            inv = np.linalg.pinv(xtwx)
+            wbeta = np.einsum('vpq,vq->pv', inv, xtwy)
+            cope = np.dot(con, wbeta)
+            variance = np.einsum('kp,vpq,kq->kv', con, inv, con)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tstat = np.where(variance > 0, cope / np.sqrt(variance), 0.)
+        results.append(dict(cope=cope, varcope=variance, tstat=tstat,
+                            zstat=t_to_z(tstat, dof), dof=dof))
+    return results
+
+
+def run_regression(cope_files, varcope_files, designs, mask_file,
+                   method='ols', out_dir=None, design_dirs=None,
+                   cope_dirs=None, block_size=BLOCK_SIZE):
+    """Fit group regressions for several first level contrasts
+
+    Parameters
+    ----------
+    cope_files, varcope_files : list of lists of str
+        Per first level contrast, the subject images in design row order
+    designs : list of (design, contrasts) arrays
+        Group designs, e.g. from :func:`regression_design`
+    design_dirs, cope_dirs : list of str
+        Output subdirectories per design and per first level contrast
+
+    Returns
+    -------
+    dictionary mapping ``copes``, ``varcopes``, ``tstats``, ``zstats`` and
+    ``pvals`` to [design][first level contrast] outputs: one image per
+    contrast of the design (a single path for single contrast designs).
+    The maps are named like FLAMEO's (``zstat1``...) and ``zstat1_pval``
+    holds the upper tail p values like ``fslmaths -ztop``.
+    """
+    from scipy import stats
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    mask_img, mask_idx = load_mask(mask_file)
+    designs = [(np.asarray(design, dtype=np.float64),
+                np.atleast_2d(np.asarray(con, dtype=np.float64)))
+               for design, con in designs]
+    if design_dirs is None:
+        design_dirs = ['design_%d' % (idx + 1) for idx in range(len(designs))]
+    if cope_dirs is None:
+        cope_dirs = ['contrast_%d' % (idx + 1)
+                     for idx in range(len(cope_files))]
+    keys = [('cope', 'copes'), ('varcope', 'varcopes'), ('tstat', 'tstats'),
+            ('zstat', 'zstats')]
+    outputs = dict([(name, [[] for _ in designs])
+                    for name in ['copes', 'varcopes', 'tstats', 'zstats',
+                                 'pvals']])
+    n_vox = len(mask_idx)
+    for cope_idx, files in enumerate(cope_files):
+        for design, _ in designs:
+            if design.shape[0] != len(files):
+                raise ValueError('Design has %d rows but contrast %d has %d '
+                                 'subjects' % (design.shape[0], cope_idx + 1,
+                                               len(files)))
+        data = masked_data(files, mask_idx, shape=mask_img.shape)
+        varcopes = None
+        if method == 'wls':
+            varcopes = masked_data(varcope_files[cope_idx], mask_idx,
+                                   shape=mask_img.shape)
+        maps = [dict([(key, np.zeros((con.shape[0], n_vox)))
+                      for key, _ in keys]) for _, con in designs]
+        for start in range(0, n_vox, block_size):
+            block = slice(start, start + block_size)
+            results = regression_block(
+                data[:, block], designs,
+                None if varcopes is None else varcopes[:, block],
+                method=method)
+            for res, out in zip(results, maps):
+                for key, _ in keys:
+                    out[key][:, block] = res[key]
+        for design_idx, out in enumerate(maps):
+            target = os.path.join(out_dir, design_dirs[design_idx],
+                                  cope_dirs[cope_idx])
+            if not os.path.exists(target):
+                os.makedirs(target)
+            out['pval'] = stats.norm.sf(out['zstat'])
+            for key, name in keys + [('pval', 'pvals')]:
+                files_out = []
+                for con_idx in range(out[key].shape[0]):
+                    filename = '%s%d.nii.gz' % (key, con_idx + 1)
+                    if key == 'pval':
+                        filename = 'zstat%d_pval.nii.gz' % (con_idx + 1)
+                    files_out.append(save_masked(
+                        out[key][con_idx], mask_img, mask_idx,
+                        os.path.join(target, filename)))
+                outputs[name][design_idx].append(
+                    files_out[0] if len(files_out) == 1 else files_out)
+    return outputs
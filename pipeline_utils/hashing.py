@@ -0,0 +1,198 @@
+"""
+Hashing policy of the input files of the nodes.
+
+nipype hashes the input files of a node to decide whether its cached
+results are still valid, either from their content (``hash_method =
+content``, which reads every multi-GB 4D run on each check) or from their
+mtime and size (``timestamp``).  The scripts choose a policy with
+``--hash_method``:
+
+``content``, ``timestamp`` (default)
+    nipype's own methods; ``timestamp`` only stats the files.
+``fingerprint``
+    size, mtime and inode: a file replaced by a copy (e.g. written to a
+    temporary file and renamed) changes even if size and mtime match.
+``sampled``
+    ``fingerprint`` plus, for images of at least ``SAMPLE_THRESHOLD``
+    bytes, the SHA1 of their first block (the header), ``N_BLOCKS`` blocks
+    evenly strided through the file and their last block, which for
+    ``.nii.gz`` holds the CRC32 of the whole uncompressed image.  This
+    catches rewrites keeping size and mtime, at the cost of 18 reads per
+    large image on every cache check.
+
+The last two run as nipype's ``timestamp`` method with its file hash
+replaced by :func:`fingerprint`.  The hash is computed by the driver when
+it checks the cache of a node and by the worker running it, so the policy
+is attached to every node (:meth:`HashPolicy.attach`) and installs itself
+when a worker unpickles one, like ``toolcache.ToolEnvironment``.
+
+Large intermediates collected by ``workgc`` are replaced by a small JSON
+stub recording both fingerprints of the original file (:func:`write_stub`),
+which :func:`fingerprint` returns for the stub, so the nodes that consumed
+the file stay cached.
+"""
+
+from functools import partial
+import hashlib
+import json
+import os
+
+HASH_METHODS = ['content', 'timestamp', 'fingerprint', 'sampled']
+IMAGE_EXTENSIONS = ('.nii', '.nii.gz', '.img', '.hdr', '.mgz', '.mgh')
+SAMPLE_THRESHOLD = 64 * 1024 ** 2
+BLOCK_SIZE = 64 * 1024
+N_BLOCKS = 16
+# nipype modules calling hash_timestamp (nipype >= 1.0 and older)
+HASH_MODULES = ['nipype.utils.filemanip', 'nipype.interfaces.base.specs',
+                'nipype.interfaces.base']
+# collected files are stubs of at most STUB_MAX_SIZE bytes
+STUB_PREFIX = b'{"collected": '
+STUB_MAX_SIZE = 4096
+# hash method installed in this process, nipype's hash_timestamp functions
+_INSTALLED = [None]
+_ORIGINALS = {}
+
+
+def add_hash_argument(parser):
+    """Add the --hash_method option to an argument parser"""
+    parser.add_argument("--hash_method", dest="hash_method",
+                        default='timestamp', choices=HASH_METHODS,
+                        help=("How nodes hash their input files: nipype's "
+                              "content or timestamp (default), size/mtime/"
+                              "inode (fingerprint), or fingerprint plus the "
+                              "header and strided blocks of large images "
+                              "(sampled)"))
+
+
+def is_image(filename):
+    return filename.endswith(IMAGE_EXTENSIONS)
+
+
+def sampled_digest(filename, size=None, block_size=BLOCK_SIZE,
+                   n_blocks=N_BLOCKS):
+    """Return the SHA1 of the first, last and n_blocks strided blocks"""
+    if size is None:
+        size = os.path.getsize(filename)
+    offsets = [0]
+    if size > block_size:
+        stride = (size - block_size) // (n_blocks + 1)
+        offsets += [stride * (i + 1) for i in range(n_blocks)]
+        offsets.append(size - block_size)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for offset in offsets:
+            fp.seek(offset)
+            sha1.update(fp.read(block_size))
+    return sha1.hexdigest()
+
+
+def fingerprint(afile, sample=False, threshold=SAMPLE_THRESHOLD):
+    """Return the MD5 of size, mtime and inode of afile (None if it is not
+    a file), with the sampled digest of images of at least threshold bytes
+    if sample"""
+    if not os.path.isfile(afile):
+        return None
+    stat = os.stat(afile)
+    stub = read_stub(afile, stat.st_size)
+    if stub is not None:
+        return stub['sampled' if sample else 'fingerprint']
+    values = [stat.st_size, stat.st_mtime, stat.st_ino]
+    if sample and stat.st_size >= threshold and is_image(afile):
+        values.append(sampled_digest(afile, stat.st_size))
+    return hashlib.md5(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def read_stub(afile, size=None):
+    """Return the record of a collected file, or None if afile is not a
+    stub"""
+    if size is None:
+        size = os.path.getsize(afile)
+    if size >= STUB_MAX_SIZE or not is_image(afile):
+        return None
+    with open(afile, 'rb') as fp:
+        content = fp.read()
+    if not content.startswith(STUB_PREFIX):
+        return None
+    try:
+        return json.loads(content.decode('utf-8'))['collected']
+    except (ValueError, KeyError):
+        return None
+
+
+def write_stub(afile):
+    """Replace afile by a stub recording its fingerprints
+
+    The stub is a new file, so hard links to afile (e.g. made by a sink)
+    keep the data.  Returns the number of bytes freed.
+    """
+    stat = os.stat(afile)
+    if read_stub(afile, stat.st_size) is not None:
+        return 0
+    record = dict(fingerprint=fingerprint(afile),
+                  sampled=fingerprint(afile, sample=True),
+                  size=stat.st_size)
+    tmp_file = '%s.%d.tmp' % (afile, os.getpid())
+    with open(tmp_file, 'wb') as fp:
+        fp.write(json.dumps(dict(collected=record),
+                            sort_keys=True).encode('utf-8'))
+    os.rename(tmp_file, afile)
+    return stat.st_size
+
+
+def _patch_hash_timestamp(function=None):
+    """Replace nipype's hash_timestamp by function (restore it if None)"""
+    import importlib
+    for name in HASH_MODULES:
+        try:
+            module = importlib.import_module(name)
+        except ImportError:
+            continue
+        if hasattr(module, 'hash_timestamp'):
+            original = _ORIGINALS.setdefault(name, module.hash_timestamp)
+            module.hash_timestamp = original if function is None else function
+
+
+class HashPolicy(object):
+    """Hash method of HASH_METHODS used by the nodes of a workflow"""
+
+    def __init__(self, method='timestamp'):
+        if method not in HASH_METHODS:
+            raise ValueError('Unknown hash method %s (one of %s)' %
+                             (method, ', '.join(HASH_METHODS)))
+        self.method = method
+
+    @property
+    def nipype_method(self):
+        return 'content' if self.method == 'content' else 'timestamp'
+
+    def install(self):
+        """Make nipype hash files with this policy in this process"""
+        if _INSTALLED[0] == self.method:
+            return
+        if self.method in ('fingerprint', 'sampled'):
+            _patch_hash_timestamp(partial(fingerprint,
+                                          sample=self.method == 'sampled'))
+        elif _INSTALLED[0] is not None:
+            _patch_hash_timestamp()
+        _INSTALLED[0] = self.method
+
+    def configure(self, workflow):
+        """Set the nipype hash method of workflow and install the policy"""
+        workflow.config['execution']['hash_method'] = self.nipype_method
+        self.install()
+        return workflow
+
+    def attach(self, workflow):
+        """Attach the policy to every node of workflow"""
+        from .resources import iter_nodes
+        for _, node in iter_nodes(workflow):
+            node.hash_policy = self
+        return workflow
+
+    def __getstate__(self):
+        return dict(method=self.method)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # a node unpickled by a worker must hash like the driver did
+        self.install()
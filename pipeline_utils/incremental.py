@@ -0,0 +1,192 @@
+"""
+Incremental one-sample group statistics.
+
+Adding a few subjects to a study used to mean reading every subject's cope
+again and refitting the group model.  For the ordinary least squares and
+fixed effects one-sample tests the group maps only depend on per-voxel
+sufficient statistics, so :class:`SufficientStats` keeps them on disk per
+contrast and folds in the new subjects only:
+
+``n, mean, m2``
+    number of subjects, mean cope and sum of squared deviations from it
+``weight, wmean, wm2``
+    the same weighted by ``1 / varcope`` (sum of weights, weighted mean and
+    weighted sum of squared deviations)
+
+Batches of subjects are merged with Chan et al.'s pairwise update, which is
+the sum / sum of squares formulation without its cancellation error in
+float64.  The store also records the SHA1 of every subject's cope and
+varcope (from :class:`pipeline_utils.l1index.L1Index`) and of the mask: a
+changed or removed subject, or a different mask, rebuilds the statistics of
+that contrast from all subjects.
+
+``ols``
+    the t test of :func:`pipeline_utils.groupstats.onesample_block`
+``fe``
+    fixed effects: ``cope = sum(w cope) / sum(w)``, ``varcope = 1 / sum(w)``
+    with ``w = 1 / varcope`` and z = t (FLAMEO ``fe``)
+"""
+
+import json
+import os
+
+import numpy as np
+
+from .groupstats import load_mask, masked_data, save_masked, t_to_z
+from .l1index import L1Index, file_hash
+
+METHODS = ['ols', 'fe']
+FIELDS = ['n', 'mean', 'm2', 'weight', 'wmean', 'wm2']
+# subjects read at once when (re)building the statistics
+BATCH_SIZE = 32
+
+
+def _merge(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Combine (weight, mean, sum of squared deviations) of two samples"""
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(n > 0, n_b / np.where(n > 0, n, 1.), 0.)
+    delta = mean_b - mean_a
+    return n, mean_a + delta * ratio, m2_a + m2_b + delta ** 2 * n_a * ratio
+
+
+class SufficientStats(object):
+    """Running one-sample statistics of n_vox masked voxels
+
+    ``subjects`` maps the subjects folded in to the SHA1s of their cope and
+    varcope.
+    """
+
+    def __init__(self, n_vox, mask_sha1=None):
+        self.n = 0.
+        for name in FIELDS[1:]:
+            setattr(self, name, np.zeros(n_vox))
+        self.mask_sha1 = mask_sha1
+        self.subjects = {}
+
+    def add(self, copes, varcopes):
+        """Fold [subject x voxel] copes and varcopes into the statistics"""
+        copes = np.asarray(copes, dtype=np.float64)
+        mean = copes.mean(axis=0)
+        self.n, self.mean, self.m2 = _merge(
+            self.n, self.mean, self.m2, float(copes.shape[0]), mean,
+            ((copes - mean) ** 2).sum(axis=0))
+        weights = 1. / np.maximum(varcopes, np.finfo(np.float32).tiny)
+        weight = weights.sum(axis=0)
+        wmean = (weights * copes).sum(axis=0) / weight
+        self.weight, self.wmean, self.wm2 = _merge(
+            self.weight, self.wmean, self.wm2, weight, wmean,
+            (weights * (copes - wmean) ** 2).sum(axis=0))
+        return self
+
+    def estimate(self, method='ols'):
+        """Return the group cope, varcope, tstat, zstat and dof"""
+        if method not in METHODS:
+            raise ValueError('Unknown method %s, use one of %s' %
+                             (method, METHODS))
+        if self.n < 2:
+            raise ValueError('A one-sample test needs at least two subjects')
+        if method == 'ols':
+            dof = int(self.n) - 1
+            beta = self.mean
+            variance = self.m2 / dof / self.n
+        else:
+            dof = None
+            beta = self.wmean
+            with np.errstate(divide='ignore'):
+                variance = np.where(self.weight > 0, 1. / self.weight, 0.)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tstat = np.where(variance > 0, beta / np.sqrt(variance), 0.)
+        zstat = tstat if dof is None else t_to_z(tstat, dof)
+        return dict(cope=beta, varcope=variance, tstat=tstat, zstat=zstat,
+                    dof=dof)
+
+    def save(self, filename):
+        out_dir = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        # np.savez appends .npz to names without it
+        tmp_file = '%s.%d.tmp.npz' % (filename, os.getpid())
+        np.savez(tmp_file, subjects=json.dumps(self.subjects, sort_keys=True),
+                 mask_sha1=str(self.mask_sha1),
+                 **dict([(name, getattr(self, name)) for name in FIELDS]))
+        os.rename(tmp_file, filename)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            stats = cls(len(data['mean']), str(data['mask_sha1']))
+            stats.n = float(data['n'])
+            for name in FIELDS[1:]:
+                setattr(stats, name, data[name])
+            stats.subjects = json.loads(str(data['subjects']))
+        return stats
+
+
+def update_stats(index, cope_id, mask_file, store_file, subjects=None):
+    """Fold the new subjects of cope_id into the statistics in store_file
+
+    Returns (stats, number of subjects read, whether the store was rebuilt).
+    """
+    mask_img, mask_idx = load_mask(mask_file)
+    mask_sha1 = file_hash(mask_file)
+    subjects = index.subjects if subjects is None else subjects
+    current = {}
+    for subject in subjects:
+        current[subject] = [index.record(subject, kind, cope_id)['sha1']
+                            for kind in ['copes', 'varcopes']]
+    stats = None
+    if os.path.exists(store_file):
+        stats = SufficientStats.load(store_file)
+        if stats.mask_sha1 != mask_sha1 or len(stats.mean) != len(mask_idx) \
+                or any([current.get(subject) != sha1s for subject, sha1s
+                        in stats.subjects.items()]):
+            stats = None
+    rebuilt = stats is None and os.path.exists(store_file)
+    if stats is None:
+        stats = SufficientStats(len(mask_idx), mask_sha1)
+    new = [subject for subject in subjects if subject not in stats.subjects]
+    for start in range(0, len(new), BATCH_SIZE):
+        batch = new[start:start + BATCH_SIZE]
+        stats.add(masked_data(index.files('copes', cope_id, batch), mask_idx,
+                              shape=mask_img.shape),
+                  masked_data(index.files('varcopes', cope_id, batch),
+                              mask_idx, shape=mask_img.shape))
+        for subject in batch:
+            stats.subjects[subject] = current[subject]
+    if new or rebuilt or not os.path.exists(store_file):
+        stats.save(store_file)
+    return stats, len(new), rebuilt
+
+
+def run_incremental(index_file, cope_ids, mask_file, method='ols',
+                    store_dir=None, out_dir=None, subdirs=None):
+    """Update the stored statistics of several contrasts and write the maps
+
+    The statistics of contrast ``<n>`` are kept in
+    ``<store_dir>/cope<n>.npz``.  Returns a dictionary like
+    :func:`pipeline_utils.groupstats.run_onesample`.
+    """
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    store_dir = os.path.abspath(store_dir or out_dir)
+    index = L1Index.load(index_file)
+    mask_img, mask_idx = load_mask(mask_file)
+    if subdirs is None:
+        subdirs = ['contrast_%d' % cope_id for cope_id in cope_ids]
+    outputs = dict(copes=[], varcopes=[], tstats=[], zstats=[], dof=[])
+    for cope_id, subdir in zip(cope_ids, subdirs):
+        stats, _, _ = update_stats(
+            index, cope_id, mask_file,
+            os.path.join(store_dir, 'cope%02d.npz' % cope_id))
+        res = stats.estimate(method)
+        contrast_dir = os.path.join(out_dir, subdir)
+        if not os.path.exists(contrast_dir):
+            os.makedirs(contrast_dir)
+        for key, name in [('cope', 'copes'), ('varcope', 'varcopes'),
+                          ('tstat', 'tstats'), ('zstat', 'zstats')]:
+            outputs[name].append(save_masked(
+                res[key], mask_img, mask_idx,
+                os.path.join(contrast_dir, '%s1.nii.gz' % key)))
+        outputs['dof'].append(res['dof'])
+    return outputs
@@ -0,0 +1,243 @@
+"""
+Index of first level outputs.
+
+The group scripts used to count contrasts by reparsing
+``task_contrasts.txt`` and let DataGrabber glob the l1output tree for every
+cope.  :class:`L1Index` scans ``<l1output_dir>/model%03d/task%03d`` once::
+
+    <subject>/copes/mni/cope01.nii.gz
+    <subject>/varcopes/mni/varcope01.nii.gz
+    <subject>/zstats/mni/zstat01.nii.gz
+    <subject>/copes/spm/mni/cope01.nii         (use_spm)
+    <subject>/copes/mni/cope01.mvec.npz        (compact, see maskstore)
+
+and records, for every file, its shape and the SHA1 of its content.  Files
+are fully read once, so truncated or otherwise unreadable images are found
+here instead of in FLAMEO.  The index is saved as JSON and reused on the
+next scan for files whose size and modification time did not change.
+
+:meth:`L1Index.check` lists missing, unreadable and mismatched (shape
+different from the other subjects) files of the copes a group analysis
+needs, and :func:`grabber_node` replaces the DataGrabber of the group
+workflows.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+PATTERN = re.compile(r'^(cope|varcope|zstat)(\d+)(\.nii(\.gz)?|\.mvec\.npz)$')
+KINDS = {'cope': 'copes', 'varcope': 'varcopes', 'zstat': 'zstats'}
+
+
+def file_hash(filename, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def image_info(filename):
+    """Return (shape, error) after reading the whole image"""
+    import nibabel as nb
+    import numpy as np
+    from .maskstore import is_compact, load_compact
+    try:
+        if is_compact(filename):
+            return list(load_compact(filename)['shape']), None
+        img = nb.load(filename)
+        np.asanyarray(img.dataobj)
+    except Exception as exc:
+        return None, '%s: %s' % (type(exc).__name__, exc)
+    return list(img.shape), None
+
+
+class L1Index(object):
+    """Copes, varcopes and zstats available per subject for one task
+
+    Parameters
+    ----------
+    l1output_dir : str
+        Root of the first level outputs
+    model_id, task_id : int
+    use_spm : bool
+        Index the SPM estimates (``<kind>/spm/mni``) instead of FSL's
+    index_file : str
+        JSON file the index is saved to and reused from
+    """
+
+    def __init__(self, l1output_dir, model_id, task_id, use_spm=False,
+                 index_file=None):
+        self.l1output_dir = os.path.abspath(l1output_dir)
+        self.model_id = model_id
+        self.task_id = task_id
+        self.use_spm = use_spm
+        self.index_file = index_file
+        # {subject: {kind: {cope_id: record}}}
+        self.entries = {}
+
+    @property
+    def task_dir(self):
+        return os.path.join(self.l1output_dir, 'model%03d' % self.model_id,
+                            'task%03d' % self.task_id)
+
+    @property
+    def subjects(self):
+        """Subjects with at least one cope"""
+        return sorted([subj for subj, kinds in self.entries.items()
+                       if kinds.get('copes')])
+
+    def _space_dir(self, subject, kind):
+        parts = [self.task_dir, subject, kind]
+        if self.use_spm:
+            parts.append('spm')
+        return os.path.join(*(parts + ['mni']))
+
+    def scan(self):
+        """Scan the task directory, reusing unchanged records, and save"""
+        previous = {}
+        if self.index_file and os.path.exists(self.index_file):
+            previous = self._read(self.index_file).get('entries', {})
+        self.entries = {}
+        if not os.path.isdir(self.task_dir):
+            return self
+        for subject in sorted(os.listdir(self.task_dir)):
+            if not os.path.isdir(os.path.join(self.task_dir, subject)):
+                continue
+            for kind in sorted(set(KINDS.values())):
+                space_dir = self._space_dir(subject, kind)
+                if not os.path.isdir(space_dir):
+                    continue
+                for filename in sorted(os.listdir(space_dir)):
+                    match = PATTERN.match(filename)
+                    if not match or KINDS[match.group(1)] != kind:
+                        continue
+                    cope_id = str(int(match.group(2)))
+                    record = self._record(
+                        os.path.join(space_dir, filename),
+                        previous.get(subject, {}).get(kind, {}).get(cope_id))
+                    self.entries.setdefault(subject, {}).setdefault(
+                        kind, {})[cope_id] = record
+        if self.index_file:
+            self.save(self.index_file)
+        return self
+
+    def _record(self, path, previous=None):
+        stat = os.stat(path)
+        if previous and previous['path'] == path and \
+                previous['size'] == stat.st_size and \
+                previous['mtime'] == stat.st_mtime:
+            return previous
+        shape, error = image_info(path)
+        return dict(path=path, size=stat.st_size, mtime=stat.st_mtime,
+                    shape=shape, error=error, sha1=file_hash(path))
+
+    def cope_ids(self):
+        """Sorted ids of the copes found for any subject"""
+        ids = set()
+        for kinds in self.entries.values():
+            ids.update([int(val) for val in kinds.get('copes', {})])
+        return sorted(ids)
+
+    def record(self, subject, kind, cope_id):
+        return self.entries.get(subject, {}).get(kind, {}).get(str(cope_id))
+
+    def files(self, kind, cope_id, subjects=None):
+        """Paths of a cope/varcope/zstat in the order of subjects
+
+        Raises ValueError if a subject does not have it.
+        """
+        subjects = self.subjects if subjects is None else subjects
+        paths = []
+        for subject in subjects:
+            record = self.record(subject, kind, cope_id)
+            if record is None:
+                raise ValueError('No %s %s for %s in %s' %
+                                 (kind[:-1], cope_id, subject, self.task_dir))
+            paths.append(record['path'])
+        return paths
+
+    def problems(self, cope_ids, subjects=None, kinds=('copes', 'varcopes')):
+        """Return messages about missing, unreadable or mismatched files"""
+        subjects = self.subjects if subjects is None else subjects
+        messages = []
+        if not subjects:
+            return ['No first level outputs in %s' % self.task_dir]
+        for cope_id in cope_ids:
+            for kind in kinds:
+                shapes = {}
+                for subject in subjects:
+                    record = self.record(subject, kind, cope_id)
+                    if record is None:
+                        messages.append('%s: missing %s %s' %
+                                        (subject, kind[:-1], cope_id))
+                    elif record['error']:
+                        messages.append('%s: unreadable %s: %s' %
+                                        (subject, record['path'],
+                                         record['error']))
+                    else:
+                        shapes.setdefault(tuple(record['shape']),
+                                          []).append(subject)
+                if len(shapes) > 1:
+                    common = max(shapes, key=lambda key: len(shapes[key]))
+                    for shape, subjs in shapes.items():
+                        if shape != common:
+                            messages.extend(['%s: %s %s has shape %s, not %s'
+                                             % (subj, kind[:-1], cope_id,
+                                                list(shape), list(common))
+                                             for subj in subjs])
+        return messages
+
+    def check(self, cope_ids, subjects=None, kinds=('copes', 'varcopes')):
+        """Raise ValueError listing every problem of the needed files"""
+        messages = self.problems(cope_ids, subjects, kinds)
+        if messages:
+            raise ValueError('First level outputs of model %d task %d are '
+                             'incomplete:\n  %s' % (self.model_id,
+                                                    self.task_id,
+                                                    '\n  '.join(messages)))
+        return self
+
+    @staticmethod
+    def _read(filename):
+        with open(filename, 'rt') as fp:
+            return json.load(fp)
+
+    def save(self, filename):
+        out_dir = os.path.dirname(os.path.abspath(filename))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        with open(filename, 'wt') as fp:
+            json.dump(dict(l1output_dir=self.l1output_dir,
+                           model_id=self.model_id, task_id=self.task_id,
+                           use_spm=self.use_spm, entries=self.entries),
+                      fp, indent=1, sort_keys=True)
+        return filename
+
+    @classmethod
+    def load(cls, filename):
+        data = cls._read(filename)
+        index = cls(data['l1output_dir'], data['model_id'], data['task_id'],
+                    use_spm=data['use_spm'], index_file=filename)
+        index.entries = data['entries']
+        return index
+
+
+def load_l1index(l1output_dir, model_id, task_id, index_file, use_spm=False):
+    """Scan (or rescan) the first level outputs of a task"""
+    return L1Index(l1output_dir, model_id, task_id, use_spm=use_spm,
+                   index_file=index_file).scan()
+
+
+def grabber_node(index_file, subjects, cope_id):
+    """nipype Function returning the copes and varcopes of cope_id
+
+    subjects gives the order of the files (all indexed subjects if empty).
+    """
+    from pipeline_utils.l1index import L1Index
+    index = L1Index.load(index_file)
+    subjects = list(subjects) or None
+    return (index.files('copes', cope_id, subjects),
+            index.files('varcopes', cope_id, subjects))
@@ -0,0 +1,184 @@
+"""
+Declarative BIDS-Derivatives output layout.
+
+The substitution lists handed to DataSink are keyed on nipype's internal
+directory names (``_flameo%d/cope1.``, ``_warpall%d/...``), so they grow with
+the number of contrasts and break whenever a workflow is rearranged.  A
+layout instead maps every output field to a path template such as::
+
+    {subject_dir}/func/{prefix}_task-{task}_contrast-{contrast}_stat-cope{ext}
+
+and :class:`DerivativesSink` writes each file straight to its final name.
+The path of a file only depends on the entities of the run (subject, task,
+session), the entities of its position in the output list (contrast, run)
+and its extension, so it is computed in constant time.
+"""
+
+import os
+import re
+
+from nipype.interfaces.base import (traits, TraitedSpec, DynamicTraitedSpec,
+                                    BaseInterfaceInputSpec, Directory,
+                                    isdefined)
+from nipype.interfaces.io import IOBase, add_traits
+from nipype.utils.filemanip import copyfile, filename_to_list
+
+STAT_TEMPLATE = ('{subject_dir}/func/{prefix}_task-{task}_contrast-{contrast}'
+                 '_stat-%s{ext}')
+MNI_STAT_TEMPLATE = ('{subject_dir}/func/{prefix}_task-{task}'
+                     '_space-MNI152NLin6Asym_contrast-{contrast}_stat-%s{ext}')
+
+SUBJECT_LAYOUT = {
+    'copes': STAT_TEMPLATE % 'cope',
+    'varcopes': STAT_TEMPLATE % 'varcope',
+    'zstats': STAT_TEMPLATE % 'z',
+    'tstats': STAT_TEMPLATE % 't',
+    'res4d': STAT_TEMPLATE % 'res4d',
+    'copes_mni': MNI_STAT_TEMPLATE % 'cope',
+    'varcopes_mni': MNI_STAT_TEMPLATE % 'varcope',
+    'zstats_mni': MNI_STAT_TEMPLATE % 'z',
+    'roi_avgwf': ('{subject_dir}/func/{prefix}_task-{task}_atlas-aparc'
+                  '_contrast-{contrast}_stat-cope_timeseries{ext}'),
+    'roi_summary': ('{subject_dir}/func/{prefix}_task-{task}_atlas-aparc'
+                    '_contrast-{contrast}_stat-cope_summary{ext}'),
+    'tsnr': '{subject_dir}/func/{prefix}_task-{task}_run-{run}_tsnr{ext}',
+    'mean': '{subject_dir}/func/{prefix}_task-{task}_desc-median_boldref{ext}',
+    'mean_mni': ('{subject_dir}/func/{prefix}_task-{task}'
+                 '_space-MNI152NLin6Asym_desc-median_boldref{ext}'),
+}
+
+RESTING_LAYOUT = {
+    'bandpassed': ('{subject_dir}/func/{prefix}_task-rest_run-{run}'
+                   '_desc-unsmoothed_bold{ext}'),
+    'smoothed': ('{subject_dir}/func/{prefix}_task-rest_run-{run}'
+                 '_desc-smoothed_bold{ext}'),
+    'target': ('{subject_dir}/func/{prefix}_task-rest_run-{run}'
+               '_space-{space}_desc-{desc}_bold{ext}'),
+    'tsnr': '{subject_dir}/func/{prefix}_task-rest_run-{run}_tsnr{ext}',
+}
+
+
+def bids_label(value):
+    """Return value stripped of everything but letters and digits"""
+    return re.sub('[^a-zA-Z0-9]', '', str(value))
+
+
+def bids_entities(subject_id, session_id=None, **entities):
+    """Return the entities shared by all outputs of a subject
+
+    ``subject_dir`` and ``prefix`` are derived from the subject and optional
+    session so that templates do not need a session specific variant.
+    """
+    subject = bids_label(re.sub('^sub-', '', str(subject_id)))
+    out = dict([(key, bids_label(val)) for key, val in entities.items()])
+    out['subject'] = subject
+    out['subject_dir'] = 'sub-%s' % subject
+    out['prefix'] = 'sub-%s' % subject
+    if session_id:
+        session = bids_label(re.sub('^ses-', '', str(session_id)))
+        out['session'] = session
+        out['subject_dir'] = os.path.join(out['subject_dir'], 'ses-%s' % session)
+        out['prefix'] += '_ses-%s' % session
+    return out
+
+
+def split_ext(filename):
+    """Return the image aware extension of filename (e.g. ``.nii.gz``)"""
+    for ext in ['.nii.gz', '.tar.gz', '.mvec.npz']:
+        if filename.endswith(ext):
+            return ext
+    return os.path.splitext(filename)[1]
+
+
+class DerivativesSinkInputSpec(DynamicTraitedSpec, BaseInterfaceInputSpec):
+    base_directory = Directory(mandatory=True,
+                               desc='Root directory of the derivatives')
+    layout = traits.Dict(traits.Str, traits.Str, mandatory=True,
+                         desc='Path template of each output field')
+    entities = traits.Dict(desc='Entities shared by all outputs')
+    index_entities = traits.Dict(desc=('List of entity dictionaries for the '
+                                       'files of each output field'))
+    use_hardlink = traits.Bool(True, usedefault=True,
+                               desc='Hardlink instead of copying if possible')
+
+
+class DerivativesSinkOutputSpec(TraitedSpec):
+    out_files = traits.List(traits.Str, desc='Files written by the sink')
+
+
+class DerivativesSink(IOBase):
+    """Write workflow outputs directly to their BIDS-Derivatives names
+
+    Examples
+    --------
+
+    >>> sink = DerivativesSink(fields=['copes'])
+    >>> sink.inputs.base_directory = '/output'
+    >>> sink.inputs.layout = {'copes': STAT_TEMPLATE % 'cope'}
+    >>> sink.inputs.entities = bids_entities('sub-01', task='faces')
+    >>> sink.inputs.index_entities = {'copes': [{'contrast': 'facesgtrest'}]}
+    >>> sink.inputs.copes = ['/work/_flameo0/cope1.nii.gz'] # doctest: +SKIP
+
+    writes ``/output/sub-01/func/sub-01_task-faces_contrast-facesgtrest_stat-
+    cope.nii.gz``.  Without ``index_entities`` the files of a field get an
+    ``index`` entity counting from 1.
+    """
+
+    input_spec = DerivativesSinkInputSpec
+    output_spec = DerivativesSinkOutputSpec
+
+    def __init__(self, fields=None, **inputs):
+        super(DerivativesSink, self).__init__(**inputs)
+        self._fields = list(fields or [])
+        add_traits(self.inputs, self._fields)
+        self._always_run = True
+
+    def _list_outputs(self):
+        entities = {}
+        if isdefined(self.inputs.entities):
+            entities = self.inputs.entities
+        index_entities = {}
+        if isdefined(self.inputs.index_entities):
+            index_entities = self.inputs.index_entities
+        out_files = []
+        for field in self._fields:
+            value = getattr(self.inputs, field)
+            if not isdefined(value) or value is None:
+                continue
+            if field not in self.inputs.layout:
+                raise ValueError('No layout template for output %s' % field)
+            template = self.inputs.layout[field]
+            in_files = _flatten(value)
+            field_entities = index_entities.get(field)
+            if field_entities is not None and \
+                    len(field_entities) != len(in_files):
+                raise ValueError('%s has %d files but %d entity sets' %
+                                 (field, len(in_files), len(field_entities)))
+            for idx, in_file in enumerate(in_files):
+                file_entities = dict(entities)
+                if field_entities is None:
+                    file_entities['index'] = '%02d' % (idx + 1)
+                else:
+                    file_entities.update(field_entities[idx])
+                file_entities['ext'] = split_ext(in_file)
+                out_file = os.path.join(self.inputs.base_directory,
+                                        template.format(**file_entities))
+                if out_file in out_files:
+                    raise ValueError('Layout maps two outputs to %s' % out_file)
+                out_dir = os.path.dirname(out_file)
+                if not os.path.exists(out_dir):
+                    os.makedirs(out_dir)
+                copyfile(in_file, out_file, copy=True,
+                         use_hardlink=self.inputs.use_hardlink)
+                out_files.append(out_file)
+        return {'out_files': out_files}
+
+
+def _flatten(value):
+    out = []
+    for val in filename_to_list(value):
+        if isinstance(val, (list, tuple)):
+            out.extend(_flatten(list(val)))
+        else:
+            out.append(val)
+    return out
@@ -0,0 +1,159 @@
+"""
+Deferred imports of heavy modules.
+
+The scripts imported nipype's engine, interfaces and FSL workflows, SPM,
+nipy, dcmstack and nibabel at their top, so even ``--help`` took seconds
+and every SLURM array element paid for it before parsing its command line.
+:func:`lazy_import` and :func:`lazy_from` bind stand-ins at module level
+that import on first use::
+
+    fsl = lazy_import('nipype.interfaces.fsl')
+    Node, MapNode = lazy_from('nipype', 'Node', 'MapNode')
+
+A module stand-in forwards attribute access.  A name stand-in forwards
+calls and attribute access, which is all the scripts do with the classes
+and functions they import; constants, base classes and ``isinstance``
+targets must be reached through their module.  Import-time configuration
+(FSL output type, SPM paths) belongs in the functions building the
+workflows, where it runs once the interfaces are needed.
+
+``python -m pipeline_utils.lazy <script>...`` times ``<script> --help``
+and lists the heavy modules that importing the script loads.
+"""
+
+from __future__ import print_function
+
+import importlib
+import os
+
+# modules the scripts should not load before they build a workflow
+HEAVY_MODULES = ['nipype', 'nipype.pipeline.engine', 'nipype.interfaces.fsl',
+                 'nipype.interfaces.ants', 'nipype.interfaces.freesurfer',
+                 'nipype.interfaces.spm', 'nipype.interfaces.nipy',
+                 'nipype.workflows.fmri.fsl', 'dcmstack', 'dicom', 'scipy',
+                 'pandas', 'nibabel']
+
+
+class LazyModule(object):
+    """Stand-in for the module name, imported on first attribute access"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module %s (%s)>' % (self._name, state)
+
+
+class LazyAttribute(object):
+    """Stand-in for attr of a LazyModule, resolved on first use"""
+
+    def __init__(self, module, attr):
+        self._module = module
+        self._attr = attr
+        self._value = None
+
+    def _load(self):
+        if self._value is None:
+            self._value = getattr(self._module._load(), self._attr)
+        return self._value
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return '<lazy %s.%s>' % (self._module._name, self._attr)
+
+
+def lazy_import(name):
+    """Return a stand-in for ``import name``"""
+    return LazyModule(name)
+
+
+def lazy_from(name, *attrs):
+    """Return stand-ins for ``from name import attrs``
+
+    A single name is returned as is, several as a tuple.
+    """
+    module = LazyModule(name)
+    out = tuple([LazyAttribute(module, attr) for attr in attrs])
+    return out[0] if len(out) == 1 else out
+
+
+def loaded_heavy_modules(script):
+    """Import script (without running its main) in a fresh interpreter and
+    return the modules of HEAVY_MODULES it loaded (None if it failed)"""
+    import json
+    import subprocess
+    import sys
+    code = ('import json, runpy, sys; '
+            'runpy.run_path(%r, run_name="lazy_import_check"); '
+            'print(json.dumps([name for name in %r if name in sys.modules]))'
+            % (script, HEAVY_MODULES))
+    try:
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        return None
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def startup_time(script, args=('--help',), repeat=3):
+    """Return the best wall time (s) of running script with args, or None
+    if it exits with an error (a failing script is not a fast one)"""
+    import subprocess
+    import sys
+    import time
+    best = None
+    with open(os.devnull, 'wb') as null:
+        for _ in range(repeat):
+            start = time.time()
+            if subprocess.call([sys.executable, script] + list(args),
+                               stdout=null, stderr=null):
+                return None
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark(scripts, repeat=3):
+    """Time --help of scripts and list the heavy modules they import"""
+    return dict([(script, dict(help_s=startup_time(script, repeat=repeat),
+                               heavy_modules=loaded_heavy_modules(script)))
+                 for script in scripts])
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=('Time the startup of the '
+                                                  'pipeline scripts'))
+    parser.add_argument('scripts', nargs='+')
+    parser.add_argument('-n', '--repeat', default=3, type=int)
+    args = parser.parse_args()
+    result = benchmark([os.path.abspath(script) for script in args.scripts],
+                       repeat=args.repeat)
+    for script in args.scripts:
+        res = result[os.path.abspath(script)]
+        if res['help_s'] is None or res['heavy_modules'] is None:
+            print('%-50s  failed' % script)
+            continue
+        print('%-50s %6.2fs  %s' % (script, res['help_s'],
+                                    ', '.join(res['heavy_modules']) or
+                                    'no heavy imports'))
@@ -0,0 +1,118 @@
+"""
+Completion manifest of the subject level outputs.
+
+Rerunning a subject level analysis after a crash makes nipype check the
+hashes of every node of every subject, including the subjects whose
+outputs were all sunk.  The subject workflow ends with a ``manifest`` node
+that runs after the sinks and writes, per subject::
+
+    <output_dir>/manifest/<subject_id>.json
+        subject_id, model_id, task_id
+        params      SHA1 of the workflow parameters (:func:`params_key`)
+        files       {path: [size, mtime, sha1]} of every sunk file
+
+With ``--resume`` the driver drops the subjects whose manifest has the same
+parameters and whose files all still have their recorded size and mtime
+(:func:`completed_subjects`) before the workflow is built, so neither the
+graph nor the node hashes of these subjects are computed.  The SHA1s are
+for checking outputs later (:func:`verify_manifest`), not for resuming.
+"""
+
+import hashlib
+import json
+import os
+
+from .l1index import file_hash
+
+MANIFEST_DIR = 'manifest'
+
+
+def params_key(params):
+    """Return the SHA1 of the parameters of a run, without its subjects"""
+    params = dict([(key, val) for key, val in params.items()
+                   if key != 'subject'])
+    return hashlib.sha1(json.dumps(params, sort_keys=True,
+                                   default=str).encode('utf-8')).hexdigest()
+
+
+def manifest_file(output_dir, subject_id):
+    return os.path.join(output_dir, MANIFEST_DIR, '%s.json' % subject_id)
+
+
+def _flatten(value):
+    if isinstance(value, (list, tuple)):
+        return [item for val in value for item in _flatten(val)]
+    return [] if value is None else [value]
+
+
+def write_manifest(output_dir, subject_id, model_id, task_id, params,
+                   out_files):
+    """Record the sunk files of a subject; returns the manifest file"""
+    files = {}
+    for filename in sorted(set(_flatten(out_files))):
+        if not os.path.isfile(filename):
+            continue
+        stat = os.stat(filename)
+        files[os.path.relpath(filename, output_dir)] = [
+            stat.st_size, stat.st_mtime, file_hash(filename)]
+    filename = manifest_file(output_dir, subject_id)
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    tmp_file = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_file, 'wt') as fp:
+        json.dump(dict(subject_id=subject_id, model_id=model_id,
+                       task_id=task_id, params=params, files=files),
+                  fp, indent=1, sort_keys=True)
+    os.rename(tmp_file, filename)
+    return filename
+
+
+def load_manifest(output_dir, subject_id):
+    """Return the manifest of subject_id, or None"""
+    filename = manifest_file(output_dir, subject_id)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rt') as fp:
+        return json.load(fp)
+
+
+def is_complete(output_dir, subject_id, params):
+    """Whether the outputs of subject_id were sunk with params and did not
+    change since (by size and mtime)"""
+    manifest = load_manifest(output_dir, subject_id)
+    if manifest is None or manifest['params'] != params or \
+            not manifest['files']:
+        return False
+    for relpath, (size, mtime, _) in manifest['files'].items():
+        filename = os.path.join(output_dir, relpath)
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return False
+        if stat.st_size != size or stat.st_mtime != mtime:
+            return False
+    return True
+
+
+def completed_subjects(output_dir, subjects, params):
+    return [subject for subject in subjects
+            if is_complete(output_dir, subject, params)]
+
+
+def verify_manifest(output_dir, subject_id):
+    """Return the recorded files of subject_id whose SHA1 changed"""
+    manifest = load_manifest(output_dir, subject_id) or dict(files={})
+    changed = []
+    for relpath, (_, _, sha1) in sorted(manifest['files'].items()):
+        filename = os.path.join(output_dir, relpath)
+        if not os.path.exists(filename) or file_hash(filename) != sha1:
+            changed.append(relpath)
+    return changed
+
+
+def manifest_node(sink_files, derivative_files, subject_id, model_id,
+                  task_id, output_dir, params):
+    """nipype Function writing the manifest of a subject after its sinks"""
+    from pipeline_utils.manifest import write_manifest
+    return write_manifest(output_dir, subject_id, model_id, task_id, params,
+                          [sink_files, derivative_files])
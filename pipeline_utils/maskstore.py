@@ -0,0 +1,143 @@
+"""
+Compact storage of MNI space statistic maps.
+
+The first level copes, varcopes and zstats warped to MNI space are full
+91x109x91 volumes, more than half of which lies outside the brain mask the
+group analyses read them through.  :func:`compact_image` keeps only the
+voxels of the mask::
+
+    cope01.mvec.npz
+        values      voxels of the mask in flat (C) order, as nibabel reads
+                    them (after scaling) and in their data type
+        header      NIfTI-1 header of the source image
+        mask_file   path of the mask, and mask_sha1 its SHA1
+
+The values of the mask are reconstructed exactly by :func:`to_nifti`
+(voxels outside the mask are zero), and :func:`masked_values` returns them
+without building a volume when the reader uses the same mask, which is the
+case of :func:`pipeline_utils.groupstats.masked_data` and therefore of all
+in-process group engines.
+"""
+
+import os
+
+import numpy as np
+
+from .l1index import file_hash
+
+EXT = '.mvec.npz'
+# {mask_file: (mtime, shape, flat indices, sha1)}
+_MASKS = {}
+
+
+def is_compact(filename):
+    return hasattr(filename, 'endswith') and filename.endswith(EXT)
+
+
+def mask_indices(mask_file):
+    """Return (shape, flat indices, SHA1) of the nonzero voxels of a mask"""
+    import nibabel as nb
+    mask_file = os.path.abspath(mask_file)
+    mtime = os.stat(mask_file).st_mtime
+    cached = _MASKS.get(mask_file)
+    if cached is None or cached[0] != mtime:
+        img = nb.load(mask_file)
+        mask = np.asanyarray(img.dataobj) > 0
+        cached = (mtime, tuple(img.shape[:3]),
+                  np.flatnonzero(mask.ravel()), file_hash(mask_file))
+        _MASKS[mask_file] = cached
+    return cached[1:]
+
+
+def compact_image(in_file, mask_file, out_file=None):
+    """Write the voxels of in_file inside mask_file to a .mvec.npz file"""
+    import nibabel as nb
+    img = nb.load(in_file)
+    shape, mask_idx, mask_sha1 = mask_indices(mask_file)
+    if tuple(img.shape[:3]) != shape or \
+            int(np.prod(img.shape[3:])) != 1:
+        raise ValueError('%s has shape %s, expected the mask grid %s' %
+                         (in_file, img.shape, shape))
+    if out_file is None:
+        name = os.path.basename(in_file)
+        for ext in ['.nii.gz', '.nii']:
+            if name.endswith(ext):
+                name = name[:-len(ext)]
+                break
+        out_file = os.path.join(os.getcwd(), name + EXT)
+    values = np.asanyarray(img.dataobj).reshape(-1)[mask_idx]
+    header = nb.Nifti1Header.from_header(img.header)
+    np.savez(out_file, values=values,
+             header=np.frombuffer(header.binaryblock, dtype=np.uint8),
+             shape=np.array(shape),
+             mask_file=os.path.abspath(mask_file), mask_sha1=mask_sha1)
+    return out_file
+
+
+def load_compact(filename):
+    """Return the fields of a .mvec.npz file as a dictionary"""
+    with np.load(filename) as data:
+        return dict(values=data['values'], header=data['header'].tobytes(),
+                    shape=tuple([int(val) for val in data['shape']]),
+                    mask_file=str(data['mask_file']),
+                    mask_sha1=str(data['mask_sha1']))
+
+
+def _mask_of(compact, filename):
+    if not os.path.exists(compact['mask_file']):
+        raise ValueError('Mask %s of %s does not exist' %
+                         (compact['mask_file'], filename))
+    shape, mask_idx, mask_sha1 = mask_indices(compact['mask_file'])
+    if mask_sha1 != compact['mask_sha1']:
+        raise ValueError('Mask %s changed since %s was written' %
+                         (compact['mask_file'], filename))
+    return mask_idx
+
+
+def masked_values(filename, mask_idx, shape=None):
+    """Return the voxels at the flat indices mask_idx of a compact map"""
+    compact = load_compact(filename)
+    if shape is not None and tuple(shape[:3]) != compact['shape']:
+        raise ValueError('%s has shape %s, expected %s' %
+                         (filename, compact['shape'], shape))
+    stored_idx = _mask_of(compact, filename)
+    if np.array_equal(stored_idx, mask_idx):
+        return compact['values']
+    data = np.zeros(int(np.prod(compact['shape'])),
+                    dtype=compact['values'].dtype)
+    data[stored_idx] = compact['values']
+    return data[mask_idx]
+
+
+def to_nifti(filename, out_file=None):
+    """Reconstruct the NIfTI image of a compact map"""
+    import nibabel as nb
+    compact = load_compact(filename)
+    if out_file is None:
+        out_file = os.path.join(os.getcwd(), os.path.basename(
+            filename)[:-len(EXT)] + '.nii.gz')
+    data = np.zeros(int(np.prod(compact['shape'])),
+                    dtype=compact['values'].dtype)
+    data[_mask_of(compact, filename)] = compact['values']
+    header = nb.Nifti1Header(binaryblock=compact['header'])
+    img = nb.Nifti1Image(data.reshape(compact['shape']), None, header)
+    img.set_data_dtype(data.dtype)
+    img.to_filename(out_file)
+    return out_file
+
+
+def compact_node(copes, varcopes, zstats, mask_file):
+    """nipype Function writing compact copes, varcopes and zstats
+
+    The files are named ``cope01.mvec.npz``... in the order of the inputs.
+    """
+    import os
+    from pipeline_utils.maskstore import compact_image
+    out = []
+    for kind, in_files in [('cope', copes), ('varcope', varcopes),
+                           ('zstat', zstats)]:
+        out.append([compact_image(in_file, mask_file,
+                                  os.path.join(os.getcwd(), '%s%02d.mvec.npz'
+                                               % (kind, idx + 1)))
+                    for idx, in_file in enumerate(in_files)])
+    return tuple(out)
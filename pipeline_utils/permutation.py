@@ -0,0 +1,321 @@
+"""
+Permutation inference for group designs without MATLAB.
+
+This replaces the ``palm -T -C 3.09 -Cstat extent -fdr -twotail -logp
+-zstat`` call of the nonparametric group path.  The data are the merged
+4D copes restricted to the mask, i.e. a [subjects x voxels] matrix.  For
+each t contrast the design is partitioned into the effect of interest and
+nuisance regressors and the Freedman-Lane procedure permutes (or sign
+flips, for a group mean or designs without nuisance regressors) the
+nuisance model residuals.
+
+Permutations are applied to the orthonormal basis of the design instead
+of the data, so a batch of permutations costs one ``[batch x rank x
+subjects] @ [subjects x voxels]`` product.  Batches are split in chunks run
+by a process pool; the permutation set is drawn up front from ``seed`` (the
+first one being the identity) and chunk results are combined in order, so
+results do not depend on the number of workers.
+
+For every contrast the outputs follow PALM's names (``-logp``: p value
+maps hold -log10(p))::
+
+    palm_vox_zstat_c1          z statistic
+    palm_vox_zstat_uncp_c1     uncorrected, FWE and FDR corrected p
+    palm_vox_zstat_fwep_c1
+    palm_vox_zstat_fdrp_c1
+    palm_clustere_zstat_c1     cluster extent at cluster_threshold
+    palm_clustere_zstat_fwep_c1
+    palm_tfce_zstat_c1         TFCE and its p value maps
+    palm_tfce_zstat_uncp_c1
+    palm_tfce_zstat_fwep_c1
+    palm_tfce_zstat_fdrp_c1
+
+Tests are two-tailed: maxima, clusters and TFCE use the absolute z map.
+TFCE is computed for a whole batch of permutations at once on the cached
+neighbour graph of the mask (:class:`pipeline_utils.tfce.TFCEGraph`).
+"""
+
+import os
+
+import numpy as np
+
+from .groupstats import load_mask, save_masked, t_to_z
+from .tfce import TFCEGraph, cluster_sizes
+
+BATCH_SIZE = 16
+
+
+def read_vest(filename):
+    """Return the matrix of an FSL VEST file (design.mat, .con, .grp)"""
+    rows = []
+    in_matrix = False
+    with open(filename, 'rt') as fp:
+        for line in fp:
+            line = line.strip()
+            if line.startswith('/Matrix'):
+                in_matrix = True
+                continue
+            if in_matrix and line:
+                rows.append([float(val) for val in line.split()])
+    return np.array(rows)
+
+
+def masked_4d(in_file, mask_idx):
+    """Return the [volume x voxel] matrix of a 4D image within the mask"""
+    import nibabel as nb
+    img = nb.load(in_file, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 3:
+        data = data[..., None]
+    data = data.reshape((-1, data.shape[-1]))
+    return np.ascontiguousarray(data[mask_idx].T, dtype=np.float64)
+
+
+def partition(design, contrast):
+    """Split design into the effect of interest and nuisance regressors
+
+    Returns the effect of interest (n x 1) and an orthonormal basis of the
+    nuisance space (n x q, q may be 0).
+    """
+    contrast = np.atleast_2d(contrast)
+    effect = np.dot(design, np.linalg.pinv(contrast))
+    nuisance = np.dot(design, np.eye(design.shape[1]) -
+                      np.dot(np.linalg.pinv(contrast), contrast))
+    u_mat, svals, _ = np.linalg.svd(nuisance, full_matrices=False)
+    rank = (svals > svals.max() * 1e-10).sum() if svals.size and \
+        svals.max() > 0 else 0
+    return effect, u_mat[:, :rank]
+
+
+def make_shuffles(n_subj, n_perm, groups=None, sign_flip=False, seed=0):
+    """Return (row orders, signs) of n_perm shuffles, the first the identity
+
+    Rows are only permuted within the exchangeability blocks in groups.
+    """
+    rng = np.random.RandomState(seed)
+    groups = np.ones(n_subj) if groups is None else np.asarray(groups).ravel()
+    orders = np.tile(np.arange(n_subj), (n_perm, 1))
+    signs = np.ones((n_perm, n_subj))
+    for idx in range(1, n_perm):
+        if sign_flip:
+            signs[idx] = rng.choice([-1., 1.], size=n_subj)
+        else:
+            for block in np.unique(groups):
+                members = np.flatnonzero(groups == block)
+                orders[idx, members] = members[rng.permutation(len(members))]
+    return orders, signs
+
+
+class ContrastModel(object):
+    """Freedman-Lane t statistics of one contrast under many shuffles"""
+
+    def __init__(self, design, contrast, data):
+        n_subj = design.shape[0]
+        effect, nuisance = partition(design, contrast)
+        # permuting rows cannot change the statistic of a constant effect
+        # (a group mean) or of a design without nuisance regressors
+        self.sign_flip = (nuisance.shape[1] == 0 or
+                          np.ptp(effect) <= 1e-10 * np.abs(effect).max())
+        model = np.column_stack([effect, nuisance])
+        self.dof = n_subj - np.linalg.matrix_rank(model)
+        if self.dof < 1:
+            raise ValueError('Design leaves no degrees of freedom')
+        # residuals of the nuisance model are shuffled; its fit is added back
+        self.resid = data - np.dot(nuisance, np.dot(nuisance.T, data))
+        self.fitted = data - self.resid
+        self.basis, _ = np.linalg.qr(model)
+        self.pinv_row = np.linalg.pinv(model)[0]
+        self.unscaled = np.linalg.pinv(np.dot(model.T, model))[0, 0]
+        self.const_beta = np.dot(self.pinv_row, self.fitted)
+        # shuffles keep the column norms of the residuals
+        self.resid_norm = (self.resid ** 2).sum(axis=0)
+
+    def zstats(self, orders, signs):
+        """Return [shuffle x voxel] z statistics"""
+        n_batch = len(orders)
+        rank = self.basis.shape[1]
+        # Q' P S r = (S P' Q)' r: shuffle the basis instead of the data
+        shuffled = np.empty((n_batch, rank + 1, self.basis.shape[0]))
+        for idx in range(n_batch):
+            inverse = np.argsort(orders[idx])
+            flips = signs[idx][inverse]
+            shuffled[idx, :rank] = (self.basis[inverse] * flips[:, None]).T
+            shuffled[idx, rank] = self.pinv_row[inverse] * flips
+        proj = np.dot(shuffled.reshape((-1, shuffled.shape[-1])), self.resid)
+        proj = proj.reshape((n_batch, rank + 1, -1))
+        beta = proj[:, rank] + self.const_beta
+        # the residual sum of squares of Y* = P r + fitted is
+        # |P r|^2 - |Q' P r|^2 because fitted lies in the model space
+        rss = self.resid_norm - (proj[:, :rank] ** 2).sum(axis=1)
+        sigma2 = np.maximum(rss, 0) / self.dof
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tstat = np.where(sigma2 > 0,
+                             beta / np.sqrt(sigma2 * self.unscaled), 0.)
+        return t_to_z(tstat, self.dof)
+
+
+def _volume(values, mask_idx, shape):
+    out = np.zeros(int(np.prod(shape)))
+    out[mask_idx] = values
+    return out.reshape(shape)
+
+
+_WORKER = {}
+
+
+def _init_worker(state):
+    _WORKER.update(state)
+
+
+def _run_chunk(bounds):
+    state = _WORKER
+    model = state['model']
+    mask_idx, shape = state['mask_idx'], state['shape']
+    obs = state['observed']
+    start, stop = bounds
+    n_vox = len(mask_idx)
+    max_vox = []
+    max_cluster = []
+    max_tfce = []
+    count_vox = np.zeros(n_vox)
+    count_tfce = np.zeros(n_vox)
+    for first in range(start, stop, BATCH_SIZE):
+        last = min(first + BATCH_SIZE, stop)
+        zstats = np.abs(model.zstats(state['orders'][first:last],
+                                     state['signs'][first:last]))
+        for zstat in zstats:
+            max_vox.append(zstat.max())
+            count_vox += zstat >= obs['vox'] - 1e-10
+            if state['cluster_threshold'] is not None:
+                _, sizes = cluster_sizes(_volume(zstat, mask_idx, shape),
+                                         state['cluster_threshold'])
+                max_cluster.append(sizes.max() if sizes.size else 0)
+        if state['tfce'] is not None:
+            for enhanced in state['tfce'].tfce(zstats):
+                max_tfce.append(enhanced.max())
+                count_tfce += enhanced >= obs['tfce'] - 1e-10
+    return dict(max_vox=max_vox, max_cluster=max_cluster, max_tfce=max_tfce,
+                count_vox=count_vox, count_tfce=count_tfce)
+
+
+def fwe_pvalues(maxima, observed):
+    """Return the fraction of null maxima at least as large as observed"""
+    maxima = np.sort(np.asarray(maxima, dtype=np.float64))
+    below = np.searchsorted(maxima, np.asarray(observed) - 1e-10, side='left')
+    return (len(maxima) - below) / float(len(maxima))
+
+
+def fdr(pvals):
+    """Benjamini-Hochberg adjusted p values"""
+    pvals = np.asarray(pvals, dtype=np.float64)
+    order = np.argsort(pvals)
+    ranked = pvals[order] * len(pvals) / np.arange(1, len(pvals) + 1)
+    adjusted = np.minimum.accumulate(ranked[::-1])[::-1]
+    out = np.empty_like(pvals)
+    out[order] = np.minimum(adjusted, 1.)
+    return out
+
+
+def permutation_test(cope_file, design_file, contrast_file, mask_file,
+                     group_file=None, n_perm=5000, cluster_threshold=3.09,
+                     use_tfce=True, seed=0, n_procs=1, sign_flip=None,
+                     logp=True, out_dir=None):
+    """Run the permutation test of every contrast and write PALM style maps
+
+    Parameters
+    ----------
+    cope_file : str
+        4D image with one volume per subject (design row)
+    design_file, contrast_file, group_file : str
+        FSL VEST files as written by MultipleRegressDesign/L2Model; the
+        group file defines exchangeability blocks
+    n_perm : int
+        Number of shuffles including the unpermuted data
+    sign_flip : bool or None
+        Shuffle by sign flipping instead of permuting.  By default sign
+        flipping is used when a contrast tests a constant effect (e.g. a
+        group mean) or has no nuisance regressors, where permutations would
+        not change the statistic.
+
+    Returns the list of written files.
+    """
+    from multiprocessing import Pool
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    mask_img, mask_idx = load_mask(mask_file)
+    shape = mask_img.shape[:3]
+    data = masked_4d(cope_file, mask_idx)
+    design = read_vest(design_file)
+    contrasts = read_vest(contrast_file)
+    groups = read_vest(group_file) if group_file else None
+    if design.shape[0] != data.shape[0]:
+        raise ValueError('Design has %d rows but %s has %d volumes' %
+                         (design.shape[0], cope_file, data.shape[0]))
+    graph = None
+    if use_tfce:
+        mask = np.zeros(int(np.prod(shape)), dtype=bool)
+        mask[mask_idx] = True
+        graph = TFCEGraph(mask.reshape(shape))
+    out_files = []
+
+    def save(values, name, pvalue=False):
+        if pvalue and logp:
+            values = np.abs(np.log10(np.maximum(values, 1e-300)))
+        out_files.append(save_masked(values, mask_img, mask_idx,
+                                     os.path.join(out_dir, name + '.nii')))
+
+    for con_idx, contrast in enumerate(contrasts):
+        model = ContrastModel(design, contrast, data)
+        flip = sign_flip
+        if flip is None:
+            flip = model.sign_flip
+        orders, signs = make_shuffles(design.shape[0], n_perm, groups=groups,
+                                      sign_flip=flip, seed=seed + con_idx)
+        zstat = model.zstats(orders[:1], signs[:1])[0]
+        abs_z = np.abs(zstat)
+        volume = _volume(abs_z, mask_idx, shape)
+        observed = dict(vox=abs_z)
+        if graph is not None:
+            observed['tfce'] = graph.tfce(abs_z)
+        state = dict(model=model, mask_idx=mask_idx, shape=shape,
+                     observed=observed, orders=orders, signs=signs,
+                     cluster_threshold=cluster_threshold, tfce=graph)
+        chunk = max(BATCH_SIZE, int(np.ceil(n_perm / float(max(n_procs, 1) * 4))))
+        bounds = [(start, min(start + chunk, n_perm))
+                  for start in range(0, n_perm, chunk)]
+        if n_procs > 1:
+            pool = Pool(n_procs, initializer=_init_worker, initargs=(state,))
+            try:
+                results = pool.map(_run_chunk, bounds)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _init_worker(state)
+            results = [_run_chunk(val) for val in bounds]
+        max_vox = np.concatenate([res['max_vox'] for res in results])
+        count_vox = sum([res['count_vox'] for res in results])
+        suffix = '_c%d' % (con_idx + 1)
+        save(zstat, 'palm_vox_zstat' + suffix)
+        uncp = count_vox / float(n_perm)
+        save(uncp, 'palm_vox_zstat_uncp' + suffix, pvalue=True)
+        save(fwe_pvalues(max_vox, abs_z), 'palm_vox_zstat_fwep' + suffix,
+             pvalue=True)
+        save(fdr(uncp), 'palm_vox_zstat_fdrp' + suffix, pvalue=True)
+        if cluster_threshold is not None:
+            max_cluster = np.concatenate([res['max_cluster']
+                                          for res in results])
+            extent, _ = cluster_sizes(volume, cluster_threshold)
+            extent = extent.reshape(-1)[mask_idx]
+            save(extent, 'palm_clustere_zstat' + suffix)
+            fwep = np.where(extent > 0, fwe_pvalues(max_cluster, extent), 1.)
+            save(fwep, 'palm_clustere_zstat_fwep' + suffix, pvalue=True)
+        if use_tfce:
+            max_tfce = np.concatenate([res['max_tfce'] for res in results])
+            count_tfce = sum([res['count_tfce'] for res in results])
+            save(observed['tfce'], 'palm_tfce_zstat' + suffix)
+            uncp = count_tfce / float(n_perm)
+            save(uncp, 'palm_tfce_zstat_uncp' + suffix, pvalue=True)
+            save(fwe_pvalues(max_tfce, observed['tfce']),
+                 'palm_tfce_zstat_fwep' + suffix, pvalue=True)
+            save(fdr(uncp), 'palm_tfce_zstat_fdrp' + suffix, pvalue=True)
+    return out_files
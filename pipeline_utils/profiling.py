@@ -0,0 +1,355 @@
+"""
+Per-node profiling of workflow runs.
+
+``--profile`` turns on nipype's resource monitor and installs a
+``status_callback`` that records every node execution: wall time, CPU time,
+peak RSS and the bytes read from inputs and written to the node directory.
+After the run :meth:`RunProfiler.write` saves, in ``<work_dir>/profile``::
+
+    <workflow>_<timestamp>_<pid>.json   executions, template graph, summary
+    <workflow>_<timestamp>_<pid>.csv    one row per execution
+    <workflow>_<timestamp>_<pid>.html   Gantt style timeline
+
+Executions are also aggregated per template node, i.e. the node of the
+workflow definition independent of the subject/run iterables, and the
+critical path is the longest chain of template nodes weighted by their
+slowest execution.  Profiles of several runs (e.g. one per array task) can
+be combined with::
+
+    python -m pipeline_utils.profiling work/profile/*.json
+"""
+
+from __future__ import print_function
+
+import csv
+from datetime import datetime
+import json
+import os
+import time
+
+FIELDS = ['node', 'template', 'start', 'end', 'wall_s', 'cpu_s',
+          'peak_rss_gb', 'read_bytes', 'write_bytes', 'cached', 'status']
+
+
+def enable_resource_monitor():
+    """Turn on nipype's resource monitor if this nipype provides one"""
+    from nipype import config
+    if hasattr(config, 'enable_resource_monitor'):
+        config.enable_resource_monitor()
+    else:
+        config.set('execution', 'resource_monitor', 'true')
+
+
+def template_name(node):
+    """Return the dotted name of node in the workflow definition"""
+    hierarchy = getattr(node, '_hierarchy', None)
+    if hierarchy:
+        return '%s.%s' % (hierarchy, node.name)
+    return node.name
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    for fmt in ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            stamp = datetime.strptime(str(value), fmt)
+        except ValueError:
+            continue
+        return (stamp - datetime(1970, 1, 1)).total_seconds()
+    return None
+
+
+def _runtimes(node):
+    try:
+        runtime = node.result.runtime
+    except Exception:
+        return []
+    if runtime is None:
+        return []
+    if isinstance(runtime, list):
+        return [val for val in runtime if val is not None]
+    return [runtime]
+
+
+def _file_bytes(value):
+    total = 0
+    if isinstance(value, (list, tuple)):
+        for val in value:
+            total += _file_bytes(val)
+    elif isinstance(value, dict):
+        for val in value.values():
+            total += _file_bytes(val)
+    elif isinstance(value, str) and os.path.isfile(value):
+        total += os.path.getsize(value)
+    return total
+
+
+def _dir_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            filename = os.path.join(root, filename)
+            if not os.path.islink(filename):
+                total += os.path.getsize(filename)
+    return total
+
+
+class RunProfiler(object):
+    """Record node executions through the plugin status callback
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory for the JSON/CSV/HTML reports
+    name : str
+        Prefix of the report files (usually the workflow name)
+    """
+
+    def __init__(self, out_dir, name):
+        self.out_dir = out_dir
+        self.name = name
+        self.started = time.time()
+        self.records = []
+        self._starts = {}
+        self._callback = None
+
+    def install(self, plugin_args):
+        """Enable the resource monitor and hook into plugin_args
+
+        An existing ``status_callback`` keeps being called.
+        """
+        enable_resource_monitor()
+        self._callback = plugin_args.get('status_callback')
+        plugin_args['status_callback'] = self
+        return plugin_args
+
+    def __call__(self, node, status):
+        if self._callback is not None:
+            self._callback(node, status)
+        if status == 'start':
+            self._starts[id(node)] = time.time()
+        elif status in ['end', 'exception']:
+            self.records.append(self._record(node, status))
+
+    def _record(self, node, status):
+        now = time.time()
+        start = self._starts.pop(id(node), now)
+        record = dict(node=getattr(node, 'itername', node.name),
+                      template=template_name(node), start=start, end=now,
+                      wall_s=now - start, cpu_s=None, peak_rss_gb=None,
+                      read_bytes=None, write_bytes=None, cached=False,
+                      status=status)
+        runtimes = _runtimes(node) if status == 'end' else []
+        if runtimes:
+            starts = [_parse_time(getattr(rt, 'startTime', None))
+                      for rt in runtimes]
+            ends = [_parse_time(getattr(rt, 'endTime', None))
+                    for rt in runtimes]
+            starts = [val for val in starts if val is not None]
+            ends = [val for val in ends if val is not None]
+            if starts and ends:
+                record['start'] = min(starts)
+                record['end'] = max(ends)
+                record['wall_s'] = max(ends) - min(starts)
+                # results of a previous run were reused
+                record['cached'] = max(ends) < self.started
+            cpu = [getattr(rt, 'duration', 0) *
+                   getattr(rt, 'cpu_percent', 0) / 100.
+                   for rt in runtimes if hasattr(rt, 'cpu_percent')]
+            if cpu:
+                record['cpu_s'] = sum(cpu)
+            mem = [getattr(rt, 'mem_peak_gb') for rt in runtimes
+                   if getattr(rt, 'mem_peak_gb', None) is not None]
+            if mem:
+                record['peak_rss_gb'] = max(mem)
+        try:
+            record['read_bytes'] = _file_bytes(node.inputs.get())
+            record['write_bytes'] = _dir_bytes(node.output_dir())
+        except Exception:
+            pass
+        return record
+
+    def write(self, execgraph=None):
+        """Write the reports and return the path of the JSON report"""
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        edges = []
+        if execgraph is not None:
+            edges = sorted(set([(template_name(src), template_name(dst))
+                                for src, dst in execgraph.edges()]))
+        prefix = os.path.join(self.out_dir, '%s_%s_%d' % (
+            self.name, time.strftime('%Y%m%d-%H%M%S',
+                                     time.localtime(self.started)),
+            os.getpid()))
+        profile = dict(name=self.name, started=self.started,
+                       records=self.records, edges=edges)
+        profile['summary'] = summarize([profile])
+        with open(prefix + '.json', 'wt') as fp:
+            json.dump(profile, fp, indent=1)
+        write_csv(self.records, prefix + '.csv')
+        write_gantt(self.records, prefix + '.html', title=self.name)
+        return prefix + '.json'
+
+
+def write_csv(records, filename):
+    with open(filename, 'wt') as fp:
+        writer = csv.DictWriter(fp, fieldnames=FIELDS)
+        writer.writeheader()
+        for record in sorted(records, key=lambda rec: rec['start']):
+            writer.writerow(dict([(key, record.get(key)) for key in FIELDS]))
+
+
+def summarize(profiles):
+    """Aggregate executions per template node and find the critical path
+
+    ``profiles`` are loaded JSON reports, e.g. one per subject.
+    """
+    nodes = {}
+    edges = set()
+    for profile in profiles:
+        edges.update([tuple(edge) for edge in profile.get('edges', [])])
+        for record in profile['records']:
+            if record['cached'] or record['status'] != 'end':
+                continue
+            stats = nodes.setdefault(record['template'], dict(
+                count=0, total_wall_s=0., max_wall_s=0., total_cpu_s=0.,
+                max_rss_gb=None, read_bytes=0, write_bytes=0))
+            stats['count'] += 1
+            stats['total_wall_s'] += record['wall_s']
+            stats['max_wall_s'] = max(stats['max_wall_s'], record['wall_s'])
+            stats['total_cpu_s'] += record['cpu_s'] or 0.
+            if record['peak_rss_gb'] is not None:
+                stats['max_rss_gb'] = max(stats['max_rss_gb'] or 0.,
+                                          record['peak_rss_gb'])
+            stats['read_bytes'] += record['read_bytes'] or 0
+            stats['write_bytes'] += record['write_bytes'] or 0
+    for stats in nodes.values():
+        stats['mean_wall_s'] = stats['total_wall_s'] / stats['count']
+    path, length = critical_path(
+        dict([(key, val['max_wall_s']) for key, val in nodes.items()]), edges)
+    return dict(nodes=nodes, critical_path=path, critical_path_s=length)
+
+
+def critical_path(weights, edges):
+    """Return the heaviest path through the DAG given by edges"""
+    children = {}
+    parents = {}
+    for src, dst in edges:
+        if src == dst:
+            continue
+        children.setdefault(src, set()).add(dst)
+        parents.setdefault(dst, set()).add(src)
+    names = set(weights) | set(children) | set(parents)
+    # Kahn's algorithm
+    indegree = dict([(name, len(parents.get(name, ()))) for name in names])
+    order = [name for name in sorted(names) if not indegree[name]]
+    for name in order:
+        for child in sorted(children.get(name, ())):
+            indegree[child] -= 1
+            if not indegree[child]:
+                order.append(child)
+    best = {}
+    previous = {}
+    for name in order:
+        incoming = [(best[parent], parent) for parent in parents.get(name, ())
+                    if parent in best]
+        base, parent = max(incoming) if incoming else (0., None)
+        best[name] = base + weights.get(name, 0.)
+        previous[name] = parent
+    if not best:
+        return [], 0.
+    name = max(best, key=lambda key: best[key])
+    length = best[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], length
+
+
+GANTT_HTML = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(title)s</title>
+<style>
+body { font-family: sans-serif; font-size: 12px; }
+.lane { position: relative; height: 18px; border-bottom: 1px solid #eee; }
+.job { position: absolute; height: 16px; overflow: hidden;
+       white-space: nowrap; color: #fff; border-radius: 2px; }
+</style></head><body>
+<h3>%(title)s: %(count)d executions, %(span).1f s</h3>
+<div style="width: %(width)dpx">
+%(lanes)s
+</div></body></html>
+"""
+
+
+def write_gantt(records, filename, title='profile', width=1600):
+    """Write a self contained HTML timeline, one lane per concurrent job"""
+    records = sorted([rec for rec in records if not rec['cached']],
+                     key=lambda rec: rec['start'])
+    lanes = []
+    if records:
+        origin = min([rec['start'] for rec in records])
+        span = max(max([rec['end'] for rec in records]) - origin, 1e-6)
+    else:
+        origin, span = 0., 0.
+    for record in records:
+        for lane in lanes:
+            if lane[-1]['end'] <= record['start']:
+                lane.append(record)
+                break
+        else:
+            lanes.append([record])
+    html_lanes = []
+    for lane in lanes:
+        jobs = []
+        for record in lane:
+            hue = sum([ord(char) for char in record['template']]) % 360
+            jobs.append(
+                '<div class="job" title="%s: %.1f s" style="left: %.1fpx; '
+                'width: %.1fpx; background: hsl(%d, 60%%, 45%%)">%s</div>' %
+                (record['node'], record['wall_s'],
+                 (record['start'] - origin) / span * width,
+                 max(record['end'] - record['start'], 0) / span * width, hue,
+                 record['template'].split('.')[-1]))
+        html_lanes.append('<div class="lane">%s</div>' % ''.join(jobs))
+    with open(filename, 'wt') as fp:
+        fp.write(GANTT_HTML % dict(title=title, count=len(records), span=span,
+                                   width=width, lanes='\n'.join(html_lanes)))
+
+
+def format_summary(summary, top=20):
+    lines = ['%-60s %6s %10s %10s %10s' % ('node', 'count', 'mean_s',
+                                           'max_s', 'max_gb')]
+    nodes = sorted(summary['nodes'].items(),
+                   key=lambda item: -item[1]['total_wall_s'])
+    for name, stats in nodes[:top]:
+        lines.append('%-60s %6d %10.1f %10.1f %10s' % (
+            name[-60:], stats['count'], stats['mean_wall_s'],
+            stats['max_wall_s'],
+            '-' if stats['max_rss_gb'] is None else
+            '%.2f' % stats['max_rss_gb']))
+    lines.append('')
+    lines.append('critical path (%.1f s):' % summary['critical_path_s'])
+    lines.extend(['  ' + name for name in summary['critical_path']])
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Aggregate profile reports')
+    parser.add_argument('profiles', nargs='+', help='JSON profile reports')
+    parser.add_argument('-o', '--output', dest='output',
+                        help='Write the aggregate summary as JSON')
+    args = parser.parse_args()
+    profiles = []
+    for filename in args.profiles:
+        with open(filename, 'rt') as fp:
+            profiles.append(json.load(fp))
+    summary = summarize(profiles)
+    print(format_summary(summary))
+    if args.output:
+        with open(args.output, 'wt') as fp:
+            json.dump(summary, fp, indent=1)
@@ -0,0 +1,116 @@
+"""
+Progress reports of workflows made of many independent sub-workflows.
+
+The group scripts add one sub-workflow per task/contrast to a meta
+workflow.  :class:`GroupProgress` is a plugin ``status_callback`` that
+counts finished, running and failed nodes per sub-workflow and prints a
+line when a sub-workflow completes or fails and, at most every
+``interval`` seconds, an overall summary::
+
+    [mult_regress 00:42:10] 7/36 groups done, 31 running, 0 failed
+    [mult_regress 00:42:15] model_001_task_001_contrast_age: done (84 nodes)
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+from .profiling import template_name
+
+
+def group_name(node, root=None):
+    """Return the sub-workflow of node directly below the root workflow
+
+    Nodes of the root workflow itself are their own group.
+    """
+    parts = template_name(node).split('.')
+    if root is not None and parts[0] == root:
+        parts = parts[1:]
+    return parts[0]
+
+
+def expected_nodes(execgraph, root=None):
+    """Return {group: number of nodes} of an expanded execution graph
+
+    execgraph is the graph the plugin runs (``graphcache.expand_workflow``
+    and ``run_expanded``), so the workflow is only expanded once.
+    """
+    totals = {}
+    for node in execgraph.nodes():
+        key = group_name(node, root)
+        totals[key] = totals.get(key, 0) + 1
+    return totals
+
+
+class GroupProgress(object):
+    """Count node executions per sub-workflow through the status callback
+
+    Parameters
+    ----------
+    name : str
+        Name of the root workflow
+    totals : dict or None
+        Expected number of nodes per group (see :func:`expected_nodes`);
+        without it groups are only reported when they fail
+    interval : float
+        Minimum number of seconds between two summary lines
+    """
+
+    def __init__(self, name, totals=None, interval=60., stream=None):
+        self.name = name
+        self.totals = totals or {}
+        self.interval = interval
+        self.stream = stream or sys.stdout
+        self.started = time.time()
+        self.last_report = 0.
+        self.done = {}
+        self.running = {}
+        self.failed = {}
+        self._callback = None
+
+    def install(self, plugin_args):
+        """Hook into plugin_args, chaining an existing status_callback"""
+        self._callback = plugin_args.get('status_callback')
+        plugin_args['status_callback'] = self
+        return plugin_args
+
+    def _print(self, message):
+        elapsed = int(time.time() - self.started)
+        print('[%s %02d:%02d:%02d] %s' % (
+            self.name, elapsed // 3600, elapsed // 60 % 60, elapsed % 60,
+            message), file=self.stream)
+        self.stream.flush()
+
+    def __call__(self, node, status):
+        if self._callback is not None:
+            self._callback(node, status)
+        key = group_name(node, self.name)
+        if status == 'start':
+            self.running[key] = self.running.get(key, 0) + 1
+            return
+        if status not in ['end', 'exception']:
+            return
+        self.running[key] = max(self.running.get(key, 0) - 1, 0)
+        if status == 'exception':
+            self.failed[key] = self.failed.get(key, 0) + 1
+            self._print('%s: node %s failed' % (
+                key, getattr(node, 'itername', node.name)))
+        else:
+            self.done[key] = self.done.get(key, 0) + 1
+            if self.done[key] == self.totals.get(key):
+                self._print('%s: done (%d nodes)' % (key, self.done[key]))
+        if time.time() - self.last_report >= self.interval:
+            self.last_report = time.time()
+            self._print(self.summary())
+
+    def summary(self):
+        complete = len([key for key, total in self.totals.items()
+                        if self.done.get(key, 0) >= total])
+        running = len([key for key, count in self.running.items() if count])
+        failed = len([key for key, count in self.failed.items() if count])
+        if self.totals:
+            return '%d/%d groups done, %d running, %d failed' % (
+                complete, len(self.totals), running, failed)
+        return '%d nodes done, %d groups running, %d failed' % (
+            sum(self.done.values()), running, failed)
@@ -0,0 +1,121 @@
+"""
+Per-run quality measures of the subject level pipeline from one read.
+
+The subject workflow ran nipype's TSNR, a median node over the detrended
+series and ArtifactDetect on the realigned runs, and each of them read
+every run again.  :func:`run_qa` reads each run once through
+:func:`pipeline_utils.tsnr.compute_tsnr`, which also returns the global
+intensity of every volume, and writes the outputs of all three:
+
+``tsnr.nii.gz``, ``mean.nii.gz``, ``stdev.nii.gz``, ``median.nii.gz``
+    as :func:`pipeline_utils.tsnr.compute_tsnr`
+``global_intensity.<run>.txt``, ``norm.<run>.txt``, ``art.<run>_outliers.txt``
+    as ArtifactDetect with ``mask_type='file'``, ``use_norm=True`` and
+    ``use_differences=[True, False]``: the intensity z scores are computed
+    on the linearly detrended global signal and the motion norm by nipype's
+    own ``_calc_norm``
+
+and the average of the per-run median images (``median.nii.gz``).
+"""
+
+import os
+
+import numpy as np
+
+def intensity_outliers(intensity, zintensity_threshold=3,
+                       use_difference=False):
+    """Return the volumes whose global intensity z score exceeds threshold"""
+    from scipy import signal
+    gz = signal.detrend(np.asarray(intensity, dtype=np.float64)[:, None],
+                        axis=0)
+    if use_difference:
+        gz = np.concatenate((np.zeros((1, 1)), np.diff(gz, n=1, axis=0)),
+                            axis=0)
+    gz = (gz - np.mean(gz)) / np.std(gz)
+    return np.flatnonzero(np.abs(gz) > zintensity_threshold)
+
+
+def motion_outliers(motion_file, norm_threshold=1, use_difference=True,
+                    parameter_source='FSL'):
+    """Return (norm of the motion, volumes whose norm exceeds threshold)"""
+    from nipype.algorithms.rapidart import _calc_norm
+    motion = np.loadtxt(motion_file)
+    normval, _ = _calc_norm(motion, use_difference, parameter_source)
+    normval = np.asarray(normval).ravel()
+    outliers = np.union1d(np.flatnonzero(normval > norm_threshold),
+                          np.flatnonzero(normval < 0))
+    return normval, outliers
+
+
+def art_files(in_file, intensity, motion_file, out_dir,
+              norm_threshold=1, zintensity_threshold=3,
+              use_differences=(True, False), parameter_source='FSL'):
+    """Write ArtifactDetect's intensity, norm and outlier files of a run"""
+    from .layout import split_ext
+    name = os.path.basename(in_file)
+    name = name[:len(name) - len(split_ext(name))]
+    out = dict(
+        intensity_file=os.path.join(out_dir, 'global_intensity.%s.txt' %
+                                    name),
+        norm_file=os.path.join(out_dir, 'norm.%s.txt' % name),
+        outlier_file=os.path.join(out_dir, 'art.%s_outliers.txt' % name))
+    normval, outliers = motion_outliers(motion_file, norm_threshold,
+                                        use_differences[0], parameter_source)
+    outliers = np.unique(np.union1d(
+        intensity_outliers(intensity, zintensity_threshold,
+                           use_differences[1]), outliers))
+    np.savetxt(out['intensity_file'], intensity, fmt='%.2f', delimiter=' ')
+    np.savetxt(out['norm_file'], normval, fmt='%.4f', delimiter=' ')
+    np.savetxt(out['outlier_file'], outliers, fmt='%d', delimiter=' ')
+    return out
+
+
+def run_qa(realigned_files, realignment_parameters, mask_files,
+           regress_poly=2, norm_threshold=1, zintensity_threshold=3,
+           out_dir=None):
+    """Compute TSNR, medians and artifact files of every run in one read
+
+    The outputs of run ``i`` are written to ``<out_dir>/_qa<i>``, like the
+    directories of a MapNode, so that DataSink substitutions can name them
+    by run.  Returns a dictionary of per-run lists plus ``median_file``.
+    """
+    from .tsnr import average_images, compute_tsnr
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    keys = ['tsnr_file', 'median_file', 'intensity_file', 'norm_file',
+            'outlier_file']
+    outputs = dict([(key + 's', []) for key in keys])
+    for idx, in_file in enumerate(realigned_files):
+        run_dir = os.path.join(out_dir, '_qa%d' % idx)
+        if not os.path.exists(run_dir):
+            os.makedirs(run_dir)
+        res = compute_tsnr(in_file, regress_poly=regress_poly,
+                           detrended=False, out_dir=run_dir,
+                           mask_file=mask_files[idx])
+        res.update(art_files(in_file, res['global_intensity'],
+                             realignment_parameters[idx], run_dir,
+                             norm_threshold=norm_threshold,
+                             zintensity_threshold=zintensity_threshold))
+        for key in keys:
+            outputs[key + 's'].append(res.get(key))
+    cwd = os.getcwd()
+    try:
+        os.chdir(out_dir)
+        outputs['median_file'] = average_images(outputs['median_files'])
+    finally:
+        os.chdir(cwd)
+    return outputs
+
+
+def qa_node(realigned_files, realignment_parameters, mask_files,
+            regress_poly, norm_threshold, zintensity_threshold):
+    """nipype Function wrapper of run_qa"""
+    from pipeline_utils.qa import run_qa
+    from nipype.utils.filemanip import filename_to_list
+    out = run_qa(filename_to_list(realigned_files),
+                 filename_to_list(realignment_parameters),
+                 filename_to_list(mask_files), regress_poly=regress_poly,
+                 norm_threshold=norm_threshold,
+                 zintensity_threshold=zintensity_threshold)
+    return (out['tsnr_files'], out['median_files'],
+            out['median_file'], out['intensity_files'], out['norm_files'],
+            out['outlier_files'])
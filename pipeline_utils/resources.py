@@ -0,0 +1,207 @@
+"""
+Plugin arguments and per-node resource requests.
+
+``--plugin_args`` used to be passed through ``eval``.  :func:`parse_plugin_args`
+only accepts literals: a JSON object, a Python dict literal or a
+``dict(key=value, ...)`` call whose values are literals.
+
+Resource requests (CPUs, memory, partition) live in a JSON or YAML file
+instead of being hardcoded on nodes::
+
+    {
+        "default": {"partition": "om_all_nodes"},
+        "nodes": [
+            {"match": "*antsRegister", "cpus": 4, "mem": "6G"},
+            {"match": "*tsnr", "cpus": 4, "mem": "16G"}
+        ]
+    }
+
+``match`` is a shell style pattern applied to the dotted path of each node
+below the top level workflow (``registration.antsRegister``) and to its
+name.  Rules are applied in order, later rules overriding earlier ones.
+Each script loads the ``resources.json`` next to it unless ``--resources``
+names another file.
+"""
+
+import ast
+from fnmatch import fnmatchcase
+import json
+import os
+import re
+
+RESOURCE_KEYS = ['cpus', 'mem', 'partition', 'time', 'sbatch_extra',
+                 'qsub_extra', 'overwrite']
+
+
+def parse_plugin_args(value):
+    """Return the plugin arguments given on the command line as a dict
+
+    Examples
+    --------
+
+    >>> parse_plugin_args('{"sbatch_args": "-p om_all_nodes"}')
+    {'sbatch_args': '-p om_all_nodes'}
+    >>> parse_plugin_args("dict(qsub_args='-q many')")
+    {'qsub_args': '-q many'}
+    """
+    if not value:
+        return {}
+    try:
+        out = json.loads(value)
+    except ValueError:
+        try:
+            tree = ast.parse(value.strip(), mode='eval').body
+        except SyntaxError:
+            raise ValueError('Cannot parse plugin arguments: %s' % value)
+        if isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name) and \
+                tree.func.id == 'dict' and not tree.args:
+            out = dict([(kwarg.arg, _literal(kwarg.value, value))
+                        for kwarg in tree.keywords])
+        else:
+            out = _literal(tree, value)
+    if not isinstance(out, dict):
+        raise ValueError('Plugin arguments must be a dictionary: %s' % value)
+    return out
+
+
+def _literal(node, value):
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise ValueError('Plugin arguments may only contain literals: %s' %
+                         value)
+
+
+def default_resource_file(script):
+    """Return the resources.json next to script"""
+    return os.path.join(os.path.dirname(os.path.abspath(script)),
+                        'resources.json')
+
+
+def load_resource_config(filename):
+    """Load and validate a JSON or YAML resource file"""
+    with open(filename, 'rt') as fp:
+        if os.path.splitext(filename)[1].lower() in ['.yml', '.yaml']:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('PyYAML is required to read %s' % filename)
+            config = yaml.safe_load(fp)
+        else:
+            config = json.load(fp)
+    config = config or {}
+    if not isinstance(config, dict):
+        raise ValueError('%s must contain a mapping' % filename)
+    unknown = set(config.keys()) - set(['default', 'nodes'])
+    if unknown:
+        raise ValueError('Unknown sections in %s: %s' %
+                         (filename, ', '.join(sorted(unknown))))
+    _check_resources(config.get('default') or {}, filename)
+    for rule in config.get('nodes') or []:
+        if 'match' not in rule:
+            raise ValueError('Node rule without "match" in %s' % filename)
+        _check_resources(dict([(key, val) for key, val in rule.items()
+                               if key != 'match']), filename)
+    return config
+
+
+def _check_resources(resources, filename):
+    unknown = set(resources.keys()) - set(RESOURCE_KEYS)
+    if unknown:
+        raise ValueError('Unknown resource keys in %s: %s' %
+                         (filename, ', '.join(sorted(unknown))))
+    if 'mem' in resources:
+        mem_to_gb(resources['mem'])
+
+
+def mem_to_gb(mem):
+    """Return a SLURM style memory request (``6G``, ``500M``) in GB"""
+    if isinstance(mem, (int, float)):
+        return float(mem)
+    match = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)B?\s*$', str(mem), re.I)
+    if match is None:
+        raise ValueError('Invalid memory request: %s' % mem)
+    scale = {'K': 1. / 1024 ** 2, 'M': 1. / 1024, '': 1., 'G': 1.,
+             'T': 1024.}[match.group(2).upper()]
+    return float(match.group(1)) * scale
+
+
+def node_resources(config, path):
+    """Return the resources of the node at dotted path"""
+    resources = dict(config.get('default') or {})
+    name = path.split('.')[-1]
+    for rule in config.get('nodes') or []:
+        if fnmatchcase(path, rule['match']) or fnmatchcase(name, rule['match']):
+            resources.update([(key, val) for key, val in rule.items()
+                              if key != 'match'])
+    return resources
+
+
+def resources_to_plugin_args(resources):
+    """Translate resources into node plugin_args for SLURM and SGE/PBS"""
+    sbatch_args = []
+    qsub_args = []
+    if resources.get('partition'):
+        sbatch_args.append('-p %s' % resources['partition'])
+    if resources.get('sbatch_extra'):
+        sbatch_args.append(resources['sbatch_extra'])
+    if resources.get('mem'):
+        sbatch_args.append('--mem=%s' % resources['mem'])
+    if resources.get('time'):
+        sbatch_args.append('--time=%s' % resources['time'])
+    if resources.get('cpus', 1) > 1:
+        sbatch_args.append('-c %d' % resources['cpus'])
+        qsub_args.append('-pe orte %d' % resources['cpus'])
+    if resources.get('qsub_extra'):
+        qsub_args.append(resources['qsub_extra'])
+    plugin_args = {}
+    if sbatch_args:
+        plugin_args['sbatch_args'] = ' '.join(sbatch_args)
+    if qsub_args:
+        plugin_args['qsub_args'] = ' '.join(qsub_args)
+    if plugin_args and resources.get('overwrite'):
+        plugin_args['overwrite'] = True
+    return plugin_args
+
+
+def iter_nodes(workflow, prefix=''):
+    """Yield (dotted path, node) for every node below workflow"""
+    from nipype.pipeline.engine import Workflow
+    for node in workflow._graph.nodes():
+        path = prefix + node.name
+        if isinstance(node, Workflow):
+            for item in iter_nodes(node, path + '.'):
+                yield item
+        else:
+            yield path, node
+
+
+def apply_resources(workflow, config):
+    """Set plugin_args, n_procs and mem_gb of every node from config
+
+    Returns the list of (path, plugin_args) that were set.
+    """
+    applied = []
+    for path, node in iter_nodes(workflow):
+        resources = node_resources(config, path)
+        if not resources:
+            continue
+        if not resources.get('cpus') and getattr(node, 'n_procs', 1) > 1:
+            # a node sizing its own processes requests them from the queue
+            resources = dict(resources, cpus=node.n_procs)
+        plugin_args = resources_to_plugin_args(resources)
+        if plugin_args:
+            node.plugin_args = dict(node.plugin_args or {}, **plugin_args)
+            applied.append((path, plugin_args))
+        # hints for the MultiProc scheduler
+        if resources.get('cpus'):
+            node.n_procs = resources['cpus']
+        if resources.get('mem'):
+            # mem_gb is a read-only property of nipype's Node, which reads
+            # _mem_gb; older nipype reads the estimate of the interface
+            if isinstance(getattr(type(node), 'mem_gb', None), property):
+                node._mem_gb = mem_to_gb(resources['mem'])
+            else:
+                node.interface.estimated_memory_gb = mem_to_gb(
+                    resources['mem'])
+    return applied
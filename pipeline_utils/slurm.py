@@ -0,0 +1,233 @@
+"""
+Per-subject job arrays.
+
+Running a subject level script with ``-p SLURM`` submits one sbatch job for
+every node of every subject and polls each of them.  In array mode the
+driver instead writes one bash script that reruns the same command line for
+a single subject with the MultiProc plugin, and submits it once as a job
+array with one task per subject::
+
+    python fmri_ants_bids.py -d ds -o out -w work --job_array slurm \\
+        --array_cpus 4 --array_mem 16G
+
+Every subject's subgraph still caches in the shared working directory, so
+array tasks can be resubmitted and rerun like a normal run.
+
+:class:`LocalArrayScheduler` implements the same interface on the local
+filesystem: it runs the tasks as subprocesses and keeps their state and
+logs in a spool directory, which is enough to test the array script
+without a cluster.
+"""
+
+import os
+import re
+from subprocess import Popen, check_output, STDOUT
+import stat
+import sys
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+ARRAY_OPTIONS = ['job_array', 'array_cpus', 'array_mem', 'array_sbatch_args',
+                 'max_array_tasks']
+
+
+def add_array_arguments(parser):
+    """Add the job array options to a subject level argument parser"""
+    defstr = ' (default %(default)s)'
+    parser.add_argument("--job_array", dest="job_array", default=None,
+                        choices=('slurm', 'local'),
+                        help=("Submit one array task per subject running its "
+                              "workflow with MultiProc instead of running "
+                              "the workflow here"))
+    parser.add_argument("--array_cpus", dest="array_cpus", default=4, type=int,
+                        help="CPUs of each array task" + defstr)
+    parser.add_argument("--array_mem", dest="array_mem", default='16G',
+                        help="Memory of each array task" + defstr)
+    parser.add_argument("--array_sbatch_args", dest="array_sbatch_args",
+                        default='',
+                        help="Additional sbatch arguments (e.g. '-p om_all_nodes')")
+    parser.add_argument("--max_array_tasks", dest="max_array_tasks",
+                        default=None, type=int,
+                        help="Maximum number of array tasks running at once")
+
+
+def namespace_to_argv(parser, args, skip=None, overrides=None):
+    """Rebuild a command line from parsed arguments
+
+    Options in ``skip`` are left out and ``overrides`` replaces the value of
+    the given destinations.  Positional arguments are not supported.
+    """
+    skip = set(skip or [])
+    overrides = overrides or {}
+    argv = []
+    for action in parser._actions:
+        if not action.option_strings or action.dest in skip or \
+                action.dest == 'help':
+            continue
+        value = overrides.get(action.dest, getattr(args, action.dest, None))
+        flag = action.option_strings[-1]
+        if action.const is not None and action.nargs == 0:
+            # store_true / store_false / store_const
+            if value == action.const and value != action.default:
+                argv.append(flag)
+            continue
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            if not value:
+                continue
+            argv.append(flag)
+            argv.extend([str(val) for val in value])
+        else:
+            argv.extend([flag, str(value)])
+    return argv
+
+
+def write_array_script(filename, script, argv, subjects, subject_flag='-s'):
+    """Write a bash script running script for subject $SLURM_ARRAY_TASK_ID"""
+    lines = ['#!/bin/bash',
+             'SUBJECTS=(%s)' % ' '.join([quote(subj) for subj in subjects]),
+             'SUBJECT=${SUBJECTS[$SLURM_ARRAY_TASK_ID]}',
+             'exec %s %s %s %s "$SUBJECT"' % (
+                 quote(sys.executable), quote(os.path.abspath(script)),
+                 ' '.join([quote(arg) for arg in argv]), subject_flag),
+             '']
+    with open(filename, 'wt') as fp:
+        fp.write('\n'.join(lines))
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+    return filename
+
+
+class SlurmArrayScheduler(object):
+    """Submit array scripts with sbatch and query them with sacct"""
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+
+    def submit(self, script, n_tasks, cpus=1, mem=None, sbatch_args='',
+               max_parallel=None):
+        array = '0-%d' % (n_tasks - 1)
+        if max_parallel:
+            array += '%%%d' % max_parallel
+        cmd = ['sbatch', '--parsable', '--array=%s' % array,
+               '-c', str(cpus),
+               '-o', os.path.join(self.log_dir, 'slurm-%A_%a.out')]
+        if mem:
+            cmd.append('--mem=%s' % mem)
+        cmd.extend(sbatch_args.split())
+        cmd.append(script)
+        out = check_output(cmd, stderr=STDOUT).decode()
+        return out.strip().split(';')[0]
+
+    def status(self, job_id):
+        """Return the state of every array task as {task_id: state}"""
+        out = check_output(['sacct', '-j', job_id, '-n', '-P', '-X',
+                            '--format=JobID,State']).decode()
+        states = {}
+        for line in out.splitlines():
+            match = re.match(r'^\d+_(\d+)\|(\S+)', line)
+            if match:
+                states[int(match.group(1))] = match.group(2)
+        return states
+
+
+class LocalArrayScheduler(object):
+    """Filesystem based stand-in for SLURM job arrays
+
+    Each job gets a directory in ``spool_dir`` holding one ``.state`` file
+    (PENDING, RUNNING, COMPLETED or FAILED) and one ``.out`` log per task.
+    ``submit`` runs up to ``max_parallel`` tasks at a time and returns
+    once all of them finished.
+    """
+
+    def __init__(self, spool_dir, poll_interval=0.5):
+        self.spool_dir = spool_dir
+        self.poll_interval = poll_interval
+
+    def _job_dir(self, job_id):
+        return os.path.join(self.spool_dir, job_id)
+
+    def _set_state(self, job_id, task_id, state):
+        with open(os.path.join(self._job_dir(job_id),
+                               '%d.state' % task_id), 'wt') as fp:
+            fp.write(state)
+
+    def submit(self, script, n_tasks, cpus=1, mem=None, sbatch_args='',
+               max_parallel=None):
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        job_id = str(len(os.listdir(self.spool_dir)) + 1)
+        os.makedirs(self._job_dir(job_id))
+        for task_id in range(n_tasks):
+            self._set_state(job_id, task_id, 'PENDING')
+        pending = list(range(n_tasks))
+        running = {}
+        while pending or running:
+            while pending and (not max_parallel or
+                               len(running) < max_parallel):
+                task_id = pending.pop(0)
+                env = dict(os.environ, SLURM_ARRAY_JOB_ID=job_id,
+                           SLURM_ARRAY_TASK_ID=str(task_id),
+                           SLURM_CPUS_PER_TASK=str(cpus))
+                log = open(os.path.join(self._job_dir(job_id),
+                                        '%d.out' % task_id), 'wt')
+                running[task_id] = (Popen(['bash', script], env=env,
+                                          stdout=log, stderr=STDOUT), log)
+                self._set_state(job_id, task_id, 'RUNNING')
+            for task_id, (proc, log) in list(running.items()):
+                if proc.poll() is None:
+                    continue
+                log.close()
+                self._set_state(job_id, task_id,
+                                'COMPLETED' if proc.returncode == 0
+                                else 'FAILED')
+                del running[task_id]
+            if running:
+                time.sleep(self.poll_interval)
+        return job_id
+
+    def status(self, job_id):
+        """Return the state of every array task as {task_id: state}"""
+        states = {}
+        for filename in os.listdir(self._job_dir(job_id)):
+            if filename.endswith('.state'):
+                with open(os.path.join(self._job_dir(job_id), filename)) as fp:
+                    states[int(filename.split('.')[0])] = fp.read().strip()
+        return states
+
+
+def submit_subject_array(parser, args, script, subjects, work_dir,
+                         overrides=None):
+    """Submit one array task per subject and return (scheduler, job id)
+
+    The array tasks rerun ``script`` with the parsed command line (updated
+    with ``overrides``), a single subject and the MultiProc plugin sized to
+    the task.
+    """
+    from .resources import mem_to_gb
+    if not subjects:
+        raise ValueError('No subjects to submit')
+    array_dir = os.path.join(work_dir, 'job_array')
+    if not os.path.exists(array_dir):
+        os.makedirs(array_dir)
+    plugin_args = '{"n_procs": %d, "memory_gb": %g}' % (
+        args.array_cpus, mem_to_gb(args.array_mem))
+    overrides = dict(overrides or {}, plugin='MultiProc',
+                     plugin_args=plugin_args, work_dir=work_dir)
+    argv = namespace_to_argv(parser, args, skip=ARRAY_OPTIONS + ['subject'],
+                             overrides=overrides)
+    array_script = write_array_script(
+        os.path.join(array_dir, 'subjects.sh'), script, argv, subjects)
+    if args.job_array == 'local':
+        scheduler = LocalArrayScheduler(os.path.join(array_dir, 'spool'))
+    else:
+        scheduler = SlurmArrayScheduler(array_dir)
+    job_id = scheduler.submit(array_script, len(subjects),
+                              cpus=args.array_cpus, mem=args.array_mem,
+                              sbatch_args=args.array_sbatch_args,
+                              max_parallel=args.max_array_tasks)
+    return scheduler, job_id
@@ -0,0 +1,186 @@
+"""
+Cached versions and paths of the neuroimaging tools.
+
+nipype asks every interface for the version of its package when it runs
+(and for provenance), and the package ``Info`` classes only remember the
+answer in the process that asked: each node executed by a SLURM or SGE job
+runs ``antsRegistration --version`` or reads the FSL and FreeSurfer version
+files again.  :class:`ToolEnvironment` probes the tools once per
+environment and keeps the answers in a JSON file::
+
+    {"<environment key>": {"versions": {"fsl": "5.0.9", "ants": ...},
+                           "paths": {"flameo": "/usr/share/fsl/bin/flameo",
+                                     ...},
+                           "environment": {"PATH": ..., "FSLDIR": ...}}}
+
+The key is the SHA1 of ``PATH``, ``FSLDIR``, ``ANTSPATH`` and
+``FREESURFER_HOME``, so a job running with other tools probes (and adds)
+its own entry.  The scripts probe in the driver and attach the environment
+to every node (:meth:`ToolEnvironment.attach`).  When a worker unpickles a
+node, the environment installs the cached versions of the worker's own
+environment into nipype's ``Info`` classes before the node runs.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+TOOL_CACHE = 'tool_environment.json'
+ENV_VARS = ['PATH', 'FSLDIR', 'ANTSPATH', 'FREESURFER_HOME']
+# tool: (module of its nipype Info class, executables whose path is cached)
+TOOLS = {'fsl': ('nipype.interfaces.fsl.base', ['flameo', 'fslmaths']),
+         'ants': ('nipype.interfaces.ants.base', ['antsRegistration',
+                                                  'antsApplyTransforms']),
+         'freesurfer': ('nipype.interfaces.freesurfer.base',
+                        ['mri_convert', 'bbregister'])}
+# (cache file, environment key) pairs installed in this process
+_INSTALLED = set()
+
+
+def environment_key(environ=None):
+    """Return the SHA1 of the tool related environment variables"""
+    environ = os.environ if environ is None else environ
+    values = [[name, environ.get(name)] for name in ENV_VARS]
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
+def which(command, path=None):
+    """Return the full path of command on path (PATH if None), or None"""
+    path = os.environ.get('PATH', '') if path is None else path
+    for directory in path.split(os.pathsep):
+        filename = os.path.join(directory, command)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+
+def _info_class(module):
+    import importlib
+    return getattr(importlib.import_module(module), 'Info')
+
+
+class ToolEnvironment(object):
+    """Tool versions and paths cached in filename"""
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+
+    def load(self):
+        """Return all cached entries"""
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, 'rt') as fp:
+                return json.load(fp)
+        except ValueError:
+            # being replaced by another process writing an older copy
+            return {}
+
+    def entry(self, environ=None):
+        """Return the cached entry of environ (os.environ), or None"""
+        return self.load().get(environment_key(environ))
+
+    def probe(self, refresh=False):
+        """Return the entry of this environment, probing it if not cached
+
+        The versions are also installed in this process.
+        """
+        key = environment_key()
+        entry = None if refresh else self.load().get(key)
+        if entry is None:
+            entry = dict(versions={}, paths={},
+                         environment=dict([(name, os.environ.get(name))
+                                           for name in ENV_VARS]))
+            for tool, (module, commands) in sorted(TOOLS.items()):
+                try:
+                    version = _info_class(module).version()
+                except Exception:
+                    version = None
+                entry['versions'][tool] = version
+                for command in commands:
+                    entry['paths'][command] = which(command)
+            self._save(key, entry)
+        self.install(entry)
+        return entry
+
+    def _save(self, key, entry):
+        out_dir = os.path.dirname(self.filename)
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        entries = self.load()
+        entries[key] = entry
+        tmp_file = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp_file, 'wt') as fp:
+            json.dump(entries, fp, indent=1, sort_keys=True)
+        os.rename(tmp_file, self.filename)
+
+    def install(self, entry=None):
+        """Set the cached versions of this environment in nipype
+
+        Returns the versions installed; tools that were not found (None)
+        are left to nipype.
+        """
+        key = (self.filename, environment_key())
+        if entry is None:
+            if key in _INSTALLED:
+                return {}
+            entry = self.entry()
+            if entry is None:
+                return {}
+        installed = {}
+        for tool, version in entry['versions'].items():
+            if version is None or tool not in TOOLS:
+                continue
+            info = _info_class(TOOLS[tool][0])
+            if hasattr(info, 'parse_version'):
+                # nipype's PackageInfo keeps the version in _version
+                info._version = version
+            else:
+                info.version = staticmethod(lambda version=version: version)
+            installed[tool] = version
+        _INSTALLED.add(key)
+        return installed
+
+    def which(self, command):
+        """Return the cached path of command in this environment"""
+        entry = self.entry() or {}
+        if command in entry.get('paths', {}):
+            return entry['paths'][command]
+        return which(command)
+
+    def attach(self, workflow):
+        """Attach the environment to every node of workflow"""
+        from .resources import iter_nodes
+        for _, node in iter_nodes(workflow):
+            node.tool_environment = self
+        return workflow
+
+    def __getstate__(self):
+        return dict(filename=self.filename)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # runs when a node is unpickled, e.g. in a SLURM job; a failure
+        # must not keep the node from running
+        try:
+            self.install()
+        except Exception:
+            pass
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=('Probe FSL, ANTs and '
+                                                  'FreeSurfer and cache their '
+                                                  'versions and paths'))
+    parser.add_argument('cache_file', nargs='?', default=TOOL_CACHE)
+    parser.add_argument('--refresh', action='store_true',
+                        help='Probe again even if the environment is cached')
+    args = parser.parse_args()
+    entry = ToolEnvironment(args.cache_file).probe(refresh=args.refresh)
+    for tool in sorted(entry['versions']):
+        print('%-12s %s' % (tool, entry['versions'][tool]))
+    for command in sorted(entry['paths']):
+        print('%-20s %s' % (command, entry['paths'][command]))
@@ -0,0 +1,179 @@
+"""
+Block-wise temporal SNR of 4D series.
+
+nipype's ``TSNR(regress_poly=2)`` loads a whole run at float64, removes the
+Legendre polynomials with a full-size solve and writes the detrended series,
+which the ``median`` node then reads back to average the per-run medians.
+:func:`compute_tsnr` streams slabs of slices instead: the pseudo-inverse of
+the polynomial design is computed once and shared by every voxel, each slab
+is detrended in float32, and the mean, standard deviation, TSNR and median
+image (and, if requested, the detrended series, written uncompressed through
+a memory map) are all produced in the same pass.  The peak memory is one
+slab for uncompressed inputs, but a compressed run is decompressed whole at
+float32: the nodes reading ``.nii.gz`` runs keep a memory request sized for
+that in ``resources.json``.
+
+As in nipype, the polynomials of order 1 to ``regress_poly`` are removed
+and the mean is kept; the TSNR is ``mean / std`` where ``std > 1e-3``.
+Given a mask, the same pass also returns the global intensity of every
+volume (the mean of the raw voxels in the mask), as ArtifactDetect computes
+it with ``mask_type='file'``.
+"""
+
+import os
+
+import numpy as np
+
+# voxels (times volumes) detrended at once
+BLOCK_VOXELS = 1 << 15
+
+
+def legendre_design(n_vols, degree):
+    """Legendre polynomials of order 0..degree sampled on n_vols points"""
+    from numpy.polynomial import Legendre
+    grid = np.linspace(-1, 1, n_vols)
+    return np.column_stack([Legendre.basis(order)(grid)
+                            for order in range(degree + 1)])
+
+
+def _header(img, shape, dtype=np.float32):
+    import nibabel as nb
+    header = nb.Nifti1Header(binaryblock=img.header.binaryblock)
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(None, None)
+    return header
+
+
+def open_output(filename, img, dtype=np.float32):
+    """Create an uncompressed NIfTI of img's shape and memory map its data"""
+    header = _header(img, img.shape, dtype)
+    header['vox_offset'] = 0
+    n_bytes = int(np.prod(img.shape)) * np.dtype(dtype).itemsize
+    with open(filename, 'wb') as fp:
+        header.write_to(fp)
+        offset = int(header['vox_offset'])
+        fp.seek(offset + n_bytes - 1)
+        fp.write(b'\0')
+    return np.memmap(filename, dtype=header.get_data_dtype(), mode='r+',
+                     offset=offset, shape=img.shape, order='F')
+
+
+def save_map(values, img, filename):
+    """Write a 3D float32 map in the space of img"""
+    import nibabel as nb
+    out = nb.Nifti1Image(values.astype(np.float32), img.affine,
+                         _header(img, values.shape))
+    out.to_filename(filename)
+    return filename
+
+
+def compute_tsnr(in_file, regress_poly=2, detrended=True, median=True,
+                 out_dir=None, block_voxels=BLOCK_VOXELS, mask_file=None):
+    """Compute the TSNR maps of a 4D image in one pass over slabs
+
+    Returns a dictionary with ``tsnr_file``, ``mean_file``, ``stddev_file``
+    and, if requested, ``detrended_file`` (``detrend.nii``, uncompressed)
+    and ``median_file`` (median over time of the detrended series); the
+    names follow nipype's TSNR.  With mask_file, ``global_intensity`` holds
+    the mean of the mask voxels of every volume.
+    """
+    import nibabel as nb
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    img = nb.load(in_file, mmap=True)
+    if len(img.shape) != 4:
+        raise ValueError('%s is not a 4D image' % in_file)
+    n_x, n_y, n_z, n_vols = img.shape
+    data = img.dataobj
+    if in_file.endswith('.gz'):
+        # compressed slabs cannot be read without decompressing the file
+        # up to them, so the run is decompressed once, as float32
+        data = img.get_fdata(dtype=np.float32)
+    design = None
+    if regress_poly:
+        design = legendre_design(n_vols, regress_poly)
+        pinv = np.linalg.pinv(design)[1:].astype(np.float32)
+        trend = design[:, 1:].T.astype(np.float32)
+    maps = dict([(key, np.zeros((n_x, n_y, n_z), dtype=np.float32))
+                 for key in ['mean', 'std', 'median']])
+    out = dict()
+    detrended_out = None
+    if detrended and design is not None:
+        out['detrended_file'] = os.path.join(out_dir, 'detrend.nii')
+        detrended_out = open_output(out['detrended_file'], img)
+    mask = None
+    if mask_file is not None:
+        mask = np.asanyarray(nb.load(mask_file).dataobj) > 0.5
+        if mask.shape != (n_x, n_y, n_z):
+            raise ValueError('Mask %s has shape %s, expected %s' %
+                             (mask_file, mask.shape, (n_x, n_y, n_z)))
+        intensity = np.zeros(n_vols)
+        counts = np.zeros(n_vols)
+    step = max(1, block_voxels // (n_x * n_y))
+    for start in range(0, n_z, step):
+        stop = min(start + step, n_z)
+        block = np.asarray(data[:, :, start:stop, :],
+                           dtype=np.float32).reshape(-1, n_vols)
+        if mask is not None:
+            raw = block[mask[:, :, start:stop].reshape(-1)]
+            finite = np.isfinite(raw)
+            intensity += np.where(finite, raw, 0).sum(axis=0)
+            counts += finite.sum(axis=0)
+        block = np.nan_to_num(block)
+        if design is not None:
+            block -= np.dot(np.dot(block, pinv.T), trend)
+        slab = (n_x, n_y, stop - start)
+        maps['mean'][:, :, start:stop] = block.mean(axis=1).reshape(slab)
+        maps['std'][:, :, start:stop] = block.std(axis=1).reshape(slab)
+        if median:
+            maps['median'][:, :, start:stop] = np.median(
+                block, axis=1).reshape(slab)
+        if detrended_out is not None:
+            detrended_out[:, :, start:stop, :] = block.reshape(
+                slab + (n_vols,))
+    if detrended_out is not None:
+        detrended_out.flush()
+        del detrended_out
+    tsnr = np.zeros_like(maps['mean'])
+    nonzero = maps['std'] > 1.e-3
+    tsnr[nonzero] = maps['mean'][nonzero] / maps['std'][nonzero]
+    out['tsnr_file'] = save_map(tsnr, img, os.path.join(out_dir,
+                                                        'tsnr.nii.gz'))
+    out['mean_file'] = save_map(maps['mean'], img,
+                                os.path.join(out_dir, 'mean.nii.gz'))
+    out['stddev_file'] = save_map(maps['std'], img,
+                                  os.path.join(out_dir, 'stdev.nii.gz'))
+    if median:
+        out['median_file'] = save_map(maps['median'], img,
+                                      os.path.join(out_dir, 'median.nii.gz'))
+    if mask is not None:
+        with np.errstate(invalid='ignore'):
+            out['global_intensity'] = intensity / counts
+    return out
+
+
+def tsnr_node(in_file, regress_poly):
+    """nipype Function wrapper of compute_tsnr for a TSNR MapNode"""
+    from pipeline_utils.tsnr import compute_tsnr
+    out = compute_tsnr(in_file, regress_poly=regress_poly, detrended=False)
+    return (out['tsnr_file'], out['mean_file'], out['stddev_file'],
+            out['median_file'])
+
+
+def average_images(in_files):
+    """Average 3D images such as the per-run medians into median.nii.gz"""
+    import os
+    import nibabel as nb
+    import numpy as np
+    if not isinstance(in_files, (list, tuple)):
+        in_files = [in_files]
+    average = None
+    for filename in in_files:
+        img = nb.load(filename)
+        data = np.asanyarray(img.dataobj).astype(np.float64)
+        average = data if average is None else average + data
+    median_img = nb.Nifti1Image(average / len(in_files), img.affine,
+                                img.header)
+    filename = os.path.join(os.getcwd(), 'median.nii.gz')
+    median_img.to_filename(filename)
+    return filename
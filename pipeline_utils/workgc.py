@@ -0,0 +1,126 @@
+"""
+Reference counted collection of large intermediate files.
+
+The resting state workflow keeps the realigned, TOPUP corrected, filtered,
+cleaned, bandpassed, smoothed, warped and masked 4D series of every run in
+the working directory, about ten times the raw data of a subject.
+:class:`WorkCollector` is a plugin ``status_callback`` on the expanded
+execution graph: once a node and every node consuming its outputs
+(including the sinks) finished, the images of at least ``GC_THRESHOLD``
+bytes it produced are replaced by a stub (``hashing.write_stub``).
+
+A file passed through by another node (e.g. a ``Function`` returning one of
+its inputs) is only collected once every node whose outputs reference it
+was released.  Small files (QA images, text files, motion parameters), the
+result and hash files of the nodes, and the outputs of failed or still
+running branches are kept.  Since the stubs keep the fingerprints of the
+collected files, a rerun with the ``fingerprint`` or ``sampled`` hash
+method finds the finished nodes cached; a node that has to recompute from
+a collected input needs its producer to be rerun (e.g. by removing the
+producer's node directory).
+"""
+
+from __future__ import print_function
+
+import os
+
+from .hashing import is_image, write_stub
+
+GC_THRESHOLD = 32 * 1024 ** 2
+
+
+def _paths(value):
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple)):
+        return [path for val in value for path in _paths(val)]
+    if isinstance(value, str) and os.path.isabs(value):
+        return [value]
+    return []
+
+
+class WorkCollector(object):
+    """Collect the large outputs of the nodes of execgraph under root"""
+
+    def __init__(self, execgraph, root, threshold=GC_THRESHOLD,
+                 verbose=False):
+        self.graph = execgraph
+        self.root = os.path.join(os.path.abspath(root), '')
+        self.threshold = threshold
+        self.verbose = verbose
+        # consumers of each node that did not finish yet
+        self.pending = dict([(node, len(list(execgraph.successors(node))))
+                             for node in execgraph.nodes()])
+        self.held = {}
+        self.holders = {}
+        self.collected = 0
+        self.freed = 0
+        self._callback = None
+
+    def install(self, plugin_args):
+        """Hook into plugin_args, chaining an existing status_callback"""
+        self._callback = plugin_args.get('status_callback')
+        plugin_args['status_callback'] = self
+        return plugin_args
+
+    def large_files(self, node):
+        """Return the images of at least threshold bytes in the outputs of
+        node that are under root"""
+        result = getattr(node, 'result', None)
+        outputs = getattr(result, 'outputs', None)
+        if outputs is None:
+            return []
+        try:
+            outputs = outputs.get()
+        except (AttributeError, TypeError):
+            # a Bunch
+            outputs = outputs.dictcopy()
+        files = set()
+        for path in _paths(outputs):
+            if path.startswith(self.root) and is_image(path) and \
+                    os.path.isfile(path) and \
+                    os.path.getsize(path) >= self.threshold:
+                files.add(path)
+        return sorted(files)
+
+    def __call__(self, node, status):
+        if self._callback is not None:
+            self._callback(node, status)
+        if status != 'end' or node not in self.pending:
+            return
+        try:
+            files = self.large_files(node)
+        except Exception:
+            files = []
+        for filename in files:
+            self.holders.setdefault(filename, set()).add(node)
+        self.held[node] = files
+        if self.pending[node] == 0:
+            self._release(node)
+        for pred in self.graph.predecessors(node):
+            self.pending[pred] -= 1
+            if self.pending[pred] == 0 and pred in self.held:
+                self._release(pred)
+
+    def _release(self, node):
+        for filename in self.held.pop(node):
+            holders = self.holders[filename]
+            holders.discard(node)
+            if not holders:
+                del self.holders[filename]
+                self._collect(filename)
+
+    def _collect(self, filename):
+        try:
+            freed = write_stub(filename)
+        except (IOError, OSError):
+            return
+        if freed:
+            self.collected += 1
+            self.freed += freed
+            if self.verbose:
+                print('Collected %s (%.1f MB)' % (filename, freed / 1024. ** 2))
+
+    def summary(self):
+        return 'Collected %d intermediate files (%.1f GB)' % (
+            self.collected, self.freed / 1024. ** 3)
@@ -48,30 +48,52 @@ from __future__ import division
 from builtins import range
 
 import os
-
-from nipype.interfaces.base import CommandLine
-CommandLine.set_default_terminal_output('allatonce')
-
-from dcmstack.extract import default_extractor
-from dicom import read_file
-
-from nipype.interfaces import (fsl, Function, ants, freesurfer, nipy)
-from nipype.interfaces.c3 import C3dAffineTool
-
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
-
-from nipype import Workflow, Node, MapNode
-
-from nipype.algorithms.rapidart import ArtifactDetect
-from nipype.algorithms.misc import TSNR
-from nipype.interfaces.utility import Rename, Merge, IdentityInterface
-from nipype.utils.filemanip import filename_to_list
-from nipype.interfaces.io import DataSink, FreeSurferSource
-import nipype.interfaces.freesurfer as fs
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pipeline_utils.lazy import lazy_from, lazy_import
+
+# nipype, dcmstack, scipy and nibabel are imported when the workflow is
+# built, not to parse arguments
+CommandLine = lazy_from('nipype.interfaces.base', 'CommandLine')
+
+default_extractor = lazy_from('dcmstack.extract', 'default_extractor')
+read_file = lazy_from('dicom', 'read_file')
+
+fsl = lazy_import('nipype.interfaces.fsl')
+ants = lazy_import('nipype.interfaces.ants')
+freesurfer = fs = lazy_import('nipype.interfaces.freesurfer')
+nipy = lazy_import('nipype.interfaces.nipy')
+C3dAffineTool = lazy_from('nipype.interfaces.c3', 'C3dAffineTool')
+
+Workflow, Node, MapNode = lazy_from('nipype', 'Workflow', 'Node', 'MapNode')
+
+ArtifactDetect = lazy_from('nipype.algorithms.rapidart', 'ArtifactDetect')
+Function, Rename, Merge, IdentityInterface = lazy_from(
+    'nipype.interfaces.utility', 'Function', 'Rename', 'Merge',
+    'IdentityInterface')
+filename_to_list = lazy_from('nipype.utils.filemanip', 'filename_to_list')
+DataSink, FreeSurferSource = lazy_from('nipype.interfaces.io', 'DataSink',
+                                       'FreeSurferSource')
+
+from pipeline_utils.graphcache import expand_workflow, run_expanded
+from pipeline_utils.hashing import HashPolicy, add_hash_argument
+from pipeline_utils.profiling import RunProfiler
+from pipeline_utils.resources import (apply_resources, default_resource_file,
+                                      load_resource_config, parse_plugin_args)
+from pipeline_utils.toolcache import TOOL_CACHE, ToolEnvironment
+from pipeline_utils.tsnr import average_images, tsnr_node
+from pipeline_utils.workgc import GC_THRESHOLD, WorkCollector
+# the sinks are nipype interfaces
+layout = lazy_import('pipeline_utils.layout')
+DerivativesSink, bids_entities = lazy_from('pipeline_utils.layout',
+                                           'DerivativesSink', 'bids_entities')
+CompiledDataSink = lazy_from('pipeline_utils.sinks', 'CompiledDataSink')
 
 import numpy as np
-import scipy as sp
-import nibabel as nb
+sp = lazy_import('scipy')
+nb = lazy_import('nibabel')
 
 imports = ['import os',
            'import nibabel as nb',
@@ -521,7 +543,6 @@ def create_reg_workflow(name='registration'):
     reg.inputs.float = True
     reg.inputs.output_warped_image = 'output_warped_image.nii.gz'
     reg.inputs.num_threads = 4
-    reg.plugin_args = {'sbatch_args': '-c%d' % 4}
     register.connect(stripper, 'out_file', reg, 'moving_image')
     register.connect(inputnode, 'target_image', reg, 'fixed_image')
 
@@ -544,7 +565,6 @@ def create_reg_workflow(name='registration'):
     warpmean.inputs.terminal_output = 'file'
     warpmean.inputs.args = '--float'
     warpmean.inputs.num_threads = 4
-    warpmean.plugin_args = {'sbatch_args': '-c%d' % 4}
 
     register.connect(inputnode, 'target_image', warpmean, 'reference_image')
     register.connect(inputnode, 'mean_image', warpmean, 'input_image')
@@ -742,8 +762,12 @@ def create_workflow(files,
                     readout=None,
                     readout_topup=None,
                     session=None,
+                    output_layout='legacy',
                     name='resting'):
 
+    CommandLine.set_default_terminal_output('allatonce')
+    fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+
     wf = Workflow(name=name)
 
     # Rename files in case they are named identically
@@ -758,21 +782,33 @@ def create_workflow(files,
     realign.inputs.slice_times = slice_times
     realign.inputs.tr = TR
     realign.inputs.slice_info = 2
-    realign.plugin_args = {'sbatch_args': '-c%d' % 4}
 
-    # Comute TSNR on realigned data regressing polynomials upto order 2
-    tsnr = MapNode(TSNR(regress_poly=2), iterfield=['in_file'], name='tsnr')
-
-    # Compute the median image across runs
-    calc_median = Node(Function(input_names=['in_files'],
-                                output_names=['median_file'],
-                                function=median,
-                                imports=imports),
-                       name='median')
+    # Compute TSNR on realigned data regressing polynomials up to order 2,
+    # with the median image of the detrended series in the same pass
+    tsnr = MapNode(Function(input_names=['in_file', 'regress_poly'],
+                            output_names=['tsnr_file', 'mean_file',
+                                          'stddev_file', 'median_file'],
+                            function=tsnr_node),
+                   iterfield=['in_file'], name='tsnr')
+    tsnr.inputs.regress_poly = 2
+
+    # Compute the median image across runs: from the realigned series when
+    # it is the TOPUP reference, else from the medians computed with TSNR
+    if rest_pe_dir:
+        calc_median = Node(Function(input_names=['in_files'],
+                                    output_names=['median_file'],
+                                    function=median,
+                                    imports=imports),
+                           name='median')
+    else:
+        calc_median = Node(Function(input_names=['in_files'],
+                                    output_names=['median_file'],
+                                    function=average_images),
+                           name='median')
 
     if rest_pe_dir == None:
         wf.connect(realign, 'out_file', tsnr, 'in_file')
-        wf.connect(tsnr, 'detrended_file', calc_median, 'in_files')
+        wf.connect(tsnr, 'median_file', calc_median, 'in_files')
 
 
     """Geometric distortion correction using TOPUP
@@ -788,10 +824,13 @@ def create_workflow(files,
         wf.connect(realign, 'out_file', calc_median, 'in_files')
         wf.connect(calc_median, 'median_file', topup, 'inputspec.ref_file')
 
-        recalc_median = calc_median.clone(name='recalc_median')
+        recalc_median = Node(Function(input_names=['in_files'],
+                                      output_names=['median_file'],
+                                      function=average_images),
+                             name='recalc_median')
 
         wf.connect(topup, 'outputspec.applytopup_corrected', tsnr, 'in_file')
-        wf.connect(tsnr, 'detrended_file', recalc_median, 'in_files')
+        wf.connect(tsnr, 'median_file', recalc_median, 'in_files')
 
 
     """Segment and Register
@@ -966,7 +1005,6 @@ def create_workflow(files,
     warpall.inputs.reference_image = target_file
     warpall.inputs.args = '--float'
     warpall.inputs.num_threads = 2
-    warpall.plugin_args = {'sbatch_args': '-c%d' % 2}
 
     # transform to target
     wf.connect(collector, 'out', warpall, 'input_image')
@@ -1079,8 +1117,10 @@ def create_workflow(files,
                      ('_filtermotart_cleaned_bp_trans_masked', ''),
                      ('_filtermotart_cleaned_bp', ''),
                      ]
-    substitutions += [("_smooth%d" % i, "") for i in range(11)[::-1]]
-    substitutions += [("_ts_masker%d" % i, "") for i in range(11)[::-1]]
+    if output_layout == 'legacy':
+        # the layout sink names the smoothed and target space time series
+        substitutions += [("_smooth%d" % i, "") for i in range(11)[::-1]]
+        substitutions += [("_ts_masker%d" % i, "") for i in range(11)[::-1]]
     substitutions += [("_getsubcortts%d" % i, "") for i in range(11)[::-1]]
     substitutions += [("_combiner%d" % i, "") for i in range(11)[::-1]]
     substitutions += [("_filtermotion%d" % i, "") for i in range(11)[::-1]]
@@ -1106,7 +1146,7 @@ def create_workflow(files,
                   ('_inverse_transform./', ''),
                   ]
     # Save the relevant data into an output directory
-    datasink = Node(interface=DataSink(), name="datasink")
+    datasink = Node(interface=CompiledDataSink(), name="datasink")
     datasink.inputs.base_directory = sink_directory
     if session:
         datasink.inputs.container = os.path.join(subject_id, str(session))
@@ -1127,7 +1167,8 @@ def create_workflow(files,
     wf.connect(filter2, 'out_f', datasink, 'resting.qa.compmaps')
     wf.connect(filter2, 'out_pf', datasink, 'resting.qa.compmaps.@p')
     wf.connect(registration, 'outputspec.min_cost_file', datasink, 'resting.qa.mincost')
-    wf.connect(tsnr, 'tsnr_file', datasink, 'resting.qa.tsnr.@map')
+    if output_layout == 'legacy':
+        wf.connect(tsnr, 'tsnr_file', datasink, 'resting.qa.tsnr.@map')
     wf.connect([(get_roi_tsnr, datasink, [('avgwf_txt_file', 'resting.qa.tsnr'),
                                           ('summary_file', 'resting.qa.tsnr.@summary')])])
     if rest_pe_dir:
@@ -1143,13 +1184,14 @@ def create_workflow(files,
                    datasink, 'resting.qa.topup.@topup_corrected')
         wf.connect(topup, 'outputspec.applytopup_corrected', 
                    datasink, 'resting.qa.topup.@applytopup_corrected')
-    wf.connect(bandpass, 'out_files', datasink, 'resting.timeseries.@bandpassed')
-    wf.connect(smooth, 'out_file', datasink, 'resting.timeseries.@smoothed')
+    if output_layout == 'legacy':
+        wf.connect(bandpass, 'out_files', datasink, 'resting.timeseries.@bandpassed')
+        wf.connect(smooth, 'out_file', datasink, 'resting.timeseries.@smoothed')
+        wf.connect(maskts, 'out_file', datasink, 'resting.timeseries.target')
     wf.connect(createfilter1, 'out_files',
                datasink, 'resting.regress.@regressors')
     wf.connect(createfilter2, 'out_files',
                datasink, 'resting.regress.@compcorr')
-    wf.connect(maskts, 'out_file', datasink, 'resting.timeseries.target')
     wf.connect(sampleaparc, 'summary_file',
                datasink, 'resting.parcellations.aparc')
     wf.connect(sampleaparc, 'avgwf_txt_file',
@@ -1157,13 +1199,32 @@ def create_workflow(files,
     wf.connect(ts2txt, 'out_file',
                datasink, 'resting.parcellations.grayo.@subcortical')
 
-    datasink2 = Node(interface=DataSink(), name="datasink2")
+    datasink2 = Node(interface=CompiledDataSink(), name="datasink2")
     datasink2.inputs.base_directory = sink_directory
     datasink2.inputs.container = subject_id
     datasink2.inputs.substitutions = substitutions
     datasink2.inputs.regexp_substitutions = regex_subs  # (r'(/_.*(\d+/))', r'/run\2')
     wf.connect(combiner, 'out_file',
                datasink2, 'resting.parcellations.grayo.@surface')
+
+    if output_layout == 'bids':
+        # Write the time series and TSNR maps to their BIDS-Derivatives names
+        runs = [{'run': '%02d' % run} for run in range(1, len(files) + 1)]
+        derivatives = Node(DerivativesSink(fields=sorted(layout.RESTING_LAYOUT)),
+                           name='derivatives_sink')
+        derivatives.inputs.base_directory = sink_directory
+        derivatives.inputs.layout = layout.RESTING_LAYOUT
+        derivatives.inputs.entities = bids_entities(subject_id, session)
+        derivatives.inputs.index_entities = {
+            'bandpassed': runs,
+            'smoothed': runs,
+            'tsnr': runs,
+            'target': ([dict(run, space='MNI152', desc='smoothed') for run in runs] +
+                       [dict(run, space='MNI152', desc='unsmoothed') for run in runs])}
+        wf.connect(bandpass, 'out_files', derivatives, 'bandpassed')
+        wf.connect(smooth, 'out_file', derivatives, 'smoothed')
+        wf.connect(maskts, 'out_file', derivatives, 'target')
+        wf.connect(tsnr, 'tsnr_file', derivatives, 'tsnr')
     return wf
 
 
@@ -1211,6 +1272,7 @@ def create_resting_workflow(args, name=None):
                   readout=readout,
                   readout_topup=readout_topup,
                   session=args.session,
+                  output_layout=args.output_layout,
                   name=name)
     wf = create_workflow(**kwargs)
     return wf
@@ -1268,8 +1330,26 @@ if __name__ == "__main__":
                         help="Plugin to use")
     parser.add_argument("--plugin_args", dest="plugin_args",
                         help="Plugin arguments")
+    parser.add_argument("--resources", dest="resources",
+                        default=default_resource_file(__file__),
+                        help=("JSON or YAML file with default and per-node "
+                              "CPU/memory/partition requests" + defstr))
+    parser.add_argument("--profile", dest="profile", action='store_true',
+                        help=("Record wall/CPU time, memory and I/O of every "
+                              "node and write reports to <work_dir>/profile"))
     parser.add_argument("-ss", "--session", dest="session",
                         help="Session (if longitudinal study)")
+    parser.add_argument("--output_layout", dest="output_layout",
+                        default='legacy', choices=('legacy', 'bids'),
+                        help=("Name time series with DataSink substitutions "
+                              "or write them to BIDS-Derivatives names" + defstr))
+    parser.add_argument("--gc", dest="gc", action='store_true',
+                        help=("Replace intermediate images of at least %d MB "
+                              "by stubs once every node using them and the "
+                              "sinks finished (requires --hash_method "
+                              "fingerprint or sampled)"
+                              % (GC_THRESHOLD // 1024 ** 2)))
+    add_hash_argument(parser)
     args = parser.parse_args()
 
     wf = create_resting_workflow(args)
@@ -1284,8 +1364,31 @@ if __name__ == "__main__":
     if (args.topup_dicom and (args.topup_AP is None or args.topup_PA is None or  
             args.rest_pe_dir is None)):
         parser.error("topup requires:--topup_dicom,--topup_AP,--topup_PA,--rest_pe_dir")
-
-    if args.plugin_args:
-        wf.run(args.plugin, plugin_args=eval(args.plugin_args))
+    if args.gc and args.hash_method not in ('fingerprint', 'sampled'):
+        parser.error("--gc requires --hash_method fingerprint or sampled")
+
+    apply_resources(wf, load_resource_config(args.resources))
+    # probe FSL, ANTs and FreeSurfer once for the driver and all nodes
+    tools = ToolEnvironment(os.path.join(work_dir, TOOL_CACHE))
+    tools.probe()
+    tools.attach(wf)
+    hashing = HashPolicy(args.hash_method)
+    hashing.configure(wf)
+    hashing.attach(wf)
+    plugin_args = parse_plugin_args(args.plugin_args)
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler(os.path.join(work_dir, 'profile'), wf.name)
+        profiler.install(plugin_args)
+    if args.gc:
+        # the collector counts the consumers of the expanded nodes
+        execgraph = expand_workflow(wf)
+        collector = WorkCollector(execgraph, os.path.join(work_dir, wf.name))
+        collector.install(plugin_args)
+        execgraph = run_expanded(wf, execgraph, args.plugin,
+                                 plugin_args=plugin_args)
+        print(collector.summary())
     else:
-        wf.run(args.plugin)
+        execgraph = wf.run(args.plugin, plugin_args=plugin_args)
+    if profiler is not None:
+        profiler.write(execgraph)
@@ -12,42 +12,50 @@ This script demonstrates how to use nipype to analyze a data set::
     python fmri_ants_openfmri.py --datasetdir ds107
 """
 
-from nipype import config
-config.enable_provenance()
-
-import six
-
 from glob import glob
 import os
-
-import nipype.pipeline.engine as pe
-import nipype.algorithms.modelgen as model
-import nipype.algorithms.rapidart as ra
-import nipype.interfaces.fsl as fsl
-import nipype.interfaces.ants as ants
-from nipype.algorithms.misc import TSNR
-from nipype.interfaces.c3 import C3dAffineTool
-import nipype.interfaces.io as nio
-import nipype.interfaces.utility as niu
-from nipype.workflows.fmri.fsl import (create_featreg_preproc,
-                                       create_modelfit_workflow,
-                                       create_fixed_effects_flow)
-
-from nipype import LooseVersion
-from nipype import Workflow, Node, MapNode
-from nipype.interfaces import (fsl, Function, ants, freesurfer)
-
-from nipype.interfaces.utility import Rename, Merge, IdentityInterface
-from nipype.utils.filemanip import filename_to_list
-from nipype.interfaces.io import DataSink, FreeSurferSource
-import nipype.interfaces.freesurfer as fs
-
-version = 0
-if fsl.Info.version() and \
-    LooseVersion(fsl.Info.version()) > LooseVersion('5.0.6'):
-    version = 507
-
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from pipeline_utils.lazy import lazy_from, lazy_import
+
+# nipype is imported when the workflow is built, not to parse arguments
+pe = lazy_import('nipype.pipeline.engine')
+model = lazy_import('nipype.algorithms.modelgen')
+fsl = lazy_import('nipype.interfaces.fsl')
+ants = lazy_import('nipype.interfaces.ants')
+C3dAffineTool = lazy_from('nipype.interfaces.c3', 'C3dAffineTool')
+nio = lazy_import('nipype.interfaces.io')
+niu = lazy_import('nipype.interfaces.utility')
+fsl_workflows = lazy_import('nipype.workflows.fmri.fsl')
+
+Workflow, Node, MapNode = lazy_from('nipype', 'Workflow', 'Node', 'MapNode')
+freesurfer = fs = lazy_import('nipype.interfaces.freesurfer')
+
+Function, Rename, Merge, IdentityInterface = lazy_from(
+    'nipype.interfaces.utility', 'Function', 'Rename', 'Merge',
+    'IdentityInterface')
+filename_to_list = lazy_from('nipype.utils.filemanip', 'filename_to_list')
+DataSink, FreeSurferSource = lazy_from('nipype.interfaces.io', 'DataSink',
+                                       'FreeSurferSource')
+
+from pipeline_utils.graphcache import (CACHE_DIR, cached_graph,
+                                       dataset_index, run_expanded)
+from pipeline_utils.hashing import HashPolicy, add_hash_argument
+from pipeline_utils.manifest import (completed_subjects, manifest_node,
+                                     params_key)
+from pipeline_utils.maskstore import compact_node
+from pipeline_utils.profiling import RunProfiler
+from pipeline_utils.resources import (apply_resources, default_resource_file,
+                                      load_resource_config, parse_plugin_args)
+from pipeline_utils.slurm import add_array_arguments, submit_subject_array
+from pipeline_utils.toolcache import TOOL_CACHE, ToolEnvironment
+from pipeline_utils.qa import qa_node
+# the sinks are nipype interfaces
+layout = lazy_import('pipeline_utils.layout')
+DerivativesSink = lazy_from('pipeline_utils.layout', 'DerivativesSink')
+CompiledDataSink = lazy_from('pipeline_utils.sinks', 'CompiledDataSink')
 
 imports = ['import os',
            'import nibabel as nb',
@@ -57,33 +65,6 @@ imports = ['import os',
            'from scipy.special import legendre'
            ]
 
-def median(in_files):
-    """Computes an average of the median of each realigned timeseries
-
-    Parameters
-    ----------
-
-    in_files: one or more realigned Nifti 4D time series
-
-    Returns
-    -------
-
-    out_file: a 3D Nifti file
-    """
-    average = None
-    for idx, filename in enumerate(filename_to_list(in_files)):
-        img = nb.load(filename)
-        data = np.median(img.get_data(), axis=3)
-        if average is None:
-            average = data
-        else:
-            average = average + data
-    median_img = nb.Nifti1Image(average/float(idx + 1),
-                                img.get_affine(), img.get_header())
-    filename = os.path.join(os.getcwd(), 'median.nii.gz')
-    median_img.to_filename(filename)
-    return filename
-
 
 def create_reg_workflow(name='registration'):
     """Create a FEAT preprocessing workflow together with freesurfer
@@ -226,8 +207,6 @@ def create_reg_workflow(name='registration'):
     reg.inputs.args = '--float'
     reg.inputs.output_warped_image = 'output_warped_image.nii.gz'
     reg.inputs.num_threads = 4
-    reg.plugin_args = {'qsub_args': '-pe orte 4',
-                       'sbatch_args': '--mem=6G -c 4'}
     register.connect(stripper, 'out_file', reg, 'moving_image')
     register.connect(inputnode,'target_image_brain', reg,'fixed_image')
 
@@ -443,8 +422,6 @@ def create_fs_reg_workflow(name='registration'):
     reg.inputs.args = '--float'
     reg.inputs.output_warped_image = 'output_warped_image.nii.gz'
     reg.inputs.num_threads = 4
-    reg.plugin_args = {'qsub_args': '-pe orte 4',
-                       'sbatch_args': '--mem=6G -c 4'}
     register.connect(stripper, 'out_file', reg, 'moving_image')
     register.connect(inputnode,'target_image', reg,'fixed_image')
 
@@ -485,7 +462,6 @@ def create_fs_reg_workflow(name='registration'):
     warpall.inputs.terminal_output = 'file'
     warpall.inputs.args = '--float'
     warpall.inputs.num_threads = 2
-    warpall.plugin_args = {'sbatch_args': '--mem=6G -c 2'}
 
     """
     Assign all the output files
@@ -638,7 +614,8 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                              task_id=None, output_dir=None, subj_prefix='*',
                              hpcutoff=120., use_derivatives=True,
                              fwhm=6.0, subjects_dir=None, target=None, 
-                             session_id=None):
+                             session_id=None, output_layout='legacy',
+                             compact_stats=False, manifest_key=None):
     """Analyzes an open fmri dataset
 
     Parameters
@@ -649,15 +626,29 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
 
     work_dir : str
         Nipype working directory (defaults to cwd)
+
+    output_layout : str
+        'legacy' renames outputs with DataSink substitutions, 'bids' writes
+        statistics, TSNR and mean images to BIDS-Derivatives names
+
+    compact_stats : bool
+        Store the MNI space copes, varcopes and zstats as the voxels of the
+        MNI152 brain mask (``.mvec.npz``, see pipeline_utils.maskstore)
+
+    manifest_key : str
+        Parameter key (pipeline_utils.manifest.params_key) recorded in the
+        completion manifest written after the sinks of each subject; no
+        manifest is written if None
     """
 
     """
     Load nipype workflows
     """
 
-    preproc = create_featreg_preproc(whichvol='first')
-    modelfit = create_modelfit_workflow()
-    fixed_fx = create_fixed_effects_flow()
+    fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+    preproc = fsl_workflows.create_featreg_preproc(whichvol='first')
+    modelfit = fsl_workflows.create_modelfit_workflow()
+    fixed_fx = fsl_workflows.create_fixed_effects_flow()
     if subjects_dir:
         registration = create_fs_reg_workflow()
     else:
@@ -839,16 +830,6 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                                        function=get_contrasts),
                           name='contrastgen')
 
-    art = pe.MapNode(interface=ra.ArtifactDetect(use_differences=[True, False],
-                                                 use_norm=True,
-                                                 norm_threshold=1,
-                                                 zintensity_threshold=3,
-                                                 parameter_source='FSL',
-                                                 mask_type='file'),
-                     iterfield=['realigned_files', 'realignment_parameters',
-                                'mask_file'],
-                     name="art")
-
     modelspec = pe.Node(interface=model.SpecifyModel(),
                            name="modelspec")
     modelspec.inputs.input_units = 'secs'
@@ -883,36 +864,38 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     wf.connect(taskname, 'task_name', contrastgen, 'task_name')
     wf.connect(contrastgen, 'contrasts', modelfit, 'inputspec.contrasts')
 
-    wf.connect([(preproc, art, [('outputspec.motion_parameters',
-                                 'realignment_parameters'),
-                                ('outputspec.realigned_files',
-                                 'realigned_files'),
-                                ('outputspec.mask', 'mask_file')]),
+    # Compute TSNR on realigned data regressing polynomials up to order 2,
+    # the median image of every run and of all runs, and the artifact
+    # (intensity and motion) outliers of every run in one read of each run
+    qa = Node(Function(input_names=['realigned_files',
+                                    'realignment_parameters', 'mask_files',
+                                    'regress_poly', 'norm_threshold',
+                                    'zintensity_threshold'],
+                       output_names=['tsnr_files', 'median_files',
+                                     'median_file', 'intensity_files',
+                                     'norm_files', 'outlier_files'],
+                       function=qa_node),
+              name='qa')
+    qa.inputs.regress_poly = 2
+    qa.inputs.norm_threshold = 1
+    qa.inputs.zintensity_threshold = 3
+
+    wf.connect([(preproc, qa, [('outputspec.motion_parameters',
+                                'realignment_parameters'),
+                               ('outputspec.realigned_files',
+                                'realigned_files'),
+                               ('outputspec.mask', 'mask_files')]),
                 (preproc, modelspec, [('outputspec.highpassed_files',
                                        'functional_runs'),
                                       ('outputspec.motion_parameters',
                                        'realignment_parameters')]),
-                (art, modelspec, [('outlier_files', 'outlier_files')]),
+                (qa, modelspec, [('outlier_files', 'outlier_files')]),
                 (modelspec, modelfit, [('session_info',
                                         'inputspec.session_info')]),
                 (preproc, modelfit, [('outputspec.highpassed_files',
                                       'inputspec.functional_data')])
                 ])
 
-    # Comute TSNR on realigned data regressing polynomials upto order 2
-    tsnr = MapNode(TSNR(regress_poly=2), iterfield=['in_file'], name='tsnr')
-    wf.connect(preproc, "outputspec.realigned_files", tsnr, "in_file")
-    tsnr.plugin_args = {'qsub_args': '-pe orte 4',
-                       'sbatch_args': '--mem=16G -c 4'}
-
-    # Compute the median image across runs
-    calc_median = Node(Function(input_names=['in_files'],
-                                output_names=['median_file'],
-                                function=median,
-                                imports=imports),
-                       name='median')
-    wf.connect(tsnr, 'detrended_file', calc_median, 'in_files')
-
     """
     Reorder the copes so that now it combines across runs
     """
@@ -952,7 +935,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                                       ])
                 ])
 
-    wf.connect(calc_median, 'median_file', registration, 'inputspec.mean_image')
+    wf.connect(qa, 'median_file', registration, 'inputspec.mean_image')
     if subjects_dir:
         wf.connect(infosource, 'subject_id', registration, 'inputspec.subject_id')
         registration.inputs.inputspec.subjects_dir = subjects_dir
@@ -1003,6 +986,20 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     wf.connect(registration, 'outputspec.transformed_files',
                splitfunc, 'in_files')
 
+    mni_stats = splitfunc
+    if compact_stats:
+        mni_stats = pe.Node(niu.Function(input_names=['copes', 'varcopes',
+                                                      'zstats', 'mask_file'],
+                                         output_names=['copes', 'varcopes',
+                                                       'zstats'],
+                                         function=compact_node),
+                            name='compact_stats')
+        mni_stats.inputs.mask_file = fsl.Info.standard_image(
+            'MNI152_T1_2mm_brain_mask.nii.gz')
+        wf.connect([(splitfunc, mni_stats, [('copes', 'copes'),
+                                            ('varcopes', 'varcopes'),
+                                            ('zstats', 'zstats')])])
+
     if subjects_dir:
         get_roi_mean = pe.MapNode(fs.SegStats(default_color_table=True),
                                   iterfield=['in_file'], name='get_aparc_means')
@@ -1013,7 +1010,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
         get_roi_tsnr = pe.MapNode(fs.SegStats(default_color_table=True),
                                   iterfield=['in_file'], name='get_aparc_tsnr')
         get_roi_tsnr.inputs.avgwf_txt_file = True
-        wf.connect(tsnr, 'tsnr_file', get_roi_tsnr, 'in_file')
+        wf.connect(qa, 'tsnr_files', get_roi_tsnr, 'in_file')
         wf.connect(registration, 'outputspec.aparc', get_roi_tsnr, 'segmentation_file')
 
         # Sample the average time series in aparc ROIs
@@ -1064,7 +1061,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
 
         for i, run_num in enumerate(run_id):
             subs.append(('__get_aparc_tsnr%d/' % i, '/run%02d_' % run_num))
-            subs.append(('__art%d/' % i, '/run%02d_' % run_num))
+            subs.append(('__qa%d/' % i, '/run%02d_' % run_num))
             subs.append(('__dilatemask%d/' % i, '/run%02d_' % run_num))
             subs.append(('__realign%d/' % i, '/run%02d_' % run_num))
             subs.append(('__modelgen%d/' % i, '/run%02d_' % run_num))
@@ -1084,21 +1081,26 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                       name='subsgen')
     wf.connect(subjinfo, 'run_id', subsgen, 'run_id')
 
-    datasink = pe.Node(interface=nio.DataSink(),
+    datasink = pe.Node(interface=CompiledDataSink(),
                        name="datasink")
     wf.connect(infosource, 'subject_id', datasink, 'container')
     wf.connect(infosource, 'subject_id', subsgen, 'subject_id')
     wf.connect(infosource, 'model_id', subsgen, 'model_id')
     wf.connect(infosource, 'task_id', subsgen, 'task_id')
-    wf.connect(contrastgen, 'contrasts', subsgen, 'conds')
+    if output_layout == 'bids':
+        # contrast specific outputs are named by the layout sink below
+        subsgen.inputs.conds = []
+    else:
+        wf.connect(contrastgen, 'contrasts', subsgen, 'conds')
     wf.connect(subsgen, 'substitutions', datasink, 'substitutions')
-    wf.connect([(fixed_fx.get_node('outputspec'), datasink,
-                                 [('res4d', 'res4d'),
-                                  ('copes', 'copes'),
-                                  ('varcopes', 'varcopes'),
-                                  ('zstats', 'zstats'),
-                                  ('tstats', 'tstats')])
-                                 ])
+    if output_layout == 'legacy':
+        wf.connect([(fixed_fx.get_node('outputspec'), datasink,
+                                     [('res4d', 'res4d'),
+                                      ('copes', 'copes'),
+                                      ('varcopes', 'varcopes'),
+                                      ('zstats', 'zstats'),
+                                      ('tstats', 'tstats')])
+                                     ])
     wf.connect([(modelfit.get_node('modelgen'), datasink,
                                  [('design_cov', 'qa.model'),
                                   ('design_image', 'qa.model.@matrix_image'),
@@ -1110,29 +1112,113 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                                       'qa.motion.plots'),
                                      ('outputspec.mask', 'qa.mask')])])
     wf.connect(registration, 'outputspec.mean2anat_mask', datasink, 'qa.mask.mean2anat')
-    wf.connect(art, 'norm_files', datasink, 'qa.art.@norm')
-    wf.connect(art, 'intensity_files', datasink, 'qa.art.@intensity')
-    wf.connect(art, 'outlier_files', datasink, 'qa.art.@outlier_files')
+    wf.connect(qa, 'norm_files', datasink, 'qa.art.@norm')
+    wf.connect(qa, 'intensity_files', datasink, 'qa.art.@intensity')
+    wf.connect(qa, 'outlier_files', datasink, 'qa.art.@outlier_files')
     wf.connect(registration, 'outputspec.anat2target', datasink, 'qa.anat2target')
-    wf.connect(tsnr, 'tsnr_file', datasink, 'qa.tsnr.@map')
     if subjects_dir:
         wf.connect(registration, 'outputspec.min_cost_file', datasink, 'qa.mincost')
         wf.connect([(get_roi_tsnr, datasink, [('avgwf_txt_file', 'qa.tsnr'),
                                               ('summary_file', 'qa.tsnr.@summary')])])
-        wf.connect([(get_roi_mean, datasink, [('avgwf_txt_file', 'copes.roi'),
-                                              ('summary_file', 'copes.roi.@summary')])])
         wf.connect(sampleaparc, 'summary_file', datasink, 'timeseries.aparc.@summary')
         wf.connect(sampleaparc, 'avgwf_txt_file', datasink, 'timeseries.aparc')
-    wf.connect([(splitfunc, datasink,
-                 [('copes', 'copes.mni'),
-                  ('varcopes', 'varcopes.mni'),
-                  ('zstats', 'zstats.mni'),
-                  ])])
-    wf.connect(calc_median, 'median_file', datasink, 'mean')
-    wf.connect(registration, 'outputspec.transformed_mean', datasink, 'mean.mni')
+    if output_layout == 'legacy':
+        wf.connect(qa, 'tsnr_files', datasink, 'qa.tsnr.@map')
+        if subjects_dir:
+            wf.connect([(get_roi_mean, datasink, [('avgwf_txt_file', 'copes.roi'),
+                                                  ('summary_file', 'copes.roi.@summary')])])
+        wf.connect([(mni_stats, datasink,
+                     [('copes', 'copes.mni'),
+                      ('varcopes', 'varcopes.mni'),
+                      ('zstats', 'zstats.mni'),
+                      ])])
+        wf.connect(qa, 'median_file', datasink, 'mean')
+        wf.connect(registration, 'outputspec.transformed_mean', datasink, 'mean.mni')
     wf.connect(registration, 'outputspec.func2anat_transform', datasink, 'xfm.mean2anat')
     wf.connect(registration, 'outputspec.anat2target_transform', datasink, 'xfm.anat2target')
 
+    if output_layout == 'bids':
+        """
+        Write statistics, TSNR and mean images directly to their
+        BIDS-Derivatives names
+        """
+
+        def get_layout_entities(subject_id, session_id, task_name, contrasts,
+                                run_id):
+            from pipeline_utils.layout import bids_entities, bids_label
+            entities = bids_entities(subject_id, session_id, task=task_name)
+            con_entities = [{'contrast': bids_label(con[0])} for con in contrasts]
+            run_entities = [{'run': '%02d' % run} for run in run_id]
+            index_entities = dict([(field, con_entities) for field in
+                                   ['copes', 'varcopes', 'zstats', 'tstats',
+                                    'res4d', 'copes_mni', 'varcopes_mni',
+                                    'zstats_mni', 'roi_avgwf', 'roi_summary']])
+            index_entities['tsnr'] = run_entities
+            return entities, index_entities
+
+        layoutgen = pe.Node(niu.Function(input_names=['subject_id', 'session_id',
+                                                      'task_name', 'contrasts',
+                                                      'run_id'],
+                                         output_names=['entities',
+                                                       'index_entities'],
+                                         function=get_layout_entities),
+                            name='layoutgen')
+        layoutgen.inputs.session_id = session_id
+        wf.connect(infosource, 'subject_id', layoutgen, 'subject_id')
+        wf.connect(taskname, 'task_name', layoutgen, 'task_name')
+        wf.connect(contrastgen, 'contrasts', layoutgen, 'contrasts')
+        wf.connect(subjinfo, 'run_id', layoutgen, 'run_id')
+
+        layout_fields = [field for field in sorted(layout.SUBJECT_LAYOUT)
+                         if subjects_dir or not field.startswith('roi_')]
+        derivatives = pe.Node(DerivativesSink(fields=layout_fields),
+                              name='derivatives_sink')
+        derivatives.inputs.base_directory = output_dir
+        derivatives.inputs.layout = layout.SUBJECT_LAYOUT
+        wf.connect(layoutgen, 'entities', derivatives, 'entities')
+        wf.connect(layoutgen, 'index_entities', derivatives, 'index_entities')
+        wf.connect([(fixed_fx.get_node('outputspec'), derivatives,
+                     [('res4d', 'res4d'),
+                      ('copes', 'copes'),
+                      ('varcopes', 'varcopes'),
+                      ('zstats', 'zstats'),
+                      ('tstats', 'tstats')]),
+                    (mni_stats, derivatives,
+                     [('copes', 'copes_mni'),
+                      ('varcopes', 'varcopes_mni'),
+                      ('zstats', 'zstats_mni')]),
+                    ])
+        wf.connect(qa, 'tsnr_files', derivatives, 'tsnr')
+        wf.connect(qa, 'median_file', derivatives, 'mean')
+        wf.connect(registration, 'outputspec.transformed_mean', derivatives, 'mean_mni')
+        if subjects_dir:
+            wf.connect([(get_roi_mean, derivatives, [('avgwf_txt_file', 'roi_avgwf'),
+                                                     ('summary_file', 'roi_summary')])])
+
+    """
+    Record the sunk files of each subject, so that --resume can skip it
+    """
+
+    if manifest_key is not None:
+        manifest = pe.Node(niu.Function(input_names=['sink_files',
+                                                     'derivative_files',
+                                                     'subject_id', 'model_id',
+                                                     'task_id', 'output_dir',
+                                                     'params'],
+                                        output_names=['manifest_file'],
+                                        function=manifest_node),
+                           name='manifest')
+        manifest.inputs.output_dir = output_dir
+        manifest.inputs.params = manifest_key
+        wf.connect(datasink, 'out_file', manifest, 'sink_files')
+        if output_layout == 'bids':
+            wf.connect(derivatives, 'out_files', manifest, 'derivative_files')
+        else:
+            manifest.inputs.derivative_files = []
+        wf.connect([(infosource, manifest, [('subject_id', 'subject_id'),
+                                            ('model_id', 'model_id'),
+                                            ('task_id', 'task_id')])])
+
     """
     Set processing parameters
     """
@@ -1181,6 +1267,13 @@ if __name__ == '__main__':
                         help="Plugin to use")
     parser.add_argument("--plugin_args", dest="plugin_args",
                         help="Plugin arguments")
+    parser.add_argument("--resources", dest="resources",
+                        default=default_resource_file(__file__),
+                        help=("JSON or YAML file with default and per-node "
+                              "CPU/memory/partition requests" + defstr))
+    parser.add_argument("--profile", dest="profile", action='store_true',
+                        help=("Record wall/CPU time, memory and I/O of every "
+                              "node and write reports to <work_dir>/profile"))
     parser.add_argument("--sd", dest="subjects_dir",
                         help="FreeSurfer subjects directory (if available)")
     parser.add_argument("--target", dest="target_file",
@@ -1191,12 +1284,48 @@ if __name__ == '__main__':
                         help="Session id, ses-1")
     parser.add_argument("--crashdump_dir", dest="crashdump_dir",
                         help="Crashdump dir", default=None)
+    parser.add_argument("--output_layout", dest="output_layout",
+                        default='legacy', choices=('legacy', 'bids'),
+                        help=("Name statistics with DataSink substitutions or "
+                              "write them to BIDS-Derivatives names" + defstr))
+    parser.add_argument("--compact_stats", dest="compact_stats",
+                        action='store_true',
+                        help=("Store MNI space copes, varcopes and zstats as "
+                              "the voxels of the MNI brain mask (.mvec.npz), "
+                              "which the group scripts read directly"))
+    parser.add_argument("--no_graph_cache", dest="graph_cache",
+                        action='store_false',
+                        help=("Build and expand the workflow even if "
+                              "<work_dir>/%s has its execution graph for "
+                              "these sources, parameters and dataset"
+                              % CACHE_DIR))
+    parser.add_argument("--resume", dest="resume", action='store_true',
+                        help=("Skip the subjects whose outputs were all sunk "
+                              "with these parameters and did not change "
+                              "since (see <output_dir>/manifest)"))
+    add_hash_argument(parser)
+    add_array_arguments(parser)
 
     args = parser.parse_args()
+    from nipype import config
+    config.enable_provenance()
     outdir = args.outdir
     work_dir = os.getcwd()
     if args.work_dir:
         work_dir = os.path.abspath(args.work_dir)
+    if args.job_array:
+        data_dir = os.path.abspath(args.datasetdir)
+        subjects = args.subject or sorted(
+            [path.split(os.path.sep)[-1] for path in
+             glob(os.path.join(data_dir, args.subjectprefix))])
+        overrides = {'datasetdir': data_dir,
+                     'outdir': os.path.abspath(outdir or
+                                               os.path.join(work_dir, 'output'))}
+        scheduler, job_id = submit_subject_array(parser, args, __file__,
+                                                 subjects, work_dir,
+                                                 overrides=overrides)
+        print('Submitted %d subjects as array job %s' % (len(subjects), job_id))
+        sys.exit(0)
     if outdir:
         outdir = os.path.abspath(outdir)
     else:
@@ -1206,30 +1335,80 @@ if __name__ == '__main__':
     derivatives = args.derivatives
     if derivatives is None:
        derivatives = False
-    wf = analyze_openfmri_dataset(data_dir=os.path.abspath(args.datasetdir),
-                                  subject=args.subject,
-                                  model_id=int(args.model),
-                                  task_id=[int(args.task)],
-                                  subj_prefix=args.subjectprefix,
-                                  output_dir=outdir,
-                                  hpcutoff=args.hpfilter,
-                                  use_derivatives=derivatives,
-                                  fwhm=args.fwhm,
-                                  subjects_dir=args.subjects_dir,
-                                  target=args.target_file,
-                                  session_id=args.session_id)
-    #wf.config['execution']['remove_unnecessary_outputs'] = False
-    wf.config['execution']['poll_sleep_duration'] = 2
-    wf.base_dir = work_dir
-    
-    if not (args.crashdump_dir is None):
-        wf.config['execution']['crashdump_dir'] = args.crashdump_dir
-
-    if args.plugin_args:
-        wf.run(args.plugin, plugin_args=eval(args.plugin_args))
+    params = dict(data_dir=os.path.abspath(args.datasetdir),
+                  subject=args.subject,
+                  model_id=int(args.model),
+                  task_id=[int(args.task)],
+                  subj_prefix=args.subjectprefix,
+                  output_dir=outdir,
+                  hpcutoff=args.hpfilter,
+                  use_derivatives=derivatives,
+                  fwhm=args.fwhm,
+                  subjects_dir=args.subjects_dir,
+                  target=args.target_file,
+                  session_id=args.session_id,
+                  output_layout=args.output_layout,
+                  compact_stats=args.compact_stats)
+    params['manifest_key'] = params_key(params)
+    if args.resume:
+        # checks the size and mtime of the sunk files, without hashing them
+        subjects = args.subject or sorted(
+            [path.split(os.path.sep)[-1] for path in
+             glob(os.path.join(params['data_dir'], args.subjectprefix))])
+        done = completed_subjects(outdir, subjects, params['manifest_key'])
+        params['subject'] = [subj for subj in subjects if subj not in done]
+        print('Skipping %d completed subjects' % len(done))
+        if not params['subject']:
+            sys.exit(0)
+    resources = load_resource_config(args.resources)
+    # probe FSL, ANTs and FreeSurfer once for the driver and all nodes
+    tools = ToolEnvironment(os.path.join(work_dir, TOOL_CACHE))
+    tools.probe()
+    hashing = HashPolicy(args.hash_method)
+
+    def build():
+        wf = analyze_openfmri_dataset(**params)
+        apply_resources(wf, resources)
+        tools.attach(wf)
+        hashing.attach(wf)
+        return wf
+
+    def configure(wf):
+        #wf.config['execution']['remove_unnecessary_outputs'] = False
+        wf.config['execution']['poll_sleep_duration'] = 2
+        wf.base_dir = work_dir
+        if not (args.crashdump_dir is None):
+            wf.config['execution']['crashdump_dir'] = args.crashdump_dir
+        hashing.configure(wf)
+        return wf
+
+    plugin_args = parse_plugin_args(args.plugin_args)
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler(os.path.join(work_dir, 'profile'), 'bids')
+        profiler.install(plugin_args)
+    if args.graph_cache:
+        # the graph depends on the subject directories and the contrasts
+        dataset = dataset_index(params['data_dir'], [
+            args.subjectprefix, os.path.join('code', 'model', 'model%03d' %
+                                             int(args.model),
+                                             'task_contrasts.txt')])
+        wf, execgraph, cached = cached_graph(
+            build, configure, __file__,
+            dict(params, resources=resources,
+                 crashdump_dir=args.crashdump_dir,
+                 hash_method=args.hash_method),
+            dataset, os.path.join(work_dir, CACHE_DIR), 'bids')
+        if cached:
+            print('Using the cached execution graph of %d nodes' %
+                  len(execgraph))
+        execgraph = run_expanded(wf, execgraph, args.plugin,
+                                 plugin_args=plugin_args)
     else:
-        #wf.run('SLURM', plugin_args={'sbatch_args': '-p om_interactive -N1 -c1','max_jobs':40}) 
-        wf.run(args.plugin)
+        wf = configure(build())
+        execgraph = wf.run(args.plugin, plugin_args=plugin_args)
+    if profiler is not None:
+        profiler.write(execgraph)
 
 
 
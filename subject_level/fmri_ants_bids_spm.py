@@ -12,48 +12,50 @@ This script demonstrates how to use nipype to analyze a data set::
     python fmri_ants_openfmri.py --datasetdir ds107
 """
 
-from nipype import config
-config.enable_provenance()
-
-from nipype.external import six
-
 from glob import glob
 import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
 
 use_spm_smooth = True
 use_spm_model = True
-
-import nipype.interfaces.spm as spm
-spm.SPMCommand.set_mlab_paths(paths='/cm/shared/openmind/spm/spm12/spm12_r6225/')
-
-import nipype.pipeline.engine as pe
-import nipype.algorithms.modelgen as model
-import nipype.algorithms.rapidart as ra
-import nipype.interfaces.fsl as fsl
-import nipype.interfaces.ants as ants
-from nipype.algorithms.misc import TSNR
-from nipype.interfaces.c3 import C3dAffineTool
-import nipype.interfaces.io as nio
-import nipype.interfaces.utility as niu
-from nipype.workflows.fmri.fsl import (create_featreg_preproc,
-                                       create_modelfit_workflow,
-                                       create_fixed_effects_flow)
-
-from nipype import LooseVersion
-from nipype import Workflow, Node, MapNode
-from nipype.interfaces import (fsl, Function, ants, freesurfer)
-
-from nipype.interfaces.utility import Rename, Merge, IdentityInterface
-from nipype.utils.filemanip import filename_to_list
-from nipype.interfaces.io import DataSink, FreeSurferSource
-import nipype.interfaces.freesurfer as fs
-
-version = 0
-if fsl.Info.version() and \
-    LooseVersion(fsl.Info.version()) > LooseVersion('5.0.6'):
-    version = 507
-
-fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+SPM_PATH = '/cm/shared/openmind/spm/spm12/spm12_r6225/'
+
+from pipeline_utils.lazy import lazy_from, lazy_import
+
+# nipype is imported when the workflow is built, not to parse arguments
+spm = lazy_import('nipype.interfaces.spm')
+pe = lazy_import('nipype.pipeline.engine')
+model = lazy_import('nipype.algorithms.modelgen')
+ra = lazy_import('nipype.algorithms.rapidart')
+fsl = lazy_import('nipype.interfaces.fsl')
+ants = lazy_import('nipype.interfaces.ants')
+C3dAffineTool = lazy_from('nipype.interfaces.c3', 'C3dAffineTool')
+nio = lazy_import('nipype.interfaces.io')
+niu = lazy_import('nipype.interfaces.utility')
+fsl_workflows = lazy_import('nipype.workflows.fmri.fsl')
+
+Workflow, Node, MapNode = lazy_from('nipype', 'Workflow', 'Node', 'MapNode')
+freesurfer = fs = lazy_import('nipype.interfaces.freesurfer')
+
+Function, Rename, Merge, IdentityInterface = lazy_from(
+    'nipype.interfaces.utility', 'Function', 'Rename', 'Merge',
+    'IdentityInterface')
+filename_to_list = lazy_from('nipype.utils.filemanip', 'filename_to_list')
+DataSink, FreeSurferSource = lazy_from('nipype.interfaces.io', 'DataSink',
+                                       'FreeSurferSource')
+
+from pipeline_utils.graphcache import (CACHE_DIR, cached_graph,
+                                       dataset_index, run_expanded)
+from pipeline_utils.hashing import HashPolicy, add_hash_argument
+from pipeline_utils.profiling import RunProfiler
+from pipeline_utils.resources import (apply_resources, default_resource_file,
+                                      load_resource_config, parse_plugin_args)
+from pipeline_utils.tsnr import average_images, tsnr_node
+from pipeline_utils.toolcache import TOOL_CACHE, ToolEnvironment
+# the sink is a nipype interface
+CompiledDataSink = lazy_from('pipeline_utils.sinks', 'CompiledDataSink')
 
 imports = ['import os',
            'import nibabel as nb',
@@ -63,33 +65,6 @@ imports = ['import os',
            'from scipy.special import legendre'
            ]
 
-def median(in_files):
-    """Computes an average of the median of each realigned timeseries
-
-    Parameters
-    ----------
-
-    in_files: one or more realigned Nifti 4D time series
-
-    Returns
-    -------
-
-    out_file: a 3D Nifti file
-    """
-    average = None
-    for idx, filename in enumerate(filename_to_list(in_files)):
-        img = nb.load(filename)
-        data = np.median(img.get_data(), axis=3)
-        if average is None:
-            average = data
-        else:
-            average = average + data
-    median_img = nb.Nifti1Image(average/float(idx + 1),
-                                img.get_affine(), img.get_header())
-    filename = os.path.join(os.getcwd(), 'median.nii.gz')
-    median_img.to_filename(filename)
-    return filename
-
 
 def create_reg_workflow(name='registration'):
     """Create a FEAT preprocessing workflow together with freesurfer
@@ -232,8 +207,6 @@ def create_reg_workflow(name='registration'):
     reg.inputs.float = True
     reg.inputs.output_warped_image = 'output_warped_image.nii.gz'
     reg.inputs.num_threads = 4
-    reg.plugin_args = {'qsub_args': '-pe orte 4',
-                       'sbatch_args': '--mem=6G -c 4'}
     register.connect(stripper, 'out_file', reg, 'moving_image')
     register.connect(inputnode,'target_image_brain', reg,'fixed_image')
 
@@ -459,8 +432,6 @@ def create_fs_reg_workflow(name='registration'):
     reg.inputs.float = True
     reg.inputs.output_warped_image = 'output_warped_image.nii.gz'
     reg.inputs.num_threads = 4
-    reg.plugin_args = {'qsub_args': '-pe orte 4',
-                       'sbatch_args': '--mem=6G -c 4'}
     register.connect(stripper, 'out_file', reg, 'moving_image')
     register.connect(inputnode,'target_image', reg,'fixed_image')
 
@@ -691,9 +662,11 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     Load nipype workflows
     """
 
-    preproc = create_featreg_preproc(whichvol='first')
-    modelfit = create_modelfit_workflow()
-    fixed_fx = create_fixed_effects_flow()
+    fsl.FSLCommand.set_default_output_type('NIFTI_GZ')
+    spm.SPMCommand.set_mlab_paths(paths=SPM_PATH)
+    preproc = fsl_workflows.create_featreg_preproc(whichvol='first')
+    modelfit = fsl_workflows.create_modelfit_workflow()
+    fixed_fx = fsl_workflows.create_fixed_effects_flow()
     if subjects_dir:
         registration = create_fs_reg_workflow()
     else:
@@ -986,17 +959,22 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                                                         ('residual_image', 'residual_image')]),
                     ])
 
-    # Comute TSNR on realigned data regressing polynomials upto order 2
-    tsnr = MapNode(TSNR(regress_poly=2), iterfield=['in_file'], name='tsnr')
+    # Compute TSNR on realigned data regressing polynomials up to order 2,
+    # with the median image of the detrended series in the same pass
+    tsnr = MapNode(Function(input_names=['in_file', 'regress_poly'],
+                            output_names=['tsnr_file', 'mean_file',
+                                          'stddev_file', 'median_file'],
+                            function=tsnr_node),
+                   iterfield=['in_file'], name='tsnr')
+    tsnr.inputs.regress_poly = 2
     wf.connect(preproc, "outputspec.realigned_files", tsnr, "in_file")
 
-    # Compute the median image across runs
+    # Average the median images of the runs
     calc_median = Node(Function(input_names=['in_files'],
                                 output_names=['median_file'],
-                                function=median,
-                                imports=imports),
+                                function=average_images),
                        name='median')
-    wf.connect(tsnr, 'detrended_file', calc_median, 'in_files')
+    wf.connect(tsnr, 'median_file', calc_median, 'in_files')
 
     """
     Reorder the copes so that now it combines across runs
@@ -1095,7 +1073,6 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
         warpall.inputs.invert_transform_flags = [False, False]
         warpall.inputs.terminal_output = 'file'
         warpall.inputs.num_threads = 2
-        warpall.plugin_args = {'sbatch_args': '--mem=6G -c 2'}
         warpall.inputs.reference_image = computed_target
         wf.connect(mergefunc, 'out_files', warpall, 'input_image')
         wf.connect(registration, 'outputspec.transforms', warpall, 'transforms')
@@ -1283,7 +1260,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
                       name='subsgen')
     wf.connect(subjinfo, 'run_id', subsgen, 'run_id')
 
-    datasink = pe.Node(interface=nio.DataSink(),
+    datasink = pe.Node(interface=CompiledDataSink(),
                        name="datasink")
     wf.connect(infosource, 'subject_id', datasink, 'container')
     wf.connect(infosource, 'subject_id', subsgen, 'subject_id')
@@ -1353,7 +1330,7 @@ def analyze_openfmri_dataset(data_dir, subject=None, model_id=None,
     wf.connect(registration, 'outputspec.anat2target_transform', datasink, 'xfm.anat2target')
 
     if subjects_dir:
-        datasink2 = Node(interface=DataSink(), name="datasink2")
+        datasink2 = Node(interface=CompiledDataSink(), name="datasink2")
         wf.connect(infosource, 'subject_id', datasink2, 'container')
         wf.connect(subsgen, 'substitutions', datasink2, 'substitutions')
         wf.connect(combiner, 'out_file',
@@ -1409,6 +1386,13 @@ if __name__ == '__main__':
                         help="Plugin to use")
     parser.add_argument("--plugin_args", dest="plugin_args",
                         help="Plugin arguments")
+    parser.add_argument("--resources", dest="resources",
+                        default=default_resource_file(__file__),
+                        help=("JSON or YAML file with default and per-node "
+                              "CPU/memory/partition requests" + defstr))
+    parser.add_argument("--profile", dest="profile", action='store_true',
+                        help=("Record wall/CPU time, memory and I/O of every "
+                              "node and write reports to <work_dir>/profile"))
     parser.add_argument("--sd", dest="subjects_dir",
                         help="FreeSurfer subjects directory (if available)")
     parser.add_argument('--surf_fwhm', default=15., dest='surf_fwhm',
@@ -1422,7 +1406,16 @@ if __name__ == '__main__':
                               "OASIS-30_Atropos_template_in_MNI152_2mm.nii.gz"))
     parser.add_argument("--sleep", dest="sleep", default=60., type=float,
                         help="Time to sleep between polls")
+    parser.add_argument("--no_graph_cache", dest="graph_cache",
+                        action='store_false',
+                        help=("Build and expand the workflow even if "
+                              "<work_dir>/%s has its execution graph for "
+                              "these sources, parameters and dataset"
+                              % CACHE_DIR))
+    add_hash_argument(parser)
     args = parser.parse_args()
+    from nipype import config
+    config.enable_provenance()
     outdir = args.outdir
     work_dir = os.getcwd()
     if args.work_dir:
@@ -1436,28 +1429,65 @@ if __name__ == '__main__':
     derivatives = args.derivatives
     if derivatives is None:
        derivatives = False
-    wf = analyze_openfmri_dataset(data_dir=os.path.abspath(args.datasetdir),
-                                  subject=args.subject,
-                                  model_id=int(args.model),
-                                  task_id=[int(args.task)],
-                                  subj_prefix=args.subjectprefix,
-                                  output_dir=outdir,
-                                  hpcutoff=args.hpfilter,
-                                  use_derivatives=derivatives,
-                                  fwhm=args.fwhm,
-                                  subjects_dir=args.subjects_dir,
-                                  target=args.target_file,
-                                  surf_fwhm=args.surf_fwhm,
-                                  target_subject=args.target_surfs)
-    #wf.config['execution']['remove_unnecessary_outputs'] = False
-
-    wf.base_dir = work_dir
-    wf.config['execution']['poll_sleep_duration'] = args.sleep
-    #wf.config['exeuction']['stop_on_first_rerun'] = True
-    wf.config['execution']['hash_method'] = 'timestamp'
-    wf.write_graph(graph2use='flat')
-    if args.plugin_args:
-        wf.run(args.plugin, plugin_args=eval(args.plugin_args))
+    params = dict(data_dir=os.path.abspath(args.datasetdir),
+                  subject=args.subject,
+                  model_id=int(args.model),
+                  task_id=[int(args.task)],
+                  subj_prefix=args.subjectprefix,
+                  output_dir=outdir,
+                  hpcutoff=args.hpfilter,
+                  use_derivatives=derivatives,
+                  fwhm=args.fwhm,
+                  subjects_dir=args.subjects_dir,
+                  target=args.target_file,
+                  surf_fwhm=args.surf_fwhm,
+                  target_subject=args.target_surfs)
+    resources = load_resource_config(args.resources)
+    # probe FSL, ANTs and FreeSurfer once for the driver and all nodes
+    tools = ToolEnvironment(os.path.join(work_dir, TOOL_CACHE))
+    tools.probe()
+    hashing = HashPolicy(args.hash_method)
+
+    def configure(wf):
+        #wf.config['execution']['remove_unnecessary_outputs'] = False
+        wf.base_dir = work_dir
+        wf.config['execution']['poll_sleep_duration'] = args.sleep
+        #wf.config['exeuction']['stop_on_first_rerun'] = True
+        hashing.configure(wf)
+        return wf
+
+    def build():
+        wf = configure(analyze_openfmri_dataset(**params))
+        wf.write_graph(graph2use='flat')
+        apply_resources(wf, resources)
+        tools.attach(wf)
+        hashing.attach(wf)
+        return wf
+
+    plugin_args = parse_plugin_args(args.plugin_args)
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler(os.path.join(work_dir, 'profile'), 'openfmri')
+        profiler.install(plugin_args)
+    if args.graph_cache:
+        # the graph depends on the subject directories and the contrasts
+        dataset = dataset_index(params['data_dir'], [
+            args.subjectprefix, os.path.join('code', 'model', 'model%03d' %
+                                             int(args.model),
+                                             'task_contrasts.txt')])
+        wf, execgraph, cached = cached_graph(
+            build, configure, __file__,
+            dict(params, resources=resources, sleep=args.sleep,
+                 hash_method=args.hash_method),
+            dataset, os.path.join(work_dir, CACHE_DIR), 'openfmri')
+        if cached:
+            print('Using the cached execution graph of %d nodes' %
+                  len(execgraph))
+        execgraph = run_expanded(wf, execgraph, args.plugin,
+                                 plugin_args=plugin_args)
     else:
-        wf.run(args.plugin)
+        wf = build()
+        execgraph = wf.run(args.plugin, plugin_args=plugin_args)
+    if profiler is not None:
+        profiler.write(execgraph)
     